@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Micro-benchmark the functions that klue-microservice runs on every
+request, each in isolation inside a Flask test request context, and compare
+them with a baseline.
+
+Usage:
+
+    # Measure, and fail if any benchmark is more than 20% slower, or
+    # allocates 20% more memory, than in bench/baseline.json. Also fail if
+    # there is no baseline, so that the gate never passes without comparing
+    # anything
+    python bench/bench_hotpaths.py --max-regression 20
+
+    # Record a new baseline (do so on the machine that runs the gate)
+    python bench/bench_hotpaths.py --update-baseline
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+
+from flask import Flask
+from klue.swagger.apipool import ApiPool
+import klue_microservice
+from klue_microservice.log import set_level
+from klue_microservice.config import get_config
+from klue_microservice.serializer import json_response
+from klue_microservice.crash import generate_crash_handler_decorator, populate_error_report
+from klue_microservice.auth import generate_token, authenticate_http_request, load_auth_token
+from klue_microservice.exceptions import AuthInvalidTokenError, format_error
+from klue_microservice.hooks import get_hooks, run_hooks
+
+
+BASELINE_PATH = os.path.join(here, 'baseline.json')
+
+
+def setup():
+    """Load the test config and serve the ping api from a Flask app, and
+    return the app and a valid token"""
+    get_config(os.path.join(here, '..', 'test', 'klue-config.yaml'))
+    app = Flask('bench')
+    ApiPool.add(
+        'ping',
+        yaml_path=os.path.join(os.path.dirname(klue_microservice.__file__), 'ping.yaml'),
+        error_callback=format_error,
+        host='localhost',
+        port=80,
+        local=True,
+    )
+    ApiPool.ping.spawn_api(app)
+    return app, generate_token('bench-user', expire_in=3600)
+
+
+def get_benchmarks(token):
+    """Return a dict of benchmark name -> (request headers, function to call)"""
+    crash_handler = generate_crash_handler_decorator()
+
+    @crash_handler
+    def do_succeed():
+        return json_response({'symbol': 'ok'})
+
+    @crash_handler
+    def do_fail():
+        raise AuthInvalidTokenError('bench')
+
+    def with_hooks(f):
+        # Also run the reports deferred until after the response, as the
+        # server would once it is sent
+        def g():
+            f()
+            hooks = get_hooks()
+            run_hooks(hooks)
+            del hooks[:]
+        return g
+
+    auth_headers = {'Authorization': 'Bearer %s' % token}
+
+    return {
+        'crash_handler_success': ({}, with_hooks(do_succeed)),
+        'crash_handler_error': ({}, with_hooks(do_fail)),
+        'authenticate_http_request': (auth_headers, authenticate_http_request),
+        'load_auth_token': ({}, lambda: load_auth_token(token)),
+        'http_reply': ({}, lambda: AuthInvalidTokenError('bench').http_reply()),
+        'populate_error_report': ({}, lambda: populate_error_report({})),
+        'format_error': ({}, lambda: format_error(Exception('bench'))),
+    }
+
+
+def measure(f, seconds):
+    """Return the best ns/op over 5 runs of about seconds/5 each, and the
+    median bytes allocated by one call"""
+    # Warm up, and size runs
+    n = 1
+    while True:
+        t0 = time.perf_counter_ns()
+        for i in range(n):
+            f()
+        elapsed = time.perf_counter_ns() - t0
+        if elapsed > 50 * 1000000:
+            break
+        n *= 2
+    n = max(1, int(n * seconds / 5 * 1e9 / elapsed))
+
+    best = None
+    for run in range(5):
+        t0 = time.perf_counter_ns()
+        for i in range(n):
+            f()
+        ns = (time.perf_counter_ns() - t0) / n
+        best = ns if best is None else min(best, ns)
+
+    # Peak memory allocated while running one call, not counting what
+    # tracemalloc itself allocates between calls
+    allocs = []
+    tracemalloc.start()
+    for i in range(21):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        f()
+        allocs.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    allocs.sort()
+
+    return int(best), allocs[len(allocs) // 2]
+
+
+def compare(results, baseline, max_regression):
+    """Return a report, and whether any benchmark regressed by more than
+    max_regression percent"""
+    lines = []
+    regressed = False
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        if not b:
+            lines.append("%-28s no baseline" % name)
+            continue
+        ns_change = (r['ns_per_op'] - b['ns_per_op']) * 100.0 / b['ns_per_op']
+        alloc_change = (r['alloc_bytes_per_op'] - b['alloc_bytes_per_op']) * 100.0 / max(1, b['alloc_bytes_per_op'])
+        flag = ''
+        if ns_change > max_regression or alloc_change > max_regression:
+            flag = '  REGRESSION'
+            regressed = True
+        lines.append("%-28s %+7.1f%% ns/op   %+7.1f%% bytes/op%s" % (name, ns_change, alloc_change, flag))
+    return lines, regressed
+
+
+def main():
+    p = argparse.ArgumentParser(description="Micro-benchmark klue-microservice's per-request code paths")
+    p.add_argument('--seconds', type=float, default=2, help="Time spent measuring each benchmark")
+    p.add_argument('--only', action='append', help="Run only this benchmark (repeatable)")
+    p.add_argument('--baseline', default=BASELINE_PATH, help="Baseline to compare with")
+    p.add_argument('--max-regression', type=float, default=20, help="Fail above this slowdown, in percent")
+    p.add_argument('--update-baseline', action='store_true', help="Save the results as the new baseline")
+    args = p.parse_args()
+
+    # Measure the code, not the writing of its logs
+    set_level(logging.ERROR)
+
+    app, token = setup()
+    results = {}
+
+    print("%-28s %12s %14s" % ('benchmark', 'ns/op', 'bytes/op'))
+    for name, (headers, f) in sorted(get_benchmarks(token).items()):
+        if args.only and name not in args.only:
+            continue
+        with app.test_request_context('/ping', headers=headers):
+            ns, alloc = measure(f, args.seconds)
+        results[name] = {'ns_per_op': ns, 'alloc_bytes_per_op': alloc}
+        print("%-28s %12s %14s" % (name, ns, alloc))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(json.dumps(results, indent=4, sort_keys=True))
+            f.write('\n')
+        print("Saved baseline to %s" % args.baseline)
+        return
+
+    if not os.path.isfile(args.baseline):
+        print("ERROR: no baseline at %s: run with --update-baseline to record one" % args.baseline)
+        sys.exit(1)
+
+    with open(args.baseline) as f:
+        lines, regressed = compare(results, json.loads(f.read()), args.max_regression)
+    print("\nCompared with %s (max regression: %s%%):" % (args.baseline, args.max_regression))
+    print('\n'.join(lines))
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
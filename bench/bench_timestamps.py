@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Compare the speed of klue_microservice.utils's timestamp conversions with
+their former dateutil-based implementation.
+
+Usage: python bench/bench_timestamps.py [--count N]
+"""
+
+import os
+import sys
+import timeit
+import argparse
+import datetime
+import pytz
+from dateutil import parser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from klue_microservice.utils import to_epoch, to_datetime, to_epoch_many, to_datetime_many
+
+
+def legacy_to_epoch(t):
+    if isinstance(t, str):
+        if '+' not in t:
+            t = t + '+00:00'
+        t = parser.parse(t)
+    elif t.tzinfo is None or t.tzinfo.utcoffset(t) is None:
+        t = t.replace(tzinfo=pytz.timezone('utc'))
+    t0 = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, pytz.timezone('utc'))
+    delta = t - t0
+    return int(delta.total_seconds())
+
+
+def legacy_to_datetime(e):
+    return datetime.datetime.fromtimestamp(e, pytz.timezone('utc'))
+
+
+def run(name, f, count, repeat=3):
+    best = min(timeit.repeat(f, number=1, repeat=repeat))
+    print("%-45s %8.1f msec  %8.2f usec/item" % (name, best * 1000, best * 1000000 / count))
+    return best
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark timestamp conversions")
+    p.add_argument('--count', type=int, default=10000, help="Timestamps converted per run")
+    args = p.parse_args()
+
+    count = args.count
+    start = datetime.datetime(2017, 3, 1, tzinfo=pytz.utc)
+    dates = [start + datetime.timedelta(seconds=17 * i, microseconds=i) for i in range(count)]
+    strings = [d.isoformat() for d in dates]
+    naive_strings = [d.replace(tzinfo=None).isoformat() for d in dates]
+    epochs = [legacy_to_epoch(d) for d in dates]
+
+    assert [to_epoch(s) for s in strings] == [legacy_to_epoch(s) for s in strings]
+    assert [to_epoch(s) for s in naive_strings] == [legacy_to_epoch(s) for s in naive_strings]
+
+    print("Converting %s timestamps" % count)
+
+    for label, items in (('iso strings with timezone', strings), ('iso strings without timezone', naive_strings), ('datetimes', dates)):
+        before = run("legacy to_epoch, %s" % label, lambda: [legacy_to_epoch(t) for t in items], count)
+        after = run("to_epoch, %s" % label, lambda: [to_epoch(t) for t in items], count)
+        run("to_epoch_many, %s" % label, lambda: to_epoch_many(items), count)
+        print("%-45s %8.1fx" % ("speedup", before / after))
+
+    before = run("legacy to_datetime", lambda: [legacy_to_datetime(e) for e in epochs], count)
+    after = run("to_datetime_many", lambda: to_datetime_many(epochs), count)
+    print("%-45s %8.1fx" % ("speedup", before / after))
+
+    try:
+        import numpy
+    except ImportError:
+        return
+    array = numpy.array([d.replace(tzinfo=None) for d in dates], dtype='datetime64[us]')
+    run("to_epoch_many, numpy datetime64 array", lambda: to_epoch_many(array), count)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,8 +8,13 @@ from flask import Response, redirect
 from flask_compress import Compress
 from flask_cors import CORS
 from klue.swagger.apipool import ApiPool
-from klue_microservice.log import set_level
+from klue_microservice.log import set_level, configure_logging
 from klue_microservice.crash import set_error_reporter, generate_crash_handler_decorator
+from klue_microservice.admission import generate_admission_decorator
+from klue_microservice.deadline import generate_deadline_decorator
+from klue_microservice.client import decorate_client_callers
+from klue_microservice.hooks import install_after_response
+from klue_microservice.api import do_health
 from klue_microservice.exceptions import format_error
 from klue_microservice.config import get_config
 
@@ -17,6 +22,11 @@ from klue_microservice.config import get_config
 log = logging.getLogger(__name__)
 
 
+# Set by klue_microservice.test when loading the server in the test process:
+# build the app, but do not run it
+is_in_process_test = False
+
+
 #
 # API: class to define then run a micro service api
 #
@@ -46,7 +56,7 @@ class API(object):
         if error_reporter:
             set_error_reporter(error_reporter)
 
-        log.info("Initialized API (%s:%s) (Flask debug:%s)" % (host, port, debug))
+        log.info("Initialized API (%s:%s) (Flask debug:%s)", host, port, debug)
 
 
     def load_clients(self, path=None, apis=[]):
@@ -66,7 +76,7 @@ class API(object):
             api_path = os.path.join(path, '%s.yaml' % api_name)
             if not os.path.isfile(api_path):
                 raise Exception("Cannot find swagger specification at %s" % api_path)
-            log.info("Loading api %s from %s" % (api_name, api_path))
+            log.info("Loading api %s from %s", api_name, api_path)
             ApiPool.add(
                 api_name,
                 yaml_path=api_path,
@@ -76,11 +86,12 @@ class API(object):
                 do_persist=False,
                 local=False,
             )
+            decorate_client_callers(getattr(ApiPool, api_name))
 
         return self
 
 
-    def load_apis(self, path, ignore=[], include_crash_api=False):
+    def load_apis(self, path, ignore=[], include_crash_api=False, include_debug_api=False):
         """Load all swagger files found at the given path, except those whose
         names are in the 'ignore' list"""
 
@@ -96,21 +107,21 @@ class API(object):
         # Find all swagger apis under 'path'
         apis = {}
 
-        log.debug("Searching path %s" % path)
+        log.debug("Searching path %s", path)
         for root, dirs, files in os.walk(path):
             for f in files:
                 if f.endswith('.yaml'):
                     api_name = f.replace('.yaml', '')
 
                     if api_name in ignore:
-                        log.info("Ignoring api %s" % api_name)
+                        log.info("Ignoring api %s", api_name)
                         continue
 
                     apis[api_name] = os.path.join(path, f)
-                    log.debug("Found api %s in %s" % (api_name, f))
+                    log.debug("Found api %s in %s", api_name, f)
 
-        # And add klue-microservice's default ping and crash apis
-        for name in ['ping', 'crash']:
+        # And add klue-microservice's default ping, crash and debug apis
+        for name in ['ping', 'crash', 'debug']:
             yaml_path = pkg_resources.resource_filename(__name__, 'klue_microservice/%s.yaml' % name)
             if not os.path.isfile(yaml_path):
                 yaml_path = os.path.join(os.path.dirname(sys.modules[__name__].__file__), '%s.yaml' % name)
@@ -119,6 +130,9 @@ class API(object):
         if not include_crash_api:
             del apis['crash']
 
+        if not include_debug_api:
+            del apis['debug']
+
         # Save found apis
         self.path_apis = path
         self.apis = apis
@@ -150,12 +164,12 @@ class API(object):
         for api_name, api_path in self.apis.items():
 
             api_filename = os.path.basename(api_path)
-            log.info("Publishing api %s at /%s/%s" % (api_name, path, api_name))
+            log.info("Publishing api %s at /%s/%s", api_name, path, api_name)
 
             def redirect_to_petstore(live_host, api_filename):
                 def f():
                     url = 'http://petstore.swagger.io/?url=%s/%s/%s' % (live_host, path, api_filename)
-                    log.info("Redirecting to %s" % url)
+                    log.info("Redirecting to %s", url)
                     return redirect(url, code=302)
                 return f
 
@@ -163,7 +177,7 @@ class API(object):
                 def f():
                     with open(api_path, 'r') as f:
                         spec = f.read()
-                        log.info("Serving %s" % api_path)
+                        log.info("Serving %s", api_path)
                         return Response(spec, mimetype='text/plain')
                 return f
 
@@ -196,14 +210,16 @@ class API(object):
         app = self.app
         app.secret_key = os.urandom(24)
 
-        # Initialize JWT config
         conf = get_config()
+        configure_logging(conf)
+
+        # Initialize JWT config
         if hasattr(conf, 'jwt_secret'):
-            log.info("Set JWT parameters to issuer=%s audience=%s secret=%s***" % (
+            log.info("Set JWT parameters to issuer=%s audience=%s secret=%s***",
                 conf.jwt_issuer,
                 conf.jwt_audience,
                 conf.jwt_secret[0:8],
-            ))
+            )
 
         # Always serve the ping api
         serve.append('ping')
@@ -212,6 +228,13 @@ class API(object):
         compress = Compress()
         compress.init_app(app)
 
+        # Run the work deferred by endpoints once their response is sent
+        install_after_response(app)
+
+        # Served outside of the crash handler and admission control, so that
+        # an unhealthy reply is neither reported as an error nor shed
+        app.add_url_rule('/health', 'klue_health', do_health)
+
         # All apis that are not served locally are not persistent
         not_persistent = []
         for api_name in self.apis.keys():
@@ -234,7 +257,7 @@ class API(object):
             do_persist = True if api_name not in not_persistent else False
             local = True if api_name in serve else False
 
-            log.info("Loading api %s from %s (persist: %s)" % (api_name, api_path, do_persist))
+            log.info("Loading api %s from %s (persist: %s)", api_name, api_path, do_persist)
             ApiPool.add(
                 api_name,
                 yaml_path=api_path,
@@ -249,16 +272,28 @@ class API(object):
 
         ApiPool.merge()
 
+        # Wrap every endpoint in a crash handler that catches replies and
+        # reports errors, behind an admission control that sheds load when
+        # the worker is overloaded and a check of the caller's deadline
+        crash_handler = generate_crash_handler_decorator(self.error_decorator)
+        admission_control = generate_admission_decorator()
+        deadline_control = generate_deadline_decorator()
+
+        def decorator(f):
+            return admission_control(deadline_control(crash_handler(f)))
+
         # Now spawn flask routes for all endpoints
         for api_name in self.apis.keys():
             if api_name in serve:
-                log.info("Spawning api %s" % api_name)
+                log.info("Spawning api %s", api_name)
                 api = getattr(ApiPool, api_name)
-                # Spawn api and wrap every endpoint in a crash handler that
-                # catches replies and reports errors
-                api.spawn_api(app, decorator=generate_crash_handler_decorator(self.error_decorator))
+                api.spawn_api(app, decorator=decorator)
 
-        log.debug("Argv is [%s]" % '  '.join(sys.argv))
+        # Outbound calls forward the request's deadline
+        for api_name in self.apis.keys():
+            decorate_client_callers(getattr(ApiPool, api_name))
+
+        log.debug("Argv is [%s]", '  '.join(sys.argv))
         if 'celery' in sys.argv[0].lower():
             # This code is loading in a celery server - Don't start the actual flask app.
             log.info("Running in a Celery worker - Not starting the Flask app")
@@ -269,6 +304,11 @@ class API(object):
             log.info("Running in Gunicorn - Not starting the Flask app")
             return
 
+        if is_in_process_test:
+            # Tests call the app via Flask's test client
+            log.info("Running in-process tests - Not starting the Flask app")
+            return
+
         # Debug mode is the default when not running via gunicorn
         app.debug = self.debug
         app.run(host='0.0.0.0', port=self.port)
@@ -300,5 +340,5 @@ def letsgo(name, callback=None):
             with_async = True
         main()
 
-    if os.path.basename(sys.argv[0]) == 'gunicorn':
+    if os.path.basename(sys.argv[0]) == 'gunicorn' or is_in_process_test:
         callback()
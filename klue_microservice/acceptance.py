@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import time
+import logging
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+import click
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Run acceptance tests in parallel: split test modules into shards of about
+# equal duration, based on the durations recorded by previous runs, and run
+# each shard in its own nosetests process against the same server
+#
+# Called by run_acceptance_tests --jobs N
+#
+
+DURATIONS_FILE = '.klue-test-durations.json'
+
+# Assumed duration of a test module never run before, in seconds
+DEFAULT_DURATION = 10
+
+
+def find_test_modules(paths):
+    """Return the test modules (test*.py) under the given paths"""
+    modules = []
+    for path in paths:
+        if os.path.isfile(path):
+            modules.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                if f.startswith('test') and f.endswith('.py'):
+                    modules.append(os.path.join(root, f))
+    return [os.path.normpath(m) for m in modules]
+
+
+def load_durations(path):
+    try:
+        with open(path) as f:
+            return json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_durations(path, durations):
+    tmp_path = '%s.%s' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(durations, indent=4, sort_keys=True))
+    os.rename(tmp_path, path)
+
+
+def make_shards(modules, durations, jobs):
+    """Split modules into jobs shards of about equal total duration: assign
+    the longest modules first, each to the shortest shard so far"""
+    known = [durations[m] for m in modules if m in durations]
+    default = sorted(known)[len(known) // 2] if known else DEFAULT_DURATION
+
+    shards = [[] for i in range(min(jobs, len(modules)))]
+    totals = [0] * len(shards)
+    for m in sorted(modules, key=lambda m: durations.get(m, default), reverse=True):
+        i = totals.index(min(totals))
+        shards[i].append(m)
+        totals[i] += durations.get(m, default)
+    return shards, totals
+
+
+def get_module_name(path):
+    """Return the dotted name nose imports the module at path under: its file
+    name, prefixed with those of the packages (directories with an
+    __init__.py) it is in"""
+    names = [os.path.splitext(os.path.basename(path))[0]]
+    d = os.path.dirname(os.path.abspath(path))
+    while os.path.isfile(os.path.join(d, '__init__.py')):
+        names.insert(0, os.path.basename(d))
+        d = os.path.dirname(d)
+    return '.'.join(names)
+
+
+def parse_xunit(path, modules):
+    """Return the number of tests, failures and errors, and the duration of
+    each module, from a nosetests xunit report"""
+    by_name = {}
+    for m in modules:
+        by_name.setdefault(get_module_name(m), []).append(m)
+
+    durations = {}
+    try:
+        root = ET.parse(path).getroot()
+    except (IOError, OSError, ET.ParseError):
+        return 0, 0, 0, durations
+
+    for case in root.iter('testcase'):
+        # nose names test classes '<module>.<class>', and test functions
+        # '<module>'
+        classname = case.get('classname', '')
+        found = by_name.get(classname) or by_name.get(classname.rpartition('.')[0])
+        if found and len(found) == 1:
+            # Modules with the same name in different directories cannot be
+            # told apart: their durations are not recorded
+            durations[found[0]] = durations.get(found[0], 0) + float(case.get('time', 0))
+
+    return int(root.get('tests', 0)), int(root.get('failures', 0)), int(root.get('errors', 0)), durations
+
+
+def run_shards(shards, nose_args):
+    """Run each shard in its own nosetests process, all at once, and return
+    each shard's exit code, output and xunit report path"""
+    tmpdir = tempfile.mkdtemp(prefix='klue-acceptance-')
+    procs = []
+    for i, shard in enumerate(shards):
+        xunit = os.path.join(tmpdir, 'shard-%s.xml' % i)
+        output = open(os.path.join(tmpdir, 'shard-%s.log' % i), 'w+')
+        cmd = ['nosetests'] + nose_args + ['--with-xunit', '--xunit-file=%s' % xunit] + shard
+        log.info("Shard %s: %s", i, ' '.join(cmd))
+        p = subprocess.Popen(cmd, stdout=output, stderr=subprocess.STDOUT)
+        procs.append((p, output, xunit))
+
+    results = []
+    for p, output, xunit in procs:
+        rc = p.wait()
+        output.seek(0)
+        results.append((rc, output.read(), xunit))
+        output.close()
+    return results
+
+
+@click.command()
+@click.option('--jobs', help="Number of test processes to run in parallel", default=2)
+@click.option('--durations', help="File recording the duration of each test module (default: %s)" % DURATIONS_FILE, default=DURATIONS_FILE)
+@click.option('--nose-args', help="Arguments passed to nosetests (default: '-xv')", default='-xv')
+@click.argument('paths', nargs=-1)
+def main(jobs, durations, nose_args, paths):
+    """Run the acceptance tests under paths in jobs parallel processes"""
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    modules = find_test_modules(paths or ['testaccept'])
+    if not modules:
+        print("ERROR: found no test modules in %s" % ' '.join(paths))
+        sys.exit(1)
+
+    recorded = load_durations(durations)
+    shards, totals = make_shards(modules, recorded, jobs)
+    for i, (shard, total) in enumerate(zip(shards, totals)):
+        print("=> Shard %s: %s modules, ~%.0f sec" % (i, len(shard), total))
+
+    t0 = time.time()
+    results = run_shards(shards, nose_args.split())
+
+    rc = 0
+    tests, failures, errors = 0, 0, 0
+    for i, (shard, (shard_rc, output, xunit)) in enumerate(zip(shards, results)):
+        print("\n=> Output of shard %s (exit code %s):\n" % (i, shard_rc))
+        print(output)
+
+        t, f, e, measured = parse_xunit(xunit, shard)
+        tests, failures, errors = tests + t, failures + f, errors + e
+        recorded.update(measured)
+        if shard_rc != 0:
+            rc = shard_rc
+
+    save_durations(durations, recorded)
+
+    print("=> Ran %s tests in %s shards in %.1f sec: %s failures, %s errors" % (tests, len(shards), time.time() - t0, failures, errors))
+    sys.exit(rc)
+
+
+if __name__ == '__main__':
+    main()
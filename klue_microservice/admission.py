@@ -0,0 +1,149 @@
+import logging
+import time
+from functools import wraps
+from flask import request
+from klue_microservice.config import get_config
+from klue_microservice.crash import function_name
+from klue_microservice.exceptions import ServerOverloadedError
+from klue_microservice.health import record_shed, record_queue_delay
+from klue_microservice.hooks import after_response
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Admission control: shed load early when this worker is saturated, instead
+# of letting latency collapse for every request it serves
+#
+
+# Health endpoints are never shed (/health bypasses admission altogether)
+exempt_endpoints = set([
+    'klue_microservice.api.do_ping',
+    'klue_microservice.api.do_version',
+])
+
+# Per-worker counters
+inflight = 0
+admitted = 0
+shed_inflight = 0
+shed_queue_delay = 0
+last_queue_delay_ms = 0
+
+
+def get_queue_delay_ms(header):
+    """Take the value of a X-Request-Start header, as set by nginx
+    ('t=1485357812.345') or other proxies (epoch in sec, msec or usec), and
+    return how many milliseconds the request spent queued before reaching
+    this worker, or None if the header cannot be parsed"""
+
+    if header.startswith('t='):
+        header = header[2:]
+
+    try:
+        start = float(header)
+    except ValueError:
+        return None
+
+    # Guess the unit from the order of magnitude of the epoch
+    if start > 1e14:
+        start = start / 1000000.0
+    elif start > 1e11:
+        start = start / 1000.0
+
+    return max(0, (time.time() - start) * 1000)
+
+
+def get_admission_stats():
+    """Return this worker's admission counters"""
+    return {
+        'inflight': inflight,
+        'admitted': admitted,
+        'shed': shed_inflight + shed_queue_delay,
+        'shed_inflight': shed_inflight,
+        'shed_queue_delay': shed_queue_delay,
+        'last_queue_delay_ms': last_queue_delay_ms,
+    }
+
+
+def shed(reason):
+    record_shed()
+    shed_count = shed_inflight + shed_queue_delay
+    if shed_count % 100 == 1:
+        log.warn("SHEDDING LOAD: %s (%s requests shed so far)", reason, shed_count)
+    r = ServerOverloadedError(reason).http_reply()
+    r.headers['Retry-After'] = '1'
+    return r
+
+
+def release_after_stream(call):
+    """Keep counting a streamed call as in flight until its stream has ended,
+    or its response was closed without the stream being sent"""
+    released = []
+
+    def release():
+        global inflight
+        if not released:
+            released.append(True)
+            inflight -= 1
+
+    on_end = call.on_end
+
+    def on_stream_end(call):
+        release()
+        if on_end:
+            on_end(call)
+
+    call.on_end = on_stream_end
+    after_response(release)
+
+
+def generate_admission_decorator():
+    """Return a decorator that rejects calls to an endpoint with a 503 when
+    this worker is overloaded, as configured by 'max_inflight_requests' and
+    'max_queue_delay_ms' in klue-config.yaml"""
+
+    max_inflight = get_config().max_inflight_requests
+    max_queue_delay_ms = get_config().max_queue_delay_ms
+
+    def admission_control(f):
+
+        if function_name(f) in exempt_endpoints:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            global inflight, admitted, shed_inflight, shed_queue_delay, last_queue_delay_ms
+
+            if max_inflight and inflight >= max_inflight:
+                shed_inflight += 1
+                return shed("%s requests already in flight" % inflight)
+
+            # Always measure queueing delay, for /health
+            header = request.headers.get('X-Request-Start', None)
+            if header:
+                delay = get_queue_delay_ms(header)
+                if delay is not None:
+                    last_queue_delay_ms = delay
+                    record_queue_delay(delay)
+                    if max_queue_delay_ms and delay > max_queue_delay_ms:
+                        shed_queue_delay += 1
+                        return shed("request queued for %d msec" % delay)
+
+            inflight += 1
+            admitted += 1
+            is_streamed = False
+            try:
+                res = f(*args, **kwargs)
+                if hasattr(res, 'klue_stream'):
+                    # The body is sent after we return
+                    release_after_stream(res.klue_stream)
+                    is_streamed = True
+                return res
+            finally:
+                if not is_streamed:
+                    inflight -= 1
+
+        return wrapper
+
+    return admission_control
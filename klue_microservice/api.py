@@ -1,11 +1,22 @@
+import os
+import time
 import logging
 import pprint
 from flask import make_response
 from time import sleep
 from klue.swagger.apipool import ApiPool
 from klue_microservice.utils import get_container_version
-from klue_microservice.crash import report_error
-from klue_microservice.exceptions import KlueMicroServiceException
+from klue_microservice.crash import report_error, never_report_slow
+from klue_microservice.config import get_config
+from klue_microservice.exceptions import KlueMicroServiceException, ProfilerBusyError
+from klue_microservice.stream import stream_models
+from klue_microservice.tracing import get_tracer
+from klue_microservice.profiler import start_profiler
+from klue_microservice.tasks import get_task_stats
+from klue_microservice.admission import get_admission_stats
+from klue_microservice.health import get_health
+from klue_microservice.blocking import get_blocking_stats
+from klue_microservice.serializer import json_response
 
 
 log = logging.getLogger(__name__)
@@ -32,9 +43,50 @@ def do_version():
         version=ApiPool().current_server_api.get_version(),
         container=get_container_version(),
     )
-    log.info("/version: " + pprint.pformat(v))
+    if log.isEnabledFor(logging.INFO):
+        log.info("/version: %s", pprint.pformat(v))
     return v
 
+def do_health():
+    """Report this worker's saturation, and reply 503 if it breaches the
+    thresholds set in klue-config.yaml, for load balancers to drain it"""
+    h = get_health(get_admission_stats()['inflight'])
+    h['pid'] = os.getpid()
+    h['hub'] = get_blocking_stats()
+    h['healthy'] = not h['breaches']
+    return json_response(h, status=200 if h['healthy'] else 503)
+
+def do_debug_spans():
+    """Return the spans recently recorded by this worker"""
+    return json_response({
+        'pid': os.getpid(),
+        'spans': get_tracer().get_spans(),
+    })
+
+@never_report_slow
+def do_debug_profile(seconds=None):
+    """Profile this worker for the given number of seconds and return its
+    collapsed stacks"""
+    max_seconds = get_config().profile_max_seconds
+    seconds = min(seconds or 10, max_seconds)
+    p = start_profiler(seconds)
+    if not p:
+        raise ProfilerBusyError("Worker %s is already being profiled" % os.getpid())
+    # time.sleep is looked up at call time, to yield to other greenlets once
+    # gevent has patched it, while the profiler samples from its own thread
+    while not p.is_done:
+        time.sleep(0.1)
+    return json_response({
+        'pid': os.getpid(),
+        'seconds': seconds,
+        'samples': p.samples,
+        'stacks': p.get_collapsed_stacks(),
+    })
+
+def do_debug_tasks():
+    """Return the queue depth and counters of this worker's background tasks"""
+    return json_response(get_task_stats())
+
 def do_crash_internal_exception():
     raise Exception("Raising an internal exception")
 
@@ -64,3 +116,17 @@ def do_crash_return_error_model():
 
 def do_crash_return_error_instance():
     return MyFatalCustomError("endpoint returns an Error instance")
+
+def do_crash_stream_error():
+    def generate():
+        yield ApiPool.crash.model.Ok()
+        yield ApiPool.crash.model.Ok()
+        raise Exception("Raising an exception mid-stream")
+    return stream_models(generate(), format='array', api_name='crash')
+
+def do_crash_stream_slow_call():
+    def generate():
+        for i in range(3):
+            sleep(0.6)
+            yield ApiPool.crash.model.Ok()
+    return stream_models(generate(), format='array', api_name='crash')
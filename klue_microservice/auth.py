@@ -68,11 +68,11 @@ def load_auth_token(token, load=True):
     assert get_config().jwt_issuer, "No JWT issuer configured for klue-microservice"
     assert get_config().jwt_audience, "No JWT audience configured for klue-microservice"
 
-    log.info("Validating token, using issuer:%s, audience:%s, secret:%s***" % (
+    log.info("Validating token, using issuer:%s, audience:%s, secret:%s***",
         get_config().jwt_issuer,
         get_config().jwt_audience,
         get_config().jwt_secret[1:8],
-    ))
+    )
 
     # First extract the issuer (default to 'klue')
     issuer = get_config().jwt_issuer
@@ -81,13 +81,13 @@ def load_auth_token(token, load=True):
     except jwt.DecodeError:
         raise AuthInvalidTokenError('token signature is invalid')
 
-    log.debug("Token has headers %s" % headers)
+    log.debug("Token has headers %s", headers)
 
     if 'iss' in headers:
         issuer = headers['iss']
 
     # Then validate the token against this issuer
-    log.info("Validating token in issuer %s" % issuer)
+    log.info("Validating token in issuer %s", issuer)
     try:
         payload = jwt.decode(
             token,
@@ -133,7 +133,7 @@ def authenticate_http_request(token=None):
         if auth:
             auth = unquote_plus(auth)
 
-    log.debug("Validating Auth header [%s]" % auth)
+    log.debug("Validating Auth header [%s]", auth)
 
     if not auth:
         raise AuthMissingHeaderError('There is no Authorization header in the HTTP request')
@@ -188,7 +188,7 @@ def generate_token(user_id, expire_in=None, data={}, issuer=None, iat=None):
         "iss": issuer,
     }
 
-    log.debug("Encoding token with data %s and headers %s (secret:%s****)" % (data, headers, get_config().jwt_secret[0:8]))
+    log.debug("Encoding token with data %s and headers %s (secret:%s****)", data, headers, get_config().jwt_secret[0:8])
 
     t = jwt.encode(
         data,
@@ -225,10 +225,10 @@ def backend_token(issuer=None, user_id=None, data={}):
 
     tmp_token = generate_token(user_id, issuer=issuer, data=data)
 
-    log.debug("Temporarily using custom token for %s and issuer %s: %s" % (user_id, issuer, tmp_token))
+    log.debug("Temporarily using custom token for %s and issuer %s: %s", user_id, issuer, tmp_token)
     stack.top.current_user['token'] = tmp_token
     yield tmp_token
-    log.debug("Restoring token %s" % cur_token)
+    log.debug("Restoring token %s", cur_token)
     stack.top.current_user['token'] = cur_token
 
 
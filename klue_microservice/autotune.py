@@ -0,0 +1,158 @@
+import os
+import json
+import logging
+import multiprocessing
+from klue_microservice.memory import get_memory_usage
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Choose gunicorn's worker settings from the resources actually available to
+# the container (cgroup cpu quota and memory limit), the measured memory
+# footprint of a worker, and the kind of load the service handles
+#
+
+MB = 1024 * 1024
+
+# Where workers record their memory footprint, to size the next startup
+WORKER_MEMORY_FILE = '/tmp/klue-worker-memory.json'
+
+# Where the container's cgroup (v1 or v2) is mounted
+CGROUP_DIR = '/sys/fs/cgroup'
+
+# Per profile: worker class, workers per cpu, extra workers, connections per worker
+profiles = {
+    # Mostly waiting on databases and other apis: many greenlets per worker
+    'io': ('gevent', 2, 1, 1000),
+    # A mix of io and cpu-heavy work: fewer greenlets, so that a cpu-heavy
+    # request delays fewer others
+    'mixed': ('gevent', 1, 1, 100),
+    # Cpu-bound: one request at a time per worker, one worker per cpu
+    'cpu': ('sync', 1, 0, 1),
+}
+
+
+def read_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_cpu_limit():
+    """Return the number of cpus this container may use, from its cgroup cpu
+    quota if any, else from its cpu affinity, as a float"""
+
+    # cgroup v2: '<quota> <period>' or 'max <period>'
+    s = read_file(os.path.join(CGROUP_DIR, 'cpu.max'))
+    if s:
+        quota, period = s.split()
+        if quota != 'max':
+            return float(quota) / float(period)
+    else:
+        # cgroup v1
+        quota = read_file(os.path.join(CGROUP_DIR, 'cpu', 'cpu.cfs_quota_us'))
+        period = read_file(os.path.join(CGROUP_DIR, 'cpu', 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            return float(quota) / float(period)
+
+    if hasattr(os, 'sched_getaffinity'):
+        return float(len(os.sched_getaffinity(0)))
+    return float(multiprocessing.cpu_count())
+
+
+def get_memory_limit():
+    """Return how many bytes of memory this container may use, from its cgroup
+    memory limit if any, else the host's physical memory"""
+
+    physical = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    s = read_file(os.path.join(CGROUP_DIR, 'memory.max'))
+    if s is None:
+        s = read_file(os.path.join(CGROUP_DIR, 'memory', 'memory.limit_in_bytes'))
+
+    if s and s != 'max':
+        # cgroup v1 reports a huge number when there is no limit
+        return min(int(s), physical)
+    return physical
+
+
+def record_worker_memory():
+    """Record the memory used by this worker on its own (not shared with the
+    master), to size the number of workers at the next startup"""
+    usage = get_memory_usage()
+    if not usage:
+        return
+    try:
+        with open(WORKER_MEMORY_FILE, 'w') as f:
+            f.write(json.dumps({'unique': usage['unique'], 'rss': usage['rss']}))
+    except (IOError, OSError) as e:
+        log.warn("Failed to record worker memory in %s: %s", WORKER_MEMORY_FILE, e)
+
+
+def get_worker_memory(conf, master_memory=None):
+    """Return the estimated memory footprint of one worker, in bytes, and where
+    that estimate comes from. Until a worker was measured after warmup, use
+    the memory of the master after preload if given: a worker starts as a
+    copy of it"""
+    if conf.gunicorn_worker_memory_mb:
+        return conf.gunicorn_worker_memory_mb * MB, 'gunicorn_worker_memory_mb in klue-config.yaml'
+
+    s = read_file(WORKER_MEMORY_FILE)
+    if s:
+        try:
+            return json.loads(s)['unique'], 'measured after warmup (%s)' % WORKER_MEMORY_FILE
+        except (ValueError, KeyError):
+            pass
+
+    if master_memory:
+        return master_memory, 'memory of the master after preload'
+
+    return 100 * MB, 'default estimate'
+
+
+def autotune(conf, master_memory=None):
+    """Return a dict of gunicorn settings (workers, worker_class,
+    worker_connections) and the list of reasons behind them. master_memory
+    is the unique memory of the gunicorn master once it has preloaded the
+    app, if known"""
+
+    reasons = []
+
+    profile = conf.gunicorn_profile
+    if profile not in profiles:
+        reasons.append("unknown gunicorn_profile '%s': using 'io'" % profile)
+        profile = 'io'
+    worker_class, per_cpu, extra, connections = profiles[profile]
+    reasons.append("profile '%s': %s workers, %s per cpu + %s, %s connections each" % (profile, worker_class, per_cpu, extra, connections))
+
+    cpus = get_cpu_limit()
+    reasons.append("%.2f cpus available" % cpus)
+    workers = max(1, int(round(cpus * per_cpu)) + extra)
+
+    memory = get_memory_limit()
+    worker_memory, source = get_worker_memory(conf, master_memory)
+    # Keep some room for the master and the shared memory
+    max_workers = max(1, int(memory * 0.8 / worker_memory))
+    reasons.append("%.0fMB of memory available, %.0fMB per worker (%s): room for %s workers" % (
+        memory / MB, worker_memory / MB, source, max_workers
+    ))
+
+    if workers > max_workers:
+        reasons.append("capping workers from %s to %s to fit in memory" % (workers, max_workers))
+        workers = max_workers
+
+    if conf.gunicorn_workers:
+        reasons.append("gunicorn_workers=%s set in klue-config.yaml: overriding %s workers" % (conf.gunicorn_workers, workers))
+        workers = conf.gunicorn_workers
+
+    reasons.append("=> %s %s workers with %s connections each" % (workers, worker_class, connections))
+
+    return {
+        'workers': workers,
+        'worker_class': worker_class,
+        'worker_connections': connections,
+    }, reasons
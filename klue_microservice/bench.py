@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import threading
+import subprocess
+import http.client
+import click
+from klue_microservice.utils import timenow
+from klue_microservice.test import wait_for_server
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Measure the throughput and latency of a klue-microservice server, by
+# starting it under gunicorn on localhost and loading its built-in endpoints.
+# By default, benchmark the minimal server shipped in 'benchserver/'
+#
+# Run with:
+#
+# python -m klue_microservice.bench --workers 2 --worker-class gevent --output results.json
+#
+
+# Benchmarked endpoints: name -> (path, requires authentication, expected status)
+endpoints = {
+    'ping': ('/ping', False, 200),
+    'version': ('/version', False, 200),
+    'auth_version': ('/auth/version', True, 200),
+    'crash_klue_exception': ('/crash/klueexception', False, 401),
+    'crash_internal_exception': ('/crash/internalexception', False, 500),
+    'crash_return_error_model': ('/crash/returnerrormodel', False, 543),
+}
+
+# Upper bounds of the latency histogram's buckets, in msec
+buckets = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# The bench server, installed with the package
+BENCH_SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchserver')
+
+
+def start_server(port, workers, worker_class, worker_connections=None, app='benchserver:app', chdir=BENCH_SERVER_DIR):
+    """Start the server under gunicorn, on localhost, and return its process
+    once it accepts connections"""
+
+    # letsgo() only starts the app when run by an executable named 'gunicorn'
+    gunicorn = shutil.which('gunicorn') or os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    cmd = [
+        gunicorn,
+        '--config', 'python:klue_microservice.gunicorn',
+        '--bind', '127.0.0.1:%s' % port,
+        '--workers', str(workers),
+        '--worker-class', worker_class,
+        '--chdir', chdir,
+    ]
+    if worker_connections:
+        cmd += ['--worker-connections', str(worker_connections)]
+    cmd.append(app)
+
+    env = dict(os.environ)
+    env['NO_ERROR_REPORTING'] = '1'
+    env['KLUE_IS_EC2_INSTANCE'] = '0'
+
+    log.info("Starting server: %s", ' '.join(cmd))
+    # Run from chdir too, where klue_microservice.gunicorn looks for klue-config.yaml
+    p = subprocess.Popen(cmd, env=env, cwd=chdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    if not wait_for_server('127.0.0.1', port, p=p):
+        stop_server(p)
+        raise Exception("Server failed to start: %s" % ' '.join(cmd))
+    return p
+
+
+def stop_server(p):
+    p.terminate()
+    try:
+        p.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        p.kill()
+
+
+def percentile(latencies, p):
+    """Return the p-th percentile of a sorted list"""
+    if not latencies:
+        return 0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def summarize(latencies, errors, seconds):
+    """Return requests/sec, latency percentiles and histogram"""
+    latencies = sorted(latencies)
+    histogram = {}
+    i = 0
+    for bound in buckets:
+        n = 0
+        while i < len(latencies) and latencies[i] <= bound:
+            n += 1
+            i += 1
+        histogram['<=%s' % bound] = n
+    histogram['>%s' % buckets[-1]] = len(latencies) - i
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / seconds, 1),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+            'p50': round(percentile(latencies, 50), 3),
+            'p90': round(percentile(latencies, 90), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3) if latencies else 0,
+        },
+        'histogram': histogram,
+    }
+
+
+def run_load(host, port, path, headers, expected_status, concurrency, seconds):
+    """Call path from concurrency threads, each over a keep-alive connection,
+    for the given number of seconds, and return the latencies (in msec) and
+    the number of unexpected replies"""
+
+    latencies = []
+    errors = []
+    deadline = time.time() + seconds
+
+    def worker():
+        mine = []
+        failed = 0
+        c = http.client.HTTPConnection(host, port, timeout=30)
+        while time.time() < deadline:
+            t0 = time.perf_counter()
+            try:
+                c.request('GET', path, headers=headers)
+                r = c.getresponse()
+                r.read()
+                ok = r.status == expected_status
+            except (socket.error, http.client.HTTPException):
+                c.close()
+                c = http.client.HTTPConnection(host, port, timeout=30)
+                ok = False
+            if ok:
+                mine.append((time.perf_counter() - t0) * 1000)
+            else:
+                failed += 1
+        c.close()
+        latencies.extend(mine)
+        errors.append(failed)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return latencies, sum(errors)
+
+
+def benchmark(host, port, names, concurrency, seconds, warmup_seconds=2, token=None):
+    """Load each endpoint in turn, and return the results per endpoint"""
+    results = {}
+    for name in names:
+        path, needs_auth, expected_status = endpoints[name]
+        headers = {}
+        if needs_auth:
+            headers['Authorization'] = 'Bearer %s' % token
+
+        log.info("Benchmarking %s (%s) with %s concurrent clients for %s sec", name, path, concurrency, seconds)
+        run_load(host, port, path, headers, expected_status, concurrency, warmup_seconds)
+        latencies, errors = run_load(host, port, path, headers, expected_status, concurrency, seconds)
+        results[name] = summarize(latencies, errors, seconds)
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Compare results with a baseline, and return a report and whether any
+    endpoint's requests/sec dropped, or p99 latency rose, by more than
+    max_regression percent"""
+    lines = []
+    regressed = False
+    for name, r in sorted(results['endpoints'].items()):
+        b = baseline['endpoints'].get(name)
+        if not b or not b['rps'] or not b['latency_ms']['p99']:
+            continue
+        rps_change = (r['rps'] - b['rps']) * 100.0 / b['rps']
+        p99_change = (r['latency_ms']['p99'] - b['latency_ms']['p99']) * 100.0 / b['latency_ms']['p99']
+        flag = ''
+        if max_regression is not None and (rps_change < -max_regression or p99_change > max_regression):
+            flag = '  REGRESSION'
+            regressed = True
+        lines.append("%-26s rps %9.1f -> %9.1f (%+6.1f%%)   p99 %8.2f -> %8.2f ms (%+6.1f%%)%s" % (
+            name, b['rps'], r['rps'], rps_change, b['latency_ms']['p99'], r['latency_ms']['p99'], p99_change, flag
+        ))
+    return lines, regressed
+
+
+def format_results(results):
+    lines = ["%-26s %9s %7s %9s %9s %9s %9s" % ('endpoint', 'rps', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+    for name, r in sorted(results['endpoints'].items()):
+        l = r['latency_ms']
+        lines.append("%-26s %9.1f %7s %9.2f %9.2f %9.2f %9.2f" % (name, r['rps'], r['errors'], l['p50'], l['p90'], l['p99'], l['max']))
+    return lines
+
+
+def get_test_token(chdir=BENCH_SERVER_DIR):
+    """Generate a token with the JWT settings of the server's klue-config.yaml"""
+    from klue_microservice.config import get_config
+    from klue_microservice.auth import generate_token
+    get_config(os.path.join(chdir, 'klue-config.yaml'))
+    return generate_token('klue-bench', expire_in=3600)
+
+
+@click.command()
+@click.option('--port', help="Port to start the server on (default: 8770)", default=8770)
+@click.option('--workers', help="Number of gunicorn workers (default: 1)", default=1)
+@click.option('--worker-class', help="Gunicorn worker class (default: gevent)", default='gevent')
+@click.option('--worker-connections', help="Max connections per gevent worker", default=None, type=int)
+@click.option('--app', help="Gunicorn app to start (default: the bench server shipped with klue-microservice)", default='benchserver:app')
+@click.option('--chdir', help="Directory of the app and of its klue-config.yaml (default: that of the bench server)", default=BENCH_SERVER_DIR)
+@click.option('--no-server/--server', help="Benchmark a server already listening on localhost:<port>", default=False)
+@click.option('--concurrency', help="Number of concurrent clients (default: 16)", default=16)
+@click.option('--seconds', help="Duration of the load on each endpoint (default: 10)", default=10)
+@click.option('--endpoint', help="Endpoint to benchmark (repeatable, default: all)", multiple=True, type=click.Choice(sorted(endpoints.keys())))
+@click.option('--output', help="Save the results as json in this file", default=None)
+@click.option('--baseline', help="Compare the results with those saved in this file", default=None)
+@click.option('--max-regression', help="Exit with an error if rps drops, or p99 rises, by more than this percent", default=None, type=float)
+def main(port, workers, worker_class, worker_connections, app, chdir, no_server, concurrency, seconds, endpoint, output, baseline, max_regression):
+    """Benchmark the built-in endpoints of a klue-microservice server: by
+    default, of a minimal server shipped with klue-microservice. Use --app and
+    --chdir to benchmark your own server, started with include_crash_api=True"""
+
+    if max_regression is not None and not baseline:
+        print("ERROR: --max-regression requires a --baseline to compare with")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO)
+    names = list(endpoint) or sorted(endpoints.keys())
+
+    p = None
+    if not no_server:
+        p = start_server(port, workers, worker_class, worker_connections=worker_connections, app=app, chdir=chdir)
+    try:
+        token = get_test_token(chdir)
+        results = {
+            'date': timenow().isoformat(),
+            'config': {
+                'workers': workers,
+                'worker_class': worker_class,
+                'worker_connections': worker_connections,
+                'concurrency': concurrency,
+                'seconds': seconds,
+            },
+            'endpoints': benchmark('127.0.0.1', port, names, concurrency, seconds, token=token),
+        }
+    finally:
+        if p:
+            stop_server(p)
+
+    print('\n'.join(format_results(results)))
+
+    if output:
+        with open(output, 'w') as f:
+            f.write(json.dumps(results, indent=4, sort_keys=True))
+        print("Saved results to %s" % output)
+
+    if baseline:
+        with open(baseline) as f:
+            lines, regressed = compare(results, json.loads(f.read()), max_regression)
+        print("\nCompared with %s:" % baseline)
+        print('\n'.join(lines))
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
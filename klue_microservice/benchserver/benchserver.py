@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import logging
+from flask import Flask
+from klue_microservice import API, letsgo
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# A server with only klue-microservice's built-in endpoints, shipped with the
+# package for 'klue_bench' to start under gunicorn (with this directory as
+# --chdir, where it finds its klue-config.yaml)
+#
+
+app = Flask(__name__)
+
+
+def start(port=8770, debug=False):
+
+    api = API(
+        app,
+        port=port,
+        debug=False,
+    )
+    api.load_apis('.', include_crash_api=True)
+    api.start(serve="crash")
+
+letsgo(__name__, callback=start)
@@ -0,0 +1,116 @@
+import os
+import time
+import logging
+from klue_microservice.config import get_config
+from klue_microservice.utils import is_ec2_instance
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Detect greenlets that block the gevent hub (cpu-heavy work, blocking
+# sockets, sync client libraries...) and stall every request on the worker,
+# using gevent's own monitoring thread
+#
+
+# Per-worker counters
+blocked_count = 0
+max_blocked_ms = 0
+last_report_time = 0
+unreported_count = 0
+
+
+def get_blocking_stats():
+    """Return this worker's hub-blocking counters"""
+    return {
+        'blocked': blocked_count,
+        'max_blocked_ms': max_blocked_ms,
+    }
+
+
+def report_blocking(blocking_ms, stack):
+    """Send a non-fatal error report about a greenlet that blocked the hub.
+    Runs in its own greenlet"""
+    from klue_microservice.crash import report_error
+
+    global unreported_count
+    data = {
+        # We are not in a request context: skip populate_error_report()
+        'user': {},
+        'is_ec2_instance': is_ec2_instance(),
+        'blocking': {
+            'pid': os.getpid(),
+            'blocked_ms': blocking_ms,
+            'blocked_count': blocked_count,
+            'unreported_since_last_report': unreported_count,
+            'stack': stack,
+        },
+    }
+    unreported_count = 0
+
+    report_error(
+        title="gevent hub blocked for more than %s msec" % blocking_ms,
+        data=data,
+    )
+
+
+def spawn_report(blocking_ms, stack):
+    # Report from a greenlet in the hub's thread, since the error reporter may
+    # do (gevent-patched) network io
+    import gevent
+    gevent.spawn(report_blocking, blocking_ms, stack)
+
+
+def generate_blocking_listener(hub, report_interval):
+
+    def on_event(event):
+        # Called in gevent's monitoring thread, not in the hub
+        if type(event).__name__ != 'EventLoopBlocked':
+            return
+
+        global blocked_count, max_blocked_ms, last_report_time, unreported_count
+        blocking_ms = int(event.blocking_time * 1000)
+        blocked_count += 1
+        max_blocked_ms = max(max_blocked_ms, blocking_ms)
+
+        now = time.time()
+        if now - last_report_time < report_interval:
+            unreported_count += 1
+            return
+        last_report_time = now
+
+        hub.loop.run_callback_threadsafe(spawn_report, blocking_ms, '\n'.join(event.info))
+
+    return on_event
+
+
+def start_blocking_monitor():
+    """Start reporting greenlets that block the hub for more than
+    'hub_max_blocking_ms' msec (set in klue-config.yaml), if running under
+    gevent. Call it in each worker, after forking"""
+
+    max_blocking_ms = get_config().hub_max_blocking_ms
+    if not max_blocking_ms:
+        return
+
+    try:
+        import gevent
+        import gevent.events
+        from gevent.monkey import is_module_patched
+    except ImportError:
+        log.info("gevent is not installed: not monitoring hub blocking")
+        return
+
+    if not is_module_patched('socket'):
+        log.info("Not running under gevent: not monitoring hub blocking")
+        return
+
+    gevent.config.max_blocking_time = max_blocking_ms / 1000.0
+    gevent.config.monitor_thread = True
+
+    hub = gevent.get_hub()
+    gevent.events.subscribers.append(generate_blocking_listener(hub, get_config().hub_block_report_interval_sec))
+    hub.start_periodic_monitoring_thread()
+
+    log.info("Reporting greenlets blocking the gevent hub for more than %s msec", max_blocking_ms)
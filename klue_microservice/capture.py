@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import glob
+import time
+import zlib
+import queue
+import random
+import socket
+import logging
+import threading
+import http.client
+import click
+from flask import request
+from klue_microservice.config import get_config
+from klue_microservice import serializer
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Capture a sample of the requests served by each worker, as compact json
+# lines in rotating files, and replay them against a local server to compare
+# latencies under a production-like mix of calls
+#
+
+MB = 1024 * 1024
+
+
+class TrafficCapture(object):
+
+    def __init__(self):
+        conf = get_config()
+        self.sample_rate = conf.capture_sample_rate
+        self.capture_dir = conf.capture_dir
+        self.max_bytes = conf.capture_max_mb * MB
+        self.backups = conf.capture_backups
+        self.with_bodies = conf.capture_bodies
+        self.pid = None
+        self.file = None
+        self.size = 0
+
+    def is_sampled(self):
+        return self.sample_rate and random.random() < self.sample_rate
+
+    def record(self, endpoint, status, t0, t1):
+        """Record the current request, served by endpoint between t0 and t1
+        (datetimes) with the given status"""
+        body = request.get_data(cache=True)
+        r = {
+            't': round(t0.timestamp(), 3),
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'query': request.query_string.decode('utf-8', 'replace'),
+            'auth': 'Authorization' in request.headers,
+            'body_size': len(body),
+            'status': int(status),
+            'ms': round((t1 - t0).total_seconds() * 1000, 3),
+        }
+        if body:
+            r['body_crc'] = '%08x' % zlib.crc32(body)
+            if self.with_bodies:
+                r['body'] = body.decode('utf-8', 'replace')
+                r['content_type'] = request.content_type
+        self.write(serializer.dumpb(r) + b'\n')
+
+    def write(self, line):
+        if self.pid != os.getpid():
+            # Each worker writes its own file, re-opened after forking
+            self.pid = os.getpid()
+            os.makedirs(self.capture_dir, exist_ok=True)
+            self.open()
+        if self.size + len(line) > self.max_bytes:
+            self.rotate()
+        self.file.write(line)
+        self.size += len(line)
+
+    def get_path(self, i=0):
+        path = os.path.join(self.capture_dir, 'capture-%s.jsonl' % self.pid)
+        return '%s.%s' % (path, i) if i else path
+
+    def open(self):
+        # Unbuffered: one write per line, so that nothing is lost when
+        # gunicorn kills a worker
+        self.file = open(self.get_path(), 'ab', buffering=0)
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.get_path(i)):
+                os.rename(self.get_path(i), self.get_path(i + 1))
+        if self.backups:
+            os.rename(self.get_path(), self.get_path(1))
+        else:
+            os.remove(self.get_path())
+        self.open()
+
+
+capture = None
+
+def get_capture():
+    global capture
+    if not capture:
+        capture = TrafficCapture()
+    return capture
+
+
+def capture_request(endpoint, status, t0, t1):
+    """Called by the crash handler after each call: capture a sample of them,
+    if 'capture_sample_rate' is set in klue-config.yaml"""
+    try:
+        c = get_capture()
+        if c.is_sampled():
+            c.record(endpoint, status, t0, t1)
+    except Exception as e:
+        # Capturing must never break a request
+        log.warn("Failed to capture request, turning capture off: %s", e)
+        if capture:
+            capture.sample_rate = 0
+
+
+#
+# Replay
+#
+
+def load_captures(paths):
+    """Return the records in the given capture files (or directories), sorted
+    by time"""
+    files = []
+    for p in paths:
+        if os.path.isdir(p):
+            files += glob.glob(os.path.join(p, 'capture-*.jsonl*'))
+        else:
+            files.append(p)
+
+    records = []
+    for path in files:
+        with open(path) as f:
+            for l in f:
+                l = l.strip()
+                if l:
+                    records.append(json.loads(l))
+    records.sort(key=lambda r: r['t'])
+    return records
+
+
+def is_replayable(r):
+    """Return False for calls that had a body that was not captured: replayed
+    without it, they would only measure how fast the server rejects them"""
+    return r['method'] == 'GET' or 'body' in r or not r.get('body_size')
+
+
+def replay(records, host, port, speed=1.0, concurrency=32, token=None):
+    """Send the captured requests to host:port, at the pace they were
+    captured divided by speed (0: as fast as possible), and return the
+    latencies (msec) and number of errors per endpoint"""
+
+    latencies = {}
+    errors = {}
+    lock = threading.Lock()
+    todo = queue.Queue(maxsize=concurrency * 4)
+
+    def worker():
+        c = http.client.HTTPConnection(host, port, timeout=60)
+        while True:
+            r = todo.get()
+            if r is None:
+                break
+            path = r['path'] + ('?' + r['query'] if r['query'] else '')
+            headers = {}
+            if r['auth'] and token:
+                headers['Authorization'] = 'Bearer %s' % token
+            body = None
+            if 'body' in r:
+                body = r['body'].encode('utf-8')
+                headers['Content-Type'] = r.get('content_type') or 'application/json'
+            t0 = time.perf_counter()
+            try:
+                c.request(r['method'], path, body=body, headers=headers)
+                resp = c.getresponse()
+                resp.read()
+                ok = resp.status == r['status']
+            except (socket.error, http.client.HTTPException):
+                c.close()
+                c = http.client.HTTPConnection(host, port, timeout=60)
+                ok = False
+            ms = (time.perf_counter() - t0) * 1000
+            with lock:
+                if ok:
+                    latencies.setdefault(r['endpoint'], []).append(ms)
+                else:
+                    errors[r['endpoint']] = errors.get(r['endpoint'], 0) + 1
+        c.close()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+
+    start = time.time()
+    first = records[0]['t'] if records else 0
+    for r in records:
+        if speed:
+            delay = start + (r['t'] - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        todo.put(r)
+
+    for t in threads:
+        todo.put(None)
+    for t in threads:
+        t.join()
+
+    return latencies, errors, time.time() - start
+
+
+@click.command()
+@click.option('--host', help="Host of the server to replay against (default: 127.0.0.1)", default='127.0.0.1')
+@click.option('--port', help="Port of the server (default: 8080)", default=8080)
+@click.option('--speed', help="Replay speed: 1 for the captured pace, 2 for twice faster, 0 for as fast as possible", default=1.0)
+@click.option('--concurrency', help="Max concurrent requests (default: 32)", default=32)
+@click.option('--token', help="JWT token sent with requests that were authenticated (default: $KLUE_JWT_TOKEN)", default=None)
+@click.option('--output', help="Save the replay's results as json in this file", default=None)
+@click.option('--baseline', help="Compare with the results of a previous replay", default=None)
+@click.option('--max-regression', help="Exit with an error if rps drops, or p99 rises, by more than this percent", default=None, type=float)
+@click.argument('captures', nargs=-1, required=True)
+def main(host, port, speed, concurrency, token, output, baseline, max_regression, captures):
+    """Replay captured requests against a local server, and compare latencies
+    with those captured"""
+
+    from klue_microservice.bench import summarize, compare
+
+    if max_regression is not None and not baseline:
+        print("ERROR: --max-regression requires a --baseline to compare with")
+        sys.exit(1)
+
+    records = load_captures(captures)
+    if not records:
+        print("ERROR: no captured requests in %s" % ' '.join(captures))
+        sys.exit(1)
+
+    count = len(records)
+    records = [r for r in records if is_replayable(r)]
+    if len(records) < count:
+        print("=> Skipping %s requests whose body was not captured (set 'capture_bodies' to capture them)" % (count - len(records)))
+    if not records:
+        print("ERROR: no replayable requests in %s" % ' '.join(captures))
+        sys.exit(1)
+
+    token = token or os.environ.get('KLUE_JWT_TOKEN')
+    captured_seconds = max(records[-1]['t'] - records[0]['t'], 1)
+    print("=> Replaying %s requests captured over %.0f sec, at %sx speed" % (len(records), captured_seconds, speed or 'max'))
+
+    latencies, errors, seconds = replay(records, host, port, speed=speed, concurrency=concurrency, token=token)
+
+    captured = {}
+    for r in records:
+        captured.setdefault(r['endpoint'], []).append(r['ms'])
+
+    results = {'endpoints': {}}
+    print("%-40s %7s %7s %21s %21s" % ('', '', '', 'captured (server)', 'replayed (client)'))
+    print("%-40s %7s %7s %10s %10s %10s %10s" % ('endpoint', 'calls', 'errors', 'p50 ms', 'p99 ms', 'p50 ms', 'p99 ms'))
+    for endpoint in sorted(captured.keys()):
+        c = summarize(captured[endpoint], 0, captured_seconds)
+        r = summarize(latencies.get(endpoint, []), errors.get(endpoint, 0), seconds)
+        results['endpoints'][endpoint] = r
+        print("%-40s %7s %7s %10.2f %10.2f %10.2f %10.2f" % (
+            endpoint[-40:], len(captured[endpoint]), r['errors'],
+            c['latency_ms']['p50'], c['latency_ms']['p99'],
+            r['latency_ms']['p50'], r['latency_ms']['p99'],
+        ))
+
+    if output:
+        with open(output, 'w') as f:
+            f.write(json.dumps(results, indent=4, sort_keys=True))
+        print("Saved results to %s" % output)
+
+    if baseline:
+        with open(baseline) as f:
+            lines, regressed = compare(results, json.loads(f.read()), max_regression)
+        print("\nCompared with %s:" % baseline)
+        print('\n'.join(lines))
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
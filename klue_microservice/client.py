@@ -0,0 +1,25 @@
+import logging
+from klue_microservice.deadline import deadline_client_decorator
+from klue_microservice.tracing import tracing_client_decorator
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Decorate the client callers generated by klue-client-server, to add
+# behaviour to every outbound call made through ApiPool
+#
+
+client_decorators = [
+    deadline_client_decorator,
+    tracing_client_decorator,
+]
+
+def decorate_client_callers(api):
+    """Wrap every client caller of this api (ApiPool.<name>.client.*) in the
+    client decorators"""
+    for name, caller in list(vars(api.client).items()):
+        for decorator in client_decorators:
+            caller = decorator(api, name, caller)
+        setattr(api.client, name, caller)
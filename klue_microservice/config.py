@@ -24,6 +24,109 @@ class KlueConfig(object):
         # Default time-limit for the slow-call report
         self.report_call_exceeding_ms = 1000
 
+        # Admission control: reject requests with a 503 when a worker has too
+        # many requests in flight, or when requests queued too long before
+        # reaching it (0 means no limit)
+        self.max_inflight_requests = 0
+        self.max_queue_delay_ms = 0
+
+        # Default deadline of incoming requests, when the caller sets none (0
+        # means no deadline)
+        self.default_call_timeout_ms = 0
+
+        # Tracing: fraction of requests to trace (0 means off), how many spans
+        # each worker keeps in memory, and where to export them, if anywhere
+        # ('file:///path/to/spans.json' or 'udp://host:port')
+        self.trace_sample_rate = 0
+        self.trace_buffer_size = 1000
+        self.trace_sink = None
+
+        # Gunicorn worker recycling: restart a worker when its rss exceeds
+        # worker_max_rss_mb, or grows by more than worker_max_rss_growth_percent
+        # over its rss after worker_warmup_requests requests (0 means no
+        # limit). Only one worker is recycled every
+        # worker_recycle_min_interval_sec seconds.
+        self.worker_max_rss_mb = 0
+        self.worker_max_rss_growth_percent = 0
+        self.worker_warmup_requests = 200
+        self.worker_rss_check_every = 50
+        self.worker_recycle_min_interval_sec = 60
+
+        # Gunicorn autotuning: set gunicorn_profile to 'io', 'mixed' or 'cpu'
+        # to size workers from the container's cpu and memory limits (see
+        # klue_microservice.autotune). Optionally set the memory used by one
+        # worker, or force the number of workers.
+        self.gunicorn_profile = None
+        self.gunicorn_worker_memory_mb = 0
+        self.gunicorn_workers = 0
+
+        # Report greenlets that block the gevent hub for more than this many
+        # msec (0 means off), at most once every hub_block_report_interval_sec
+        self.hub_max_blocking_ms = 0
+        self.hub_block_report_interval_sec = 300
+
+        # How long to profile a worker for, when it receives SIGUSR2, and
+        # the longest profiling allowed via /debug/profile
+        self.profile_signal_seconds = 30
+        self.profile_max_seconds = 60
+
+        # Logging: write log records from a background thread instead of in
+        # the request (log_async), as plain text or as json lines
+        # (log_format: 'text' or 'json')
+        self.log_async = False
+        self.log_format = 'text'
+
+        # Log policy: per-logger levels (logger -> level), 1-in-N sampling
+        # (logger -> N) and rate limits (logger -> records per second per
+        # message template) of records below WARNING
+        self.log_levels = {}
+        self.log_sampling = {}
+        self.log_rate_limits = {}
+
+        # Traffic capture: fraction of requests to record (0 means off) into
+        # rotating files capture-<pid>.jsonl in capture_dir, for replay with
+        # klue_microservice.capture. Request bodies are only recorded if
+        # capture_bodies is true, otherwise only their size and crc32.
+        self.capture_sample_rate = 0
+        self.capture_dir = '/tmp/klue-capture'
+        self.capture_max_mb = 50
+        self.capture_backups = 3
+        self.capture_bodies = False
+
+        # Background tasks (see klue_microservice.tasks): how many threads
+        # (greenlets under gevent) run them in each worker, how many tasks may
+        # wait for them, where durable tasks are spooled, and how long an
+        # exiting worker waits for its tasks to complete
+        self.task_workers = 4
+        self.task_queue_size = 1000
+        self.task_spool_path = '/tmp/klue-tasks.sqlite'
+        self.task_shutdown_timeout = 10
+
+        # Health endpoint (/health): the window over which it measures the
+        # error rate, p95 latency and queueing delay of calls, and the
+        # thresholds above which it replies 503 (0 means no threshold). Error
+        # rate and p95 are only checked over at least health_min_calls calls.
+        self.health_window_sec = 60
+        self.health_min_calls = 20
+        self.health_max_inflight = 0
+        self.health_max_queue_delay_ms = 0
+        self.health_max_error_percent = 0
+        self.health_max_p95_ms = 0
+
+        # Metrics: push call counts and latencies per endpoint and status to
+        # the StatsD agent at statsd_host:statsd_port (None means off) every
+        # statsd_flush_interval_sec seconds, as tags with DogStatsD or in the
+        # metric names otherwise, sending at most statsd_max_timer_samples
+        # latencies per endpoint and status per flush
+        self.statsd_host = None
+        self.statsd_port = 8125
+        self.statsd_prefix = 'klue'
+        self.statsd_tags = {}
+        self.statsd_dogstatsd = True
+        self.statsd_flush_interval_sec = 10
+        self.statsd_max_timer_samples = 50
+        self.statsd_max_packet_bytes = 1432
+
         # Get the live host from klue-config.yaml
         paths = [
             os.path.join(os.path.dirname(sys.argv[0]), 'klue-config.yaml'),
@@ -38,7 +141,7 @@ class KlueConfig(object):
         config_path = None
         for p in paths:
             p = os.path.abspath(p)
-            log.info("Looking for klue config at %s" % p)
+            log.info("Looking for klue config at %s", p)
             if os.path.isfile(p):
                 config_path = p
                 continue
@@ -48,7 +151,7 @@ class KlueConfig(object):
 
         self.config_path = config_path
 
-        log.info("Loading config file at %s" % config_path)
+        log.info("Loading config file at %s", config_path)
         all_keys = []
         config_dict = {}
         with open(config_path, 'r') as stream:
@@ -72,7 +175,7 @@ class KlueConfig(object):
                     config_dict[k] = str(getattr(self, k))[0:8] + '****'
 
         # Print config file to log, but obfuscate secrets
-        log.debug("Loaded configuration:\n%s" % pprint.pformat(config_dict, indent=4))
+        log.debug("Loaded configuration:\n%s", pprint.pformat(config_dict, indent=4))
 
 
 config = None
@@ -1,5 +1,4 @@
 import logging
-import json
 import uuid
 import os
 import inspect
@@ -13,6 +12,12 @@ from klue.swagger.apipool import ApiPool
 from klue_microservice.config import get_config
 from klue_microservice.utils import timenow, is_ec2_instance
 from klue_microservice.exceptions import UnhandledServerError
+from klue_microservice import serializer
+from klue_microservice.tracing import get_tracer
+from klue_microservice.capture import capture_request
+from klue_microservice.hooks import after_response
+from klue_microservice.health import update_health
+from klue_microservice.metrics import emit_call_metrics
 
 
 log = logging.getLogger(__name__)
@@ -41,7 +46,7 @@ class report_slow(object):
     def __call__(self, f):
         global slow_calls
         fname = function_name(f)
-        log.info("Setting custom slow_call report time limit on function %s to %s msec" % (fname, self.max_ms))
+        log.info("Setting custom slow_call report time limit on function %s to %s msec", fname, self.max_ms)
         if self.max_ms:
             slow_calls[fname] = self.max_ms
 
@@ -51,14 +56,37 @@ class report_slow(object):
 
         return wrapped
 
+
+def never_report_slow(f):
+    """Decorate an endpoint that is slow by design, to never report its calls
+    as slow"""
+    slow_calls[function_name(f)] = None
+    return f
+
+
+class pretty(object):
+    """Wrap an object to pretty-print it only if and when it is turned into a
+    string, for instance by logging once the record has passed the log
+    policy"""
+
+    __slots__ = ['obj']
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
+    __repr__ = __str__
+
 #
 # Default error reporting
 #
 
 def default_error_reporter(title, message):
     """By default, error messages are just logged"""
-    log.error("error: %s" % title)
-    log.error("details:\n%s" % message)
+    log.error("error: %s", title)
+    log.error("details:\n%s", message)
 
 error_reporter = default_error_reporter
 
@@ -96,6 +124,10 @@ def report_error(title=None, data={}, caught=None, is_fatal=False):
     if 'user' not in data:
         populate_error_report(data)
 
+    # Pretty-print the request's params, now that they are reported
+    if isinstance(data.get('request', {}).get('params'), pretty):
+        data['request'] = dict(data['request'], params=str(data['request']['params']))
+
     # Add the message
     data['title'] = title
     data['is_fatal_error'] = is_fatal
@@ -141,10 +173,10 @@ def report_error(title=None, data={}, caught=None, is_fatal=False):
     log.info("Reporting crash...")
 
     try:
-        error_reporter(title, json.dumps(data, sort_keys=True, indent=4))
+        error_reporter(title, serializer.dumps(data, pretty=True))
     except Exception as e:
         # Don't block on replying to api caller
-        log.error("Failed to send email report: %s" % str(e))
+        log.error("Failed to send email report: %s", str(e))
 
 
 def populate_error_report(data):
@@ -220,6 +252,121 @@ def populate_error_report(data):
         }
 
 
+def report_call(f, data, t0, t1, args, kwargs, response, error_id='', exception_string=''):
+    """Complete the report of a call to the endpoint f, and forward it to the
+    error_reporter if the call failed or was too slow. Called after the
+    response was sent: data must already hold the request's details (see
+    populate_error_report)"""
+
+    request_args = []
+    if len(args):
+        request_args.append(args)
+    if kwargs:
+        request_args.append(kwargs)
+
+    data.update({
+        # Set only on the original error, not on forwarded ones, not on
+        # success responses
+        'error_id': error_id,
+
+        # Call results
+        'time': {
+            'start': t0.isoformat(),
+            'end': t1.isoformat(),
+            'microsecs': (t1.timestamp() - t0.timestamp()) * 1000000,
+        },
+
+        # Response details
+        'response': response,
+
+        # Request details
+        'request': {
+            'params': pretty(request_args),
+        },
+    })
+
+    if 'user' not in data:
+        populate_error_report(data)
+    if log.isEnabledFor(logging.INFO):
+        log.info("Analytics: %s", pretty(data))
+
+    # inspect may raise a UnicodeDecodeError...
+    fname = function_name(f)
+
+    #
+    # Should we report this call?
+    #
+
+    # If it is an internal errors, report it
+    if data['response']['status'] and int(data['response']['status']) >= 500:
+        report_error(
+            title="%s(): %s" % (fname, exception_string),
+            data=data,
+            is_fatal=True
+        )
+    elif 'celery' in sys.argv[0].lower():
+        # This is an async task running in celery - Slow calls don't matter
+        pass
+    else:
+        # Looking this function's time-limit, else use default
+        global slow_calls
+        max_ms = get_config().report_call_exceeding_ms
+        if fname in slow_calls:
+            max_ms = slow_calls[fname]
+        log.info("Checking if call to %s exceeds %s msec", fname, max_ms)
+        if max_ms is not None and int(data['time']['microsecs']) > max_ms * 1000:
+            log.warn("SLOW CALL to %s: exceeded %s millisec", fname, max_ms)
+            report_error(
+                title='%s() calltime exceeded %s millisec!' % (fname, max_ms),
+                data=data
+            )
+
+
+def report_streamed_call(f, data, t0, t1, args, kwargs, call):
+    """Report a call whose response was streamed, once the stream has ended"""
+
+    data['stream'] = {
+        'format': call.format,
+        'items': call.items,
+        'bytes': call.bytes,
+    }
+
+    response = {
+        'type': 'Response',
+        'status': '200',
+        'is_error': 0,
+        'error_code': '',
+        'error_description': '',
+        'user_message': '',
+    }
+
+    exception_string = ''
+    if call.error:
+        # The stream was interrupted and ended with an error record
+        if call.trace:
+            data['trace'] = call.trace
+        exception_string = call.error.get('error_description', '')
+        response.update({
+            'status': str(call.error['status']),
+            'is_error': 1,
+            'error_code': call.error['error'],
+            'error_description': exception_string,
+            'user_message': call.error.get('user_message', ''),
+        })
+
+    report_call(
+        f,
+        data,
+        t0,
+        t1,
+        args,
+        kwargs,
+        response=response,
+        error_id=call.error_id,
+        exception_string=exception_string,
+    )
+
+
 def generate_crash_handler_decorator(error_decorator=None):
     """Return the crash_handler to pass to klue-client-server, with optional error decoration"""
 
@@ -227,6 +374,8 @@ def generate_crash_handler_decorator(error_decorator=None):
         """Return a decorator that reports failed api calls via the error_reporter,
         for use on every server endpoint"""
 
+        span_name = function_name(f)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
             """Generate a report of this api call, and if the call failed or was too slow,
@@ -234,6 +383,9 @@ def generate_crash_handler_decorator(error_decorator=None):
 
             data = {}
             t0 = timenow()
+            # Tag every log record of this call with the endpoint's name
+            stack.top.endpoint = span_name
+            span = get_tracer().start_server_span(span_name)
             exception_string = ''
 
             # Call endpoint and log execution time
@@ -252,11 +404,27 @@ def generate_crash_handler_decorator(error_decorator=None):
                 else:
                     # Otherwise, forge a Response
                     e = UnhandledServerError(exception_string)
-                    log.error("UNHANDLED EXCEPTION: %s" % '\n'.join(trace))
+                    log.error("UNHANDLED EXCEPTION: %s", '\n'.join(trace))
                     res = e.http_reply()
 
             t1 = timenow()
 
+            if hasattr(res, 'klue_stream'):
+                # A streamed response: time and report this call once the
+                # stream has been fully sent, without buffering it
+                def on_stream_end(call):
+                    status = call.error['status'] if call.error else 200
+                    if span:
+                        get_tracer().finish_span(span, status)
+                    t1 = timenow()
+                    capture_request(span_name, status, t0, t1)
+                    update_health(span_name, status, t0, t1)
+                    emit_call_metrics(span_name, status, t0, t1)
+                    populate_error_report(data)
+                    after_response(report_streamed_call, f, data, t0, t1, args, kwargs, call)
+                res.klue_stream.on_end = on_stream_end
+                return res
+
             # Is the response an Error instance?
             response_type = type(res).__name__
             status_code = 200
@@ -270,10 +438,22 @@ def generate_crash_handler_decorator(error_decorator=None):
             if isinstance(res, Response):
                 # Got a flask.Response object
                 res_data = None
+                j = None
+                is_json = True
 
                 status_code = str(res.status_code)
 
-                if str(status_code) == '200':
+                if hasattr(res, 'klue_error'):
+                    # Built by KlueMicroServiceException.http_reply(): this
+                    # error already has an error_id, no need to decode it
+                    j = res.klue_error
+                    error_id = res.klue_error_id
+
+                elif res.is_streamed:
+                    # Never buffer a streamed body
+                    pass
+
+                elif str(status_code) == '200':
 
                     # It could be any valid json response, but it could also be an Error model
                     # that klue-client-server handled as a status 200 because it does not know of
@@ -291,35 +471,36 @@ def generate_crash_handler_decorator(error_decorator=None):
                     if type(res_data) is bytes:
                         res_data = res_data.decode("utf-8")
 
-                    is_json = True
                     try:
-                        j = json.loads(res_data)
+                        j = serializer.loads(res_data)
                     except ValueError as e:
                         # This was a plain html response. Fake an error
                         is_json = False
                         j = {'error': res_data, 'status': status_code}
 
+                    # Patch Response to contain a unique id
+                    if is_json and 'error_id' not in j:
+                        # If the error is forwarded by multiple micro-services, we
+                        # want the error_id to be set only on the original error
+                        error_id = str(uuid.uuid4())
+                        j['error_id'] = error_id
+                        if not error_decorator:
+                            res.set_data(serializer.dumpb(j))
+
+                if j is not None:
+
                     # Make sure that the response gets the same status as the Klue Error it contained
                     status_code = j['status']
                     res.status_code = int(status_code)
 
-                    # Patch Response to contain a unique id
-                    if is_json:
-                        if 'error_id' not in j:
-                            # If the error is forwarded by multiple micro-services, we
-                            # want the error_id to be set only on the original error
-                            error_id = str(uuid.uuid4())
-                            j['error_id'] = error_id
-                            res.set_data(json.dumps(j))
-
-                        if error_decorator:
-                            # Apply error_decorator, if any defined
-                            res.set_data(json.dumps(error_decorator(j)))
+                    if is_json and error_decorator:
+                        # Apply error_decorator, if any defined
+                        res.set_data(serializer.dumpb(error_decorator(j)))
 
                     # And extract data from this error
                     error = j.get('error', 'NO_ERROR_IN_JSON')
                     error_description = j.get('error_description', res_data)
-                    if error_description == '':
+                    if error_description == '' and res_data:
                         error_description = res_data
 
                     if not exception_string:
@@ -328,27 +509,24 @@ def generate_crash_handler_decorator(error_decorator=None):
                     error_user_message = j.get('user_message', '')
                     is_an_error = 1
 
+            if span:
+                get_tracer().finish_span(span, status_code)
+            capture_request(span_name, status_code, t0, t1)
+            update_health(span_name, status_code, t0, t1)
+            emit_call_metrics(span_name, status_code, t0, t1)
 
-            request_args = []
-            if len(args):
-                request_args.append(args)
-            if kwargs:
-                request_args.append(kwargs)
-
-            data.update({
-                # Set only on the original error, not on forwarded ones, not on
-                # success responses
-                'error_id': error_id,
-
-                # Call results
-                'time': {
-                    'start': t0.isoformat(),
-                    'end': t1.isoformat(),
-                    'microsecs': (t1.timestamp() - t0.timestamp()) * 1000000,
-                },
-
-                # Response details
-                'response': {
+            # Complete and send the report once the response has been sent,
+            # after extracting what it needs from the request
+            populate_error_report(data)
+            after_response(
+                report_call,
+                f,
+                data,
+                t0,
+                t1,
+                args,
+                kwargs,
+                response={
                     'type': response_type,
                     'status': str(status_code),
                     'is_error': is_an_error,
@@ -356,46 +534,9 @@ def generate_crash_handler_decorator(error_decorator=None):
                     'error_description': error_description,
                     'user_message': error_user_message,
                 },
-
-                # Request details
-                'request': {
-                    'params': pformat(request_args),
-                },
-            })
-
-            populate_error_report(data)
-            log.info("Analytics: " + pformat(data))
-
-            # inspect may raise a UnicodeDecodeError...
-            fname = function_name(f)
-
-            #
-            # Should we report this call?
-            #
-
-            # If it is an internal errors, report it
-            if data['response']['status'] and int(data['response']['status']) >= 500:
-                report_error(
-                    title="%s(): %s" % (fname, exception_string),
-                    data=data,
-                    is_fatal=True
-                )
-            elif 'celery' in sys.argv[0].lower():
-                # This is an async task running in celery - Slow calls don't matter
-                pass
-            else:
-                # Looking this function's time-limit, else use default
-                global slow_calls
-                max_ms = get_config().report_call_exceeding_ms
-                if fname in slow_calls:
-                    max_ms = slow_calls[fname]
-                log.info("Checking if call to %s exceeds %s msec" % (fname, max_ms))
-                if int(data['time']['microsecs']) > max_ms * 1000:
-                    log.warn("SLOW CALL to %s: exceeded %s millisec"% (fname, max_ms))
-                    report_error(
-                        title='%s() calltime exceeded %s millisec!' % (fname, max_ms),
-                        data=data
-                    )
+                error_id=error_id,
+                exception_string=exception_string,
+            )
 
             return res
 
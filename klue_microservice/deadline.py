@@ -0,0 +1,135 @@
+import logging
+import time
+from functools import wraps
+from flask import request
+from klue_microservice.config import get_config
+from klue_microservice.crash import function_name
+from klue_microservice.exceptions import DeadlineExceededError
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Propagate a deadline across micro-service calls: a caller tells how many
+# milliseconds it is still willing to wait in the KlueCallTimeout header, and
+# outbound calls made while serving the request forward what is left of it
+#
+
+DEADLINE_HEADER = 'KlueCallTimeout'
+
+#
+# Customize the deadline per function
+#
+
+deadlines = {}
+
+class deadline(object):
+
+    def __init__(self, max_ms=None):
+        self.max_ms = max_ms
+
+    def __call__(self, f):
+        global deadlines
+        fname = function_name(f)
+        log.info("Setting custom deadline on function %s to %s msec", fname, self.max_ms)
+        if self.max_ms:
+            deadlines[fname] = self.max_ms
+
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            return f(*args, **kwargs)
+
+        return wrapped
+
+
+#
+# Access the current request's deadline
+#
+
+def get_deadline():
+    """Return the epoch (in sec) at which the current request's caller gives
+    up, or None if it has no deadline"""
+    if stack.top is None:
+        return None
+    return getattr(stack.top, 'deadline', None)
+
+
+def get_remaining_ms():
+    """Return how many milliseconds are left before the current request's
+    deadline, or None if it has no deadline"""
+    t = get_deadline()
+    if t is None:
+        return None
+    return (t - time.time()) * 1000
+
+
+def generate_deadline_decorator():
+    """Return a decorator that sets the request's deadline, from the caller's
+    KlueCallTimeout header and the endpoint's default, and rejects requests
+    whose deadline has already passed"""
+
+    default_ms = get_config().default_call_timeout_ms
+
+    def deadline_control(f):
+
+        fname = function_name(f)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+
+            # Use the shortest of the caller's timeout and the endpoint's
+            timeout_ms = deadlines.get(fname, default_ms)
+
+            header = request.headers.get(DEADLINE_HEADER, None)
+            if header:
+                try:
+                    caller_ms = float(header)
+                except ValueError:
+                    caller_ms = None
+                if caller_ms is not None:
+                    if caller_ms <= 0:
+                        return DeadlineExceededError("Caller's deadline has already passed").http_reply()
+                    if not timeout_ms or caller_ms < timeout_ms:
+                        timeout_ms = caller_ms
+
+            if timeout_ms:
+                stack.top.deadline = time.time() + timeout_ms / 1000.0
+
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    return deadline_control
+
+
+def deadline_client_decorator(api, name, f):
+    """Wrap a client caller so that it sends the remaining time budget to the
+    called server and caps its own timeouts to it"""
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        remaining_ms = get_remaining_ms()
+        if remaining_ms is None:
+            return f(*args, **kwargs)
+
+        if remaining_ms <= 0:
+            return api.error_callback(DeadlineExceededError("Deadline passed before calling api %s" % api.name))
+
+        # Copy the caller's headers, which it may reuse across calls
+        headers = dict(kwargs.get('request_headers') or {})
+        headers[DEADLINE_HEADER] = str(int(remaining_ms))
+        kwargs['request_headers'] = headers
+
+        remaining_sec = remaining_ms / 1000.0
+        for k in ('read_timeout', 'connect_timeout'):
+            kwargs[k] = min(kwargs.get(k, api.client_timeout), remaining_sec)
+
+        return f(*args, **kwargs)
+
+    return wrapper
@@ -1,16 +1,37 @@
 import logging
 import json
 import os
+import time
+import uuid
 import traceback
 from pprint import pformat
-from flask import jsonify, Response, request
+from flask import Response, request
+from werkzeug.http import HTTP_STATUS_CODES
 from klue.exceptions import ValidationError, KlueException
 from klue.swagger.apipool import ApiPool
+from klue_microservice.serializer import json_response, dumpb
 
 
 log = logging.getLogger(__name__)
 
 
+# Log at most one warning per error code per interval, in seconds
+WARNING_INTERVAL = 1
+
+# code -> [time of last warning, warnings skipped since]
+last_warnings = {}
+
+def warn_error(status, code, description):
+    now = time.time()
+    w = last_warnings.get(code)
+    if w and now - w[0] < WARNING_INTERVAL:
+        w[1] += 1
+        return
+    skipped = w[1] if w else 0
+    last_warnings[code] = [now, 0]
+    log.warn("ERROR: caught error %s %s [%s]%s", status, code, description, " (%s more since last warning)" % skipped if skipped else '')
+
+
 class KlueMicroServiceException(KlueException):
     code = 'UNKNOWN_EXCEPTION'
     status = 500
@@ -26,8 +47,8 @@ class KlueMicroServiceException(KlueException):
         self.error_caught = error
         return self
 
-    def http_reply(self):
-        """Return a Flask reply object describing this error"""
+    def to_dict(self):
+        """Return this error as a json-serializable dict"""
         data = {
             'status': self.status,
             'error': self.code.upper(),
@@ -43,11 +64,55 @@ class KlueMicroServiceException(KlueException):
         if self.user_message:
             data['user_message'] = self.user_message
 
-        r = jsonify(data)
-        r.status_code = self.status
+        return data
+
+    @classmethod
+    def get_reply_template(cls):
+        """Return the status line, headers and encoded start (up to the error
+        description) of this class's json replies, computed once per class"""
+        template = cls.__dict__.get('_reply_template')
+        if template is None:
+            status = '%d %s' % (cls.status, HTTP_STATUS_CODES.get(cls.status, 'UNKNOWN').upper())
+            headers = [('Content-Type', 'application/json')]
+            prefix = dumpb({'status': cls.status, 'error': cls.code.upper()})[:-1] + b',"error_description":'
+            template = (status, headers, prefix)
+            cls._reply_template = template
+        return template
+
+    def http_reply(self):
+        """Return a Flask reply object describing this error"""
+
+        # If the error is forwarded by multiple micro-services, we want the
+        # error_id to be set only on the original error
+        new_error_id = ''
+        if not self.error_id:
+            new_error_id = str(uuid.uuid4())
+
+        if self.error_caught or self.user_message:
+            data = self.to_dict()
+            data['error_id'] = self.error_id or new_error_id
+            r = json_response(data, status=self.status)
+        else:
+            # The common case: only splice the description and error_id into
+            # the class's precomputed reply
+            status, headers, prefix = self.get_reply_template()
+            description = str(self)
+            error_id = self.error_id or new_error_id
+            data = {
+                'status': self.status,
+                'error': self.code.upper(),
+                'error_description': description,
+                'error_id': error_id,
+            }
+            body = prefix + dumpb(description) + b',"error_id":' + dumpb(error_id) + b'}'
+            r = Response(body, status=status, headers=headers)
+
+        # Let the crash handler analyze this error without decoding the response
+        r.klue_error = data
+        r.klue_error_id = new_error_id
 
         if str(self.status) != "200":
-            log.warn("ERROR: caught error %s %s [%s]" % (self.status, self.code, str(self)))
+            warn_error(self.status, self.code, data['error_description'])
 
         return r
 
@@ -77,6 +142,7 @@ def add_error(name=None, code=None, status=None):
     if not name or not status or not code:
         raise Exception("Can't create Exception class %s: you must set both name, status and code" % name)
     myexception = type(name, (KlueMicroServiceException, ), {"code": code, "status": status})
+    myexception.get_reply_template()
     globals()[name] = myexception
     if code in code_to_class:
         raise Exception("ERROR! Exception %s is already defined." % code)
@@ -89,6 +155,10 @@ add_error('AuthMissingHeaderError', 'AUTHORIZATION_HEADER_MISSING', 401)
 add_error('AuthTokenExpiredError', 'TOKEN_EXPIRED', 401)
 add_error('AuthInvalidTokenError', 'TOKEN_INVALID', 401)
 add_error('ValidationError', 'INVALID_PARAMETER', 400)
+add_error('ServerOverloadedError', 'SERVER_OVERLOADED', 503)
+add_error('DeadlineExceededError', 'DEADLINE_EXCEEDED', 504)
+add_error('ProfilerBusyError', 'PROFILER_BUSY', 409)
+add_error('TaskQueueFullError', 'TASK_QUEUE_FULL', 503)
 
 #
 # Manipulate various error objects
@@ -14,14 +14,38 @@ sys.path.append('.')
 bind = '127.0.0.1:8080'
 backlog = 2048
 
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'gevent'
 timeout = 120
 keepalive = 2
 
-# With an average of 200 requests/hour, 2000 requests = 10 hours, 2800 = 14 hours
-max_requests = 2400
-max_requests_jitter = 800
+# Load klue-config.yaml from the project's root directory
+try:
+    from klue_microservice.config import get_config
+    conf = get_config(os.path.join(os.getcwd(), 'klue-config.yaml'))
+except Exception as e:
+    print("WARNING: failed to load klue-config.yaml (%s): using default gunicorn settings" % e)
+    conf = None
+
+if conf and conf.gunicorn_profile:
+    # Size workers after the container's resources and the service's profile
+    from klue_microservice.autotune import autotune
+    settings, reasons = autotune(conf)
+    for r in reasons:
+        print("gunicorn autotune: %s" % r)
+    workers = settings['workers']
+    worker_class = settings['worker_class']
+    worker_connections = settings['worker_connections']
+else:
+    workers = multiprocessing.cpu_count() * 2 + 1
+    worker_class = 'gevent'
+
+if conf and (conf.worker_max_rss_mb or conf.worker_max_rss_growth_percent):
+    # Workers are recycled when their memory grows too much (see post_request)
+    max_requests = 0
+    max_requests_jitter = 0
+else:
+    # With an average of 200 requests/hour, 2000 requests = 10 hours, 2800 = 14 hours
+    max_requests = 2400
+    max_requests_jitter = 800
 
 preload = True
 
@@ -32,16 +56,105 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 
 proc_name = None
 
+environment_probe = None
+
+def on_starting(server):
+    # Garbage collection in the master would touch pages shared with the
+    # workers: only collect explicitly, right before forking (see pre_fork)
+    import gc
+    gc.disable()
+
+    # Detect the environment while the master starts, so that workers inherit
+    # it instead of probing it during their first error report
+    global environment_probe
+    from klue_microservice.utils import start_environment_probe
+    environment_probe = start_environment_probe()
+
 def pre_fork(server, worker):
-    pass
+    global environment_probe
+    if environment_probe:
+        environment_probe.join(1)
+        environment_probe = None
+
+    # Freeze objects allocated by the master since the last fork
+    from klue_microservice.preload import freeze
+    freeze()
 
 def post_fork(server, worker):
+    import gc
+    gc.enable()
     server.log.info("Worker spawned (pid: %s)", worker.pid)
 
+recycler = None
+
+def post_worker_init(worker):
+    from klue_microservice.memory import get_memory_usage, format_memory_usage
+    usage = get_memory_usage()
+    if usage:
+        worker.log.info("Worker memory after init: %s", format_memory_usage(usage))
+
+    from klue_microservice.blocking import start_blocking_monitor
+    start_blocking_monitor()
+
+    # gunicorn resets SIGUSR2 in workers: profile on SIGUSR2 instead
+    from klue_microservice.profiler import install_profile_signal
+    install_profile_signal()
+
+    from klue_microservice.tasks import start_tasks
+    start_tasks()
+
+    global recycler
+    if conf:
+        from klue_microservice.recycle import MemoryRecycler
+        recycler = MemoryRecycler(conf)
+        if not recycler.is_enabled():
+            recycler = None
+
+requests_served = 0
+
+def post_request(worker, req, environ, resp):
+    global requests_served
+    requests_served += 1
+
+    if conf and conf.gunicorn_profile and requests_served == conf.worker_warmup_requests:
+        # Measure this worker once warm, to size workers at the next startup
+        from klue_microservice.autotune import record_worker_memory
+        record_worker_memory()
+
+    if recycler:
+        recycler.check(worker)
+
+def worker_exit(server, worker):
+    # Let queued background tasks complete
+    from klue_microservice.tasks import shutdown_tasks
+    shutdown_tasks()
+
+    # And send the metrics of its last calls
+    from klue_microservice.metrics import flush_metrics
+    flush_metrics()
+
 def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 
 def when_ready(server):
+    # Build all lazily initialized state in the master, to share it with workers
+    from klue_microservice.preload import preload
+    preload()
+
+    if conf and conf.gunicorn_profile:
+        # The workers' memory was not known when gunicorn read this config:
+        # unless it was measured at a previous startup, size workers after
+        # the master's, now that it has loaded the app
+        from klue_microservice.autotune import autotune
+        from klue_microservice.memory import get_memory_usage
+        usage = get_memory_usage()
+        if usage:
+            settings, reasons = autotune(conf, master_memory=usage['unique'])
+            if settings['workers'] != server.num_workers:
+                for r in reasons:
+                    server.log.info("gunicorn autotune: %s", r)
+                server.num_workers = settings['workers']
+
     server.log.info("Server is ready. Spawning workers")
 
 def worker_int(worker):
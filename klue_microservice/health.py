@@ -0,0 +1,149 @@
+import time
+import bisect
+import logging
+from klue_microservice.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Saturation counters behind /health: the crash handler and the admission
+# control update per-second slots of a sliding window on every call, and the
+# health endpoint only sums them up
+#
+
+# Calls that do not count toward health: load balancer and monitoring probes
+ignored_endpoints = set([
+    'klue_microservice.api.do_ping',
+    'klue_microservice.api.do_version',
+])
+
+# Upper bounds of the latency histogram's buckets, in msec
+bounds = [1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300, 500, 700, 1000, 1500, 2000, 3000, 5000, 10000]
+
+
+class CallWindow(object):
+    """Call counts, errors, latency histogram and max queueing delay of the
+    last 'seconds' seconds, one slot per second"""
+
+    def __init__(self, seconds):
+        self.seconds = max(1, seconds)
+        self.stamps = [0] * self.seconds
+        self.calls = [0] * self.seconds
+        self.errors = [0] * self.seconds
+        self.shed = [0] * self.seconds
+        self.queue_delays = [0] * self.seconds
+        self.histograms = [[0] * (len(bounds) + 1) for i in range(self.seconds)]
+
+    def get_slot(self):
+        now = int(time.time())
+        i = now % self.seconds
+        if self.stamps[i] != now:
+            # This slot last counted calls 'seconds' seconds ago or more
+            self.stamps[i] = now
+            self.calls[i] = 0
+            self.errors[i] = 0
+            self.shed[i] = 0
+            self.queue_delays[i] = 0
+            self.histograms[i] = [0] * (len(bounds) + 1)
+        return i
+
+    def record_call(self, status, ms):
+        i = self.get_slot()
+        self.calls[i] += 1
+        if status >= 500:
+            self.errors[i] += 1
+        self.histograms[i][bisect.bisect_left(bounds, ms)] += 1
+
+    def record_shed(self):
+        self.shed[self.get_slot()] += 1
+
+    def record_queue_delay(self, ms):
+        i = self.get_slot()
+        if ms > self.queue_delays[i]:
+            self.queue_delays[i] = ms
+
+    def get_stats(self):
+        oldest = int(time.time()) - self.seconds
+        calls, errors, shed, queue_delay = 0, 0, 0, 0
+        histogram = [0] * (len(bounds) + 1)
+        for i in range(self.seconds):
+            if self.stamps[i] <= oldest:
+                continue
+            calls += self.calls[i]
+            errors += self.errors[i]
+            shed += self.shed[i]
+            queue_delay = max(queue_delay, self.queue_delays[i])
+            for j, n in enumerate(self.histograms[i]):
+                histogram[j] += n
+
+        return {
+            'window_sec': self.seconds,
+            'calls': calls,
+            'errors': errors,
+            'shed': shed,
+            'error_percent': round(errors * 100.0 / calls, 2) if calls else 0,
+            'p95_ms': get_percentile(histogram, calls, 95),
+            'max_queue_delay_ms': round(queue_delay, 1),
+        }
+
+
+def get_percentile(histogram, count, p):
+    """Return the upper bound of the histogram bucket holding the p-th
+    percentile"""
+    if not count:
+        return 0
+    rank = count * p / 100.0
+    seen = 0
+    for j, n in enumerate(histogram):
+        seen += n
+        if seen >= rank:
+            return bounds[j] if j < len(bounds) else bounds[-1]
+    return bounds[-1]
+
+
+window = None
+
+def get_window():
+    global window
+    if not window:
+        window = CallWindow(get_config().health_window_sec)
+    return window
+
+
+def update_health(endpoint, status, t0, t1):
+    """Called by the crash handler after each call"""
+    if endpoint in ignored_endpoints:
+        return
+    get_window().record_call(int(status), (t1 - t0).total_seconds() * 1000)
+
+
+def record_shed():
+    get_window().record_shed()
+
+
+def record_queue_delay(ms):
+    get_window().record_queue_delay(ms)
+
+
+def get_health(inflight):
+    """Return this worker's health stats, and the thresholds they breach, if
+    any, as configured in klue-config.yaml"""
+    conf = get_config()
+    stats = get_window().get_stats()
+    stats['inflight'] = inflight
+
+    breaches = []
+    if conf.health_max_inflight and inflight > conf.health_max_inflight:
+        breaches.append("%s requests in flight (max %s)" % (inflight, conf.health_max_inflight))
+    if conf.health_max_queue_delay_ms and stats['max_queue_delay_ms'] > conf.health_max_queue_delay_ms:
+        breaches.append("requests queued for up to %s msec (max %s)" % (stats['max_queue_delay_ms'], conf.health_max_queue_delay_ms))
+    if stats['calls'] >= conf.health_min_calls:
+        if conf.health_max_error_percent and stats['error_percent'] > conf.health_max_error_percent:
+            breaches.append("%s%% of calls failed (max %s%%)" % (stats['error_percent'], conf.health_max_error_percent))
+        if conf.health_max_p95_ms and stats['p95_ms'] > conf.health_max_p95_ms:
+            breaches.append("p95 latency is %s msec (max %s)" % (stats['p95_ms'], conf.health_max_p95_ms))
+
+    stats['breaches'] = breaches
+    return stats
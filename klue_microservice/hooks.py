@@ -0,0 +1,58 @@
+import logging
+import traceback
+from flask import has_request_context
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Defer work the caller does not need to wait for (analytics, audit logs,
+# cache warming, error reports...) until its response has been sent:
+#
+# def do_signup_user():
+#     ...
+#     after_response(record_signup, user_id)
+#     return ApiPool.myapi.model.Ok()
+#
+
+def after_response(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) once the current request's response has been
+    fully sent, or right away if not serving a request. fn runs outside the
+    request's context: extract what it needs from the request beforehand"""
+    if not has_request_context():
+        run_hooks([(fn, args, kwargs)])
+        return
+    get_hooks().append((fn, args, kwargs))
+
+
+def get_hooks():
+    top = stack.top
+    if not hasattr(top, 'after_response_hooks'):
+        top.after_response_hooks = []
+    return top.after_response_hooks
+
+
+def run_hooks(hooks):
+    for fn, args, kwargs in hooks:
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            log.error("AFTER RESPONSE HOOK FAILED: %s", traceback.format_exc())
+
+
+def install_after_response(app):
+    """Have the app run the hooks registered by each request when the WSGI
+    server closes the response, which it does after sending it. Hooks added
+    while a response is streamed run once the stream has been sent"""
+
+    @app.after_request
+    def register_hooks(response):
+        hooks = get_hooks()
+        response.call_on_close(lambda: run_hooks(hooks))
+        return response
@@ -1,5 +1,17 @@
-import logging
+import os
 import sys
+import time
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from klue_microservice.serializer import dumps
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
 
 DEFAULT_LEVEL = logging.DEBUG
 
@@ -27,3 +39,212 @@ def get_logger():
 def set_level(newlevel):
     global root
     root.setLevel(newlevel)
+
+
+#
+# Tag every record with the call_id and endpoint of the request that logged
+# it, by copying two attributes: no formatting happens in the request
+#
+
+class ContextFilter(logging.Filter):
+
+    def filter(self, record):
+        if not hasattr(record, 'call_id'):
+            top = stack.top
+            record.call_id = getattr(top, 'call_id', '') if top else ''
+            record.endpoint = getattr(top, 'endpoint', '') if top else ''
+        return True
+
+context_filter = ContextFilter()
+ch.addFilter(context_filter)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one json object per line"""
+
+    def format(self, record):
+        d = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+            'call_id': getattr(record, 'call_id', ''),
+            'endpoint': getattr(record, 'endpoint', ''),
+        }
+        if record.exc_info:
+            d['exception'] = self.formatException(record.exc_info)
+        return dumps(d)
+
+
+def set_format(log_format):
+    """Write records as plain text ('text') or json lines ('json')"""
+    if log_format == 'json':
+        ch.setFormatter(JsonFormatter())
+    else:
+        ch.setFormatter(formatter)
+
+
+#
+# Asynchronous logging: request threads only enqueue records, and a listener
+# thread formats and writes them
+#
+
+class DeferredQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        # Interpolate the message's args now, since they may be mutated or
+        # freed by the time the listener's thread gets to the record. The
+        # record stays in this process though: unlike QueueHandler, leave the
+        # formatting (and that of its exc_info) and the io to the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+queue_handler = None
+listener = None
+
+
+def start_listener():
+    global listener
+    queue_handler.queue = queue.Queue(-1)
+    listener = QueueListener(queue_handler.queue, ch, respect_handler_level=True)
+    listener.start()
+
+
+def stop_listener():
+    """Write all pending records and stop the listener thread"""
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+
+def restart_listener_in_child():
+    # The listener thread did not survive the fork, and records queued in the
+    # parent are the parent's to write: start afresh
+    if queue_handler:
+        start_listener()
+
+
+def enable_async_logging():
+    """Replace the stdout handler on the root logger with a queue, emptied by a
+    background thread. Forked children (gunicorn workers) get their own queue
+    and thread"""
+    global queue_handler
+    if queue_handler:
+        return
+
+    queue_handler = DeferredQueueHandler(queue.Queue(-1))
+    queue_handler.addFilter(context_filter)
+    root.addHandler(queue_handler)
+    root.removeHandler(ch)
+    start_listener()
+
+    atexit.register(stop_listener)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=restart_listener_in_child)
+
+
+#
+# Log policy: per-logger levels, and per-logger sampling and rate limits of
+# records below WARNING. Records are matched by logger and message template
+# (the record's msg before interpolation), so log with
+# log.info("Doing %s", x) rather than log.info("Doing %s" % x).
+#
+
+class LogPolicy(logging.Filter):
+
+    # Forget all counters when tracking more templates than this
+    MAX_TEMPLATES = 10000
+
+    def __init__(self, sampling=None, rate_limits=None):
+        self.sampling = sampling or {}
+        self.rate_limits = rate_limits or {}
+        # logger name -> (1-in-N sampling, max records per second per template)
+        self.rules = {}
+        # (logger name, template) -> [count, window start, count in window]
+        self.counters = {}
+        self.dropped = 0
+
+    def get_rule(self, name):
+        """Return the sampling and rate limit of the logger name, or of its
+        closest parent that has some"""
+        rule = self.rules.get(name)
+        if rule is None:
+            sample, rate = 1, 0
+            n = name
+            while True:
+                if n in self.sampling or n in self.rate_limits:
+                    sample = self.sampling.get(n, 1)
+                    rate = self.rate_limits.get(n, 0)
+                    break
+                if not n:
+                    break
+                n = n.rpartition('.')[0]
+            rule = self.rules[name] = (max(1, sample), rate)
+        return rule
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        sample, rate = self.get_rule(record.name)
+        if sample == 1 and not rate:
+            return True
+
+        key = (record.name, record.msg)
+        c = self.counters.get(key)
+        if c is None:
+            if len(self.counters) >= self.MAX_TEMPLATES:
+                self.counters.clear()
+            c = self.counters[key] = [0, record.created, 0]
+
+        c[0] += 1
+        if (c[0] - 1) % sample:
+            self.dropped += 1
+            return False
+
+        if rate:
+            if record.created - c[1] >= 1:
+                c[1] = record.created
+                c[2] = 0
+            c[2] += 1
+            if c[2] > rate:
+                self.dropped += 1
+                return False
+
+        return True
+
+policy = None
+
+
+def get_dropped_count():
+    """Return how many records the log policy dropped in this process"""
+    return policy.dropped if policy else 0
+
+
+def set_log_policy(levels=None, sampling=None, rate_limits=None):
+    """Set per-logger levels (logger name -> level name, '' for the root
+    logger), 1-in-N sampling (logger name -> N) and rate limits (logger name
+    -> max records per second per message template)"""
+    global policy
+
+    for name, level in (levels or {}).items():
+        logging.getLogger(name or None).setLevel(level.upper() if isinstance(level, str) else level)
+
+    handler = queue_handler or ch
+    if policy:
+        handler.removeFilter(policy)
+        policy = None
+    if sampling or rate_limits:
+        policy = LogPolicy(sampling, rate_limits)
+        handler.addFilter(policy)
+
+
+def configure_logging(conf):
+    """Apply the logging settings in klue-config.yaml"""
+    set_format(conf.log_format)
+    if conf.log_async:
+        enable_async_logging()
+    set_log_policy(conf.log_levels, conf.log_sampling, conf.log_rate_limits)
@@ -0,0 +1,129 @@
+import os
+import sys
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Measure how much memory a process uses on its own (unique) versus shares
+# with its parent (copy-on-write pages inherited from the gunicorn master)
+#
+
+# Where processes' memory maps and stats are read from
+PROC_DIR = '/proc'
+
+
+def get_memory_usage(pid=None):
+    """Return a dict with the rss, pss, unique and shared memory of process pid
+    (default: the current process), in bytes, or None if it cannot be read.
+    Relies on /proc, ie only works on linux"""
+
+    if not pid:
+        pid = os.getpid()
+
+    usage = {'pid': pid, 'rss': 0, 'pss': 0, 'unique': 0, 'shared': 0}
+
+    fields = {
+        'Rss:': ('rss',),
+        'Pss:': ('pss',),
+        'Private_Clean:': ('unique',),
+        'Private_Dirty:': ('unique',),
+        'Shared_Clean:': ('shared',),
+        'Shared_Dirty:': ('shared',),
+    }
+
+    try:
+        # smaps_rollup sums up smaps in one go (linux >= 4.14)
+        with open(os.path.join(PROC_DIR, str(pid), 'smaps_rollup')) as f:
+            for l in f:
+                parts = l.split()
+                if parts and parts[0] in fields:
+                    for k in fields[parts[0]]:
+                        usage[k] += int(parts[1]) * 1024
+        return usage
+    except (IOError, OSError):
+        pass
+
+    # Fall back to statm, which only tells rss and shared pages
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'statm')) as f:
+            _, rss, shared = f.read().split()[0:3]
+        page = os.sysconf('SC_PAGE_SIZE')
+        usage['rss'] = int(rss) * page
+        usage['shared'] = int(shared) * page
+        usage['unique'] = usage['rss'] - usage['shared']
+        usage['pss'] = None
+        return usage
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def get_rss(pid=None):
+    """Return the resident memory of process pid in bytes, cheaply (from
+    /proc/<pid>/statm), or None if it cannot be read"""
+    if not pid:
+        pid = 'self'
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'statm')) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def get_children(pid):
+    """Return the pids of the children of process pid"""
+    children = []
+    for name in os.listdir(PROC_DIR):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC_DIR, name, 'stat')) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # The command name may contain spaces: parse after its closing parenthesis
+        ppid = stat[stat.rindex(')') + 2:].split()[1]
+        if int(ppid) == int(pid):
+            children.append(int(name))
+    return sorted(children)
+
+
+def format_memory_usage(usage):
+    mb = 1024 * 1024.0
+    pss = '%.1f' % (usage['pss'] / mb) if usage['pss'] is not None else '?'
+    return "pid %s: rss %.1fMB, pss %sMB, unique %.1fMB, shared %.1fMB" % (
+        usage['pid'],
+        usage['rss'] / mb,
+        pss,
+        usage['unique'] / mb,
+        usage['shared'] / mb,
+    )
+
+
+def memory_report(master_pid):
+    """Return a human readable report of the memory used by a gunicorn master
+    and each of its workers"""
+
+    lines = []
+    total_unique = 0
+    for pid in [int(master_pid)] + get_children(master_pid):
+        usage = get_memory_usage(pid)
+        if not usage:
+            continue
+        label = 'master' if pid == int(master_pid) else 'worker'
+        lines.append("%s %s" % (label, format_memory_usage(usage)))
+        if label == 'worker':
+            total_unique += usage['unique']
+
+    lines.append("total unique memory of workers: %.1fMB" % (total_unique / (1024 * 1024.0)))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    # Usage: python -m klue_microservice.memory <gunicorn-master-pid>
+    if len(sys.argv) != 2:
+        print("USAGE: python -m klue_microservice.memory <gunicorn-master-pid>")
+        sys.exit(1)
+    print(memory_report(sys.argv[1]))
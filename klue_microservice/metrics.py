@@ -0,0 +1,169 @@
+import os
+import time
+import random
+import socket
+import logging
+import threading
+from klue_microservice.config import get_config
+from klue_microservice.blocking import get_blocking_stats
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Push call metrics to a StatsD (or DogStatsD) agent: the crash handler
+# counts every call in memory, per endpoint and status, and a background
+# thread flushes the aggregates as batched UDP packets every few seconds
+#
+
+class CallStats(object):
+
+    __slots__ = ['count', 'samples']
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []
+
+
+class MetricsEmitter(object):
+
+    def __init__(self, conf):
+        self.pid = os.getpid()
+        self.address = (conf.statsd_host, conf.statsd_port)
+        self.prefix = conf.statsd_prefix
+        self.interval = conf.statsd_flush_interval_sec
+        self.max_samples = conf.statsd_max_timer_samples
+        self.max_packet_bytes = conf.statsd_max_packet_bytes
+        self.use_tags = conf.statsd_dogstatsd
+        self.tags = ['%s:%s' % (k, v) for k, v in sorted(conf.statsd_tags.items())]
+
+        # endpoint -> status -> CallStats, swapped for an empty dict at each
+        # flush. The lock keeps calls recorded during the swap from being lost
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.dropped_packets = 0
+        self.last_blocked = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        threading.Thread(target=self.run, name='klue-metrics', daemon=True).start()
+
+    def record(self, endpoint, status, ms):
+        with self.lock:
+            statuses = self.stats.get(endpoint)
+            if statuses is None:
+                statuses = self.stats[endpoint] = {}
+            s = statuses.get(status)
+            if s is None:
+                s = statuses[status] = CallStats()
+            s.count += 1
+
+            # Keep a uniform sample of at most max_samples latencies
+            # (reservoir sampling), sent with their sample rate
+            if len(s.samples) < self.max_samples:
+                s.samples.append(ms)
+            else:
+                i = random.randrange(s.count)
+                if i < self.max_samples:
+                    s.samples[i] = ms
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                log.warn("Failed to flush metrics: %s", e)
+
+    def format(self, name, value, kind, tags, rate=None):
+        if self.use_tags:
+            line = '%s.%s:%s|%s' % (self.prefix, name, value, kind)
+            if rate:
+                line += '|@%s' % rate
+            if tags:
+                line += '|#' + ','.join(tags)
+            return line
+
+        # Plain StatsD: no tags, put them in the metric's name
+        name = '.'.join([self.prefix, name] + [t.split(':', 1)[1].replace('.', '_') for t in tags])
+        line = '%s:%s|%s' % (name, value, kind)
+        if rate:
+            line += '|@%s' % rate
+        return line
+
+    def get_lines(self, stats):
+        lines = []
+        for endpoint, statuses in stats.items():
+            for status, s in statuses.items():
+                tags = ['endpoint:%s' % endpoint, 'status:%s' % status] + self.tags
+                lines.append(self.format('calls', s.count, 'c', tags))
+                rate = round(len(s.samples) / float(s.count), 4) if len(s.samples) < s.count else None
+                for ms in s.samples:
+                    lines.append(self.format('latency', round(ms, 3), 'ms', tags, rate=rate))
+        return lines
+
+    def get_hub_lines(self):
+        """Return the times the gevent hub was blocked since the last flush,
+        and the longest block, if any (see blocking.py)"""
+        b = get_blocking_stats()
+        if not b['blocked']:
+            return []
+        blocked, self.last_blocked = b['blocked'] - self.last_blocked, b['blocked']
+        return [
+            self.format('hub.blocked', blocked, 'c', self.tags),
+            self.format('hub.max_blocked_ms', b['max_blocked_ms'], 'g', self.tags),
+        ]
+
+    def flush(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        packet = []
+        size = 0
+        for line in self.get_lines(stats) + self.get_hub_lines():
+            if packet and size + len(line) + 1 > self.max_packet_bytes:
+                self.send('\n'.join(packet))
+                packet, size = [], 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self.send('\n'.join(packet))
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data.encode('utf-8'), self.address)
+        except (BlockingIOError, OSError) as e:
+            # Never wait for, or fail because of, the agent
+            self.dropped_packets += 1
+            if self.dropped_packets % 100 == 1:
+                log.warn("Dropped metrics packet (%s dropped so far): %s", self.dropped_packets, e)
+
+
+emitter = None
+is_enabled = None
+
+def get_emitter():
+    """Return this process's emitter, started on first use after fork, or
+    None if 'statsd_host' is not set in klue-config.yaml"""
+    global emitter, is_enabled
+    if is_enabled is None:
+        is_enabled = bool(get_config().statsd_host)
+    if not is_enabled:
+        return None
+    if not emitter or emitter.pid != os.getpid():
+        emitter = MetricsEmitter(get_config())
+    return emitter
+
+
+def emit_call_metrics(endpoint, status, t0, t1):
+    """Called by the crash handler after each call"""
+    e = get_emitter()
+    if e:
+        e.record(endpoint, int(status), (t1 - t0).total_seconds() * 1000)
+
+
+def flush_metrics():
+    """Called when a gunicorn worker exits"""
+    if emitter and emitter.pid == os.getpid():
+        emitter.flush()
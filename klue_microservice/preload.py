@@ -0,0 +1,58 @@
+import gc
+import uuid
+import logging
+from pprint import pformat
+from klue_microservice.config import get_config
+from klue_microservice.utils import timenow, to_epoch
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Build in the gunicorn master all the state that each worker would
+# otherwise build lazily, so that workers share it as copy-on-write memory,
+# then freeze the garbage collector so that it does not dirty shared pages
+#
+
+is_preloaded = False
+
+def preload():
+    """Eagerly initialize klue-microservice's lazy state. Called by the gunicorn
+    config in the master, before forking workers. The swagger specs are
+    already loaded and compiled in the master, by API.start() when the app is
+    preloaded"""
+
+    global is_preloaded
+    if is_preloaded:
+        return
+    is_preloaded = True
+
+    # Config and the singletons built from it
+    conf = get_config()
+
+    # Importing those modules defines all exception classes and decorators
+    from klue_microservice import exceptions, auth, crash, stream, admission, deadline, client
+    from klue_microservice.tracing import get_tracer
+    get_tracer()
+
+    # Load timezone data, uuid's entropy source and pprint's machinery
+    to_epoch(timenow())
+    uuid.uuid4()
+    pformat({'a': [1]})
+
+    # Exercise the JWT code path (algorithms, crypto backends)
+    if conf.jwt_secret and conf.jwt_issuer and conf.jwt_audience:
+        token = auth.generate_token('preload', expire_in=60)
+        auth.load_auth_token(token, load=False)
+
+    log.info("Preloaded klue-microservice's state")
+
+
+def freeze():
+    """Collect garbage once, then move all objects to the permanent generation
+    so that the garbage collector never touches (and dirties) them in workers"""
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+        log.info("Froze %s objects before forking", gc.get_freeze_count())
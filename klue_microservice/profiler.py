@@ -0,0 +1,169 @@
+import os
+import sys
+import gc
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from klue_microservice.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# A statistical profiler that samples the stacks of a live worker for a few
+# seconds, without stopping it, and returns them as collapsed stacks ready to
+# be rendered as a flamegraph (https://github.com/brendangregg/FlameGraph)
+#
+
+# When running under gevent, the sampler must run in a real thread and sleep
+# without yielding to the hub it is observing. get_original() returns the
+# unpatched functions whether gevent has patched them yet or not
+try:
+    from gevent.monkey import get_original, is_module_patched
+    start_new_thread = get_original('_thread', 'start_new_thread')
+    allocate_lock = get_original('_thread', 'allocate_lock')
+    real_sleep = get_original('time', 'sleep')
+    real_get_ident = get_original('_thread', 'get_ident')
+except ImportError:
+    import _thread
+    is_module_patched = None
+    start_new_thread = _thread.start_new_thread
+    allocate_lock = _thread.allocate_lock
+    real_sleep = time.sleep
+    real_get_ident = _thread.get_ident
+
+
+def is_gevent():
+    """Return True if gevent has patched threading. Checked when profiling,
+    since gunicorn's gevent workers patch it after the app was preloaded"""
+    return bool(is_module_patched and is_module_patched('threading'))
+
+
+def collapse(frame):
+    """Return the stack ending at frame in collapsed format: root first,
+    frames separated by ';'"""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s:%s:%s" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    frames.reverse()
+    return ';'.join(frames)
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, seconds, interval_ms=5, include_greenlets=True):
+        self.seconds = seconds
+        self.interval = interval_ms / 1000.0
+        self.include_greenlets = include_greenlets and is_gevent()
+        self.stacks = Counter()
+        self.samples = 0
+        self.is_done = False
+        self.greenlets = []
+
+    def find_greenlets(self):
+        """Return all live greenlets (expensive: refreshed once per second)"""
+        from greenlet import greenlet
+        return [o for o in gc.get_objects() if isinstance(o, greenlet) and o.gr_frame is not None]
+
+    def sample(self, own_ident, names):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            # The main thread's frame is that of the greenlet currently running
+            self.stacks["%s;%s" % (names.get(ident, 'thread-%s' % ident), collapse(frame))] += 1
+
+        if self.include_greenlets:
+            # And greenlets that are waiting (on io, a lock, a sleep...)
+            for g in self.greenlets:
+                frame = g.gr_frame
+                if frame is not None:
+                    self.stacks["waiting-greenlet;%s" % collapse(frame)] += 1
+
+        self.samples += 1
+
+    def run(self):
+        """Sample all stacks every interval_ms, for the given number of seconds"""
+        own_ident = real_get_ident()
+        names = dict([(t.ident, t.name) for t in threading.enumerate()])
+        samples_per_sec = int(1 / self.interval)
+        try:
+            for i in range(int(self.seconds / self.interval)):
+                if self.include_greenlets and i % samples_per_sec == 0:
+                    self.greenlets = self.find_greenlets()
+                self.sample(own_ident, names)
+                real_sleep(self.interval)
+        finally:
+            self.greenlets = []
+            self.is_done = True
+
+    def start(self, then=None):
+        """Run the profiler in a real background thread, then call then(self)
+        if given"""
+        def run():
+            self.run()
+            if then:
+                then(self)
+        start_new_thread(run, ())
+        return self
+
+    def get_collapsed_stacks(self):
+        return '\n'.join(["%s %s" % (stack, count) for stack, count in self.stacks.most_common()])
+
+
+current_profiler = None
+
+# Held while checking for and starting a profiling, so that a request and a
+# signal (whose handler may interrupt the request) never start two at once
+profiler_lock = allocate_lock()
+
+def is_profiling():
+    return current_profiler is not None and not current_profiler.is_done
+
+
+def start_profiler(seconds, then=None, **kwargs):
+    """Start profiling this worker in the background for the given number of
+    seconds, and return the profiler, or None if a profiling is already
+    running. then(profiler) is called from the profiler's thread when done"""
+    global current_profiler
+    if not profiler_lock.acquire(False):
+        return None
+    try:
+        if is_profiling():
+            return None
+        log.info("Profiling worker %s for %s sec", os.getpid(), seconds)
+        current_profiler = SamplingProfiler(seconds, **kwargs).start(then)
+        return current_profiler
+    finally:
+        profiler_lock.release()
+
+
+#
+# Profile on signal: 'kill -USR2 <worker-pid>' writes collapsed stacks to
+# /tmp/klue-profile-<pid>-<epoch>.folded
+#
+
+PROFILE_FILE = '/tmp/klue-profile-%s-%d.folded'
+
+def write_profile(p):
+    path = PROFILE_FILE % (os.getpid(), time.time())
+    with open(path, 'w') as f:
+        f.write(p.get_collapsed_stacks())
+        f.write('\n')
+    log.info("Wrote profile of worker %s (%s samples) to %s", os.getpid(), p.samples, path)
+
+
+def handle_profile_signal(signum, frame):
+    # Must return immediately: profile in a real background thread. Signals
+    # received while a profiling is running are ignored
+    start_profiler(get_config().profile_signal_seconds, then=write_profile)
+
+
+def install_profile_signal(signum=signal.SIGUSR2):
+    """Profile this worker when it receives signum. Call it in each worker,
+    after gunicorn has set up its signal handlers"""
+    signal.signal(signum, handle_profile_signal)
@@ -0,0 +1,114 @@
+import os
+import time
+import fcntl
+import random
+import logging
+from klue_microservice.memory import get_rss
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Recycle gunicorn workers whose memory grows too much, instead of after a
+# fixed number of requests, and never restart them all at once
+#
+
+MB = 1024 * 1024
+
+
+class MemoryRecycler(object):
+
+    def __init__(self, conf):
+        self.max_rss = conf.worker_max_rss_mb * MB if conf.worker_max_rss_mb else 0
+        self.max_growth_percent = conf.worker_max_rss_growth_percent
+        self.warmup_requests = conf.worker_warmup_requests
+        self.check_every = max(1, conf.worker_rss_check_every)
+        self.min_interval = conf.worker_recycle_min_interval_sec
+
+        # Spread checks and thresholds across workers, so that workers that
+        # grow alike do not all cross them at the same time
+        self.requests = random.randint(0, self.check_every - 1)
+        self.jitter = 1 + random.uniform(0, 0.05)
+
+        self.baseline = None
+        self.is_recycling = False
+
+        # All workers of the same master share one lock file
+        self.lock_path = os.path.join('/tmp', 'klue-recycle-%s.lock' % os.getppid())
+
+    def is_enabled(self):
+        return bool(self.max_rss or self.max_growth_percent)
+
+    def get_limit(self):
+        """Return the rss above which this worker should be recycled"""
+        limits = []
+        if self.max_rss:
+            limits.append(self.max_rss * self.jitter)
+        if self.max_growth_percent and self.baseline:
+            limits.append(self.baseline * (1 + self.max_growth_percent / 100.0) * self.jitter)
+        return min(limits) if limits else None
+
+    def check(self, worker):
+        """Called after each request: every 'worker_rss_check_every' requests,
+        compare the worker's rss to its limits and gracefully restart it if it
+        exceeds them"""
+
+        if self.is_recycling:
+            return
+
+        self.requests += 1
+        if self.requests % self.check_every:
+            return
+
+        rss = get_rss()
+        if rss is None:
+            return
+
+        if self.baseline is None:
+            if self.requests >= self.warmup_requests:
+                self.baseline = rss
+                log.info("Worker %s has a post-warmup rss of %.1fMB", os.getpid(), rss / MB)
+            return
+
+        limit = self.get_limit()
+        if not limit or rss <= limit:
+            return
+
+        if not self.acquire_recycle_slot():
+            log.info("Worker %s exceeds its rss limit (%.1fMB > %.1fMB) but an other worker was just recycled: waiting", os.getpid(), rss / MB, limit / MB)
+            return
+
+        log.warn("Recycling worker %s: rss %.1fMB exceeds %.1fMB (baseline: %.1fMB, %s requests served)",
+            os.getpid(),
+            rss / MB,
+            limit / MB,
+            (self.baseline or 0) / MB,
+            self.requests,
+        )
+        self.is_recycling = True
+        worker.alive = False
+
+    def acquire_recycle_slot(self):
+        """Return True if no other worker of this master was recycled during
+        the last 'worker_recycle_min_interval_sec' seconds, and record that
+        this one is"""
+        try:
+            with open(self.lock_path, 'a+') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # An other worker is deciding right now
+                    return False
+                f.seek(0)
+                s = f.read().strip()
+                now = time.time()
+                if s and now - float(s) < self.min_interval:
+                    return False
+                f.seek(0)
+                f.truncate()
+                f.write(str(now))
+                return True
+        except (IOError, OSError, ValueError) as e:
+            log.warn("Failed to coordinate worker recycling via %s: %s", self.lock_path, e)
+            return True
@@ -0,0 +1,115 @@
+import json
+import logging
+from flask import Response
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Pick the fastest json library available (orjson, then ujson), and fall back
+# to the standard library
+#
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _orjson_dumpb(o, pretty=False):
+    b = orjson.dumps(o, option=orjson.OPT_NON_STR_KEYS)
+    if pretty:
+        # orjson only indents by 2: re-indent by 4 like the other libraries.
+        # Pretty json is only used by reports, so the extra pass is cheap
+        return _json_dumpb(orjson.loads(b), pretty=True)
+    return b
+
+def _ujson_dumpb(o, pretty=False):
+    if pretty:
+        s = ujson.dumps(o, indent=4, sort_keys=True, escape_forward_slashes=False)
+    else:
+        s = ujson.dumps(o, escape_forward_slashes=False)
+    return s.encode('utf-8')
+
+def _json_dumpb(o, pretty=False):
+    if pretty:
+        s = json.dumps(o, indent=4, sort_keys=True)
+    else:
+        s = json.dumps(o, separators=(',', ':'))
+    return s.encode('utf-8')
+
+
+serializers = {
+    'json': (_json_dumpb, json.loads),
+}
+
+if ujson:
+    serializers['ujson'] = (_ujson_dumpb, ujson.loads)
+
+if orjson:
+    serializers['orjson'] = (_orjson_dumpb, orjson.loads)
+
+
+serializer_name = None
+_dumpb = None
+_loads = None
+
+def set_serializer(name=None):
+    """Select the json library used to encode responses, errors and reports
+    ('orjson', 'ujson' or 'json'). By default, pick the fastest available"""
+
+    global serializer_name, _dumpb, _loads
+
+    if not name:
+        for name in ('orjson', 'ujson', 'json'):
+            if name in serializers:
+                break
+
+    if name not in serializers:
+        raise Exception("Json serializer %s is not available (choose one of %s)" % (name, ', '.join(serializers.keys())))
+
+    log.debug("Using %s to serialize json", name)
+    serializer_name = name
+    _dumpb, _loads = serializers[name]
+
+set_serializer()
+
+
+def get_serializer():
+    """Return the name of the json library in use"""
+    return serializer_name
+
+
+#
+# Encode/decode json
+#
+
+def dumpb(o, pretty=False):
+    """Serialize o to json, as utf-8 encoded bytes"""
+    try:
+        return _dumpb(o, pretty=pretty)
+    except (TypeError, OverflowError):
+        # Let the standard library handle what the fast serializers reject
+        # (very large ints, etc.), and raise the usual error otherwise
+        return _json_dumpb(o, pretty=pretty)
+
+def dumps(o, pretty=False):
+    """Serialize o to a json string"""
+    return dumpb(o, pretty=pretty).decode('utf-8')
+
+def loads(s):
+    """Deserialize a json string or bytes"""
+    return _loads(s)
+
+
+def json_response(data, status=200):
+    """Return a Flask Response with data encoded as json in its body"""
+    r = Response(dumpb(data), mimetype='application/json')
+    r.status_code = status
+    return r
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import logging
+import click
+from klue_microservice.memory import get_memory_usage, get_children
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Soak testing: record the latency of every call made by the acceptance
+# tests and the server's memory after each iteration of
+# 'run_acceptance_tests --loop', and fail when either drifts too far from
+# the first iterations
+#
+
+MB = 1024 * 1024
+
+
+def record_latency(method, url, status, ms):
+    """Append one call's latency to the file named by KLUE_LATENCY_LOG, if
+    set. Called by KlueMicroServiceTestCase for every call"""
+    path = os.environ.get('KLUE_LATENCY_LOG')
+    if not path:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps({'method': method, 'url': url, 'status': status, 'ms': round(ms, 3)}))
+        f.write('\n')
+
+
+def read_latencies(path):
+    latencies = []
+    try:
+        with open(path) as f:
+            for l in f:
+                latencies.append(json.loads(l)['ms'])
+    except (IOError, OSError):
+        pass
+    return sorted(latencies)
+
+
+def percentile(latencies, p):
+    if not latencies:
+        return 0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+
+def find_listening_pid(port):
+    """Return the pid of the local process listening on tcp port, or None"""
+    inodes = set()
+    for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(path) as f:
+                next(f)
+                for l in f:
+                    fields = l.split()
+                    # State 0A is LISTEN
+                    if fields[3] == '0A' and int(fields[1].split(':')[1], 16) == int(port):
+                        inodes.add('socket:[%s]' % fields[9])
+        except (IOError, OSError):
+            continue
+
+    if not inodes:
+        return None
+
+    # The master is the listener with the lowest pid
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            for fd in os.listdir('/proc/%s/fd' % name):
+                if os.readlink('/proc/%s/fd/%s' % (name, fd)) in inodes:
+                    pids.append(int(name))
+                    break
+        except (IOError, OSError):
+            continue
+    return min(pids) if pids else None
+
+
+def get_server_memory(pid):
+    """Return the memory used by process pid and its children (gunicorn
+    workers), counting shared pages once when possible"""
+    total = 0
+    for p in [pid] + get_children(pid):
+        usage = get_memory_usage(p)
+        if usage:
+            total += usage.get('pss') or usage['rss']
+    return total or None
+
+
+def drift(series, key, warmup):
+    """Return how much the median of the last 3 values of key has drifted
+    from the median of the first warmup values, in percent, or None"""
+    values = [s[key] for s in series if s.get(key)]
+    if len(values) < warmup + 1:
+        return None
+    base = sorted(values[:warmup])[warmup // 2]
+    last = sorted(values[-3:])[len(values[-3:]) // 2]
+    return (last - base) * 100.0 / base if base else None
+
+
+def format_report(series):
+    lines = ["%-9s %-20s %7s %9s %9s %9s %10s" % ('iteration', 'time', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'memory MB')]
+    for s in series:
+        lines.append("%-9s %-20s %7s %9.2f %9.2f %9.2f %10s" % (
+            s['iteration'],
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s['time'])),
+            s['calls'],
+            s['p50_ms'],
+            s['p95_ms'],
+            s['p99_ms'],
+            '%.1f' % (s['memory'] / MB) if s.get('memory') else '-',
+        ))
+    return lines
+
+
+@click.command()
+@click.option('--dir', 'soak_dir', help="Directory holding the latency logs and time series", required=True)
+@click.option('--iteration', help="Number of the iteration that just ended", required=True, type=int)
+@click.option('--port', help="Port of the server, to find its process if local", default=None)
+@click.option('--pid', help="Pid of the server's master process, if local", default=None, type=int)
+@click.option('--warmup', help="Iterations making up the baseline (default: 3)", default=3)
+@click.option('--max-p95-drift', help="Fail if p95 latency drifts by more than this percent", default=None, type=float)
+@click.option('--max-memory-drift', help="Fail if the server's memory drifts by more than this percent", default=None, type=float)
+def main(soak_dir, iteration, port, pid, warmup, max_p95_drift, max_memory_drift):
+    """Record the latencies and server memory of one iteration of
+    'run_acceptance_tests --loop', and check them for drift"""
+
+    latencies = read_latencies(os.path.join(soak_dir, 'latency-%s.jsonl' % iteration))
+    sample = {
+        'iteration': iteration,
+        'time': time.time(),
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+    if not pid and port:
+        pid = find_listening_pid(port)
+    if pid:
+        sample['memory'] = get_server_memory(pid)
+
+    path_series = os.path.join(soak_dir, 'timeseries.json')
+    series = []
+    if os.path.isfile(path_series):
+        with open(path_series) as f:
+            series = json.loads(f.read())
+    series.append(sample)
+    with open(path_series, 'w') as f:
+        f.write(json.dumps(series, indent=4))
+
+    report = format_report(series)
+    with open(os.path.join(soak_dir, 'report.txt'), 'w') as f:
+        f.write('\n'.join(report))
+        f.write('\n')
+    print(report[0])
+    print(report[-1])
+
+    failed = False
+    for key, max_drift in (('p95_ms', max_p95_drift), ('memory', max_memory_drift)):
+        d = drift(series, key, warmup)
+        if d is None:
+            continue
+        print("=> %s drifted by %+.1f%% since the first %s iterations" % (key, d, warmup))
+        if max_drift is not None and d > max_drift:
+            print("ERROR: %s drifted by more than %s%%" % (key, max_drift))
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import logging
+import sys
+import traceback
+import uuid
+from functools import wraps
+from flask import Response, stream_with_context
+from klue.swagger.apipool import ApiPool
+from klue_microservice import serializer
+from klue_microservice.exceptions import KlueMicroServiceException, UnhandledServerError
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Stream a collection of models as NDJSON or as a chunked json array, with
+# bounded memory usage
+#
+
+NDJSON = 'ndjson'
+JSON_ARRAY = 'array'
+
+mimetypes = {
+    NDJSON: 'application/x-ndjson',
+    JSON_ARRAY: 'application/json',
+}
+
+# Buffer encoded items up to this many bytes before sending a chunk
+DEFAULT_CHUNK_SIZE = 16 * 1024
+
+
+class StreamedCall(object):
+    """Account for a streamed response, so that the crash handler can time and
+    report it once it has been fully sent"""
+
+    def __init__(self, format):
+        self.format = format
+        self.items = 0
+        self.bytes = 0
+
+        # Set if the stream was interrupted by an exception
+        self.error = None
+        self.error_id = ''
+        self.trace = None
+
+        # Set by the crash handler: called with this object when the stream ends
+        self.on_end = None
+
+
+def _error_record(e, call):
+    """Turn an exception raised mid-stream into a terminal error record"""
+    call.trace = traceback.format_exception(*sys.exc_info(), limit=30)
+
+    if not isinstance(e, KlueMicroServiceException):
+        log.error("UNHANDLED EXCEPTION IN STREAM: %s", '\n'.join(call.trace))
+        e = UnhandledServerError(str(e))
+
+    j = e.to_dict()
+    if 'error_id' not in j:
+        call.error_id = str(uuid.uuid4())
+        j['error_id'] = call.error_id
+
+    call.error = j
+    return j
+
+
+def _generate(models, call, model_to_json, chunk_size):
+    """Encode models one at a time and yield them in chunks of about chunk_size
+    bytes"""
+
+    is_array = call.format == JSON_ARRAY
+    separator = b',' if is_array else b'\n'
+    buf = bytearray(b'[' if is_array else b'')
+
+    try:
+        try:
+            for m in models:
+                if not isinstance(m, dict):
+                    m = model_to_json(m)
+                if is_array and call.items:
+                    buf += separator
+                buf += serializer.dumpb(m)
+                if not is_array:
+                    buf += separator
+                call.items += 1
+
+                if len(buf) >= chunk_size:
+                    call.bytes += len(buf)
+                    yield bytes(buf)
+                    buf = bytearray()
+
+        except Exception as e:
+            # Headers are already sent: end the stream with an error record
+            if is_array and call.items:
+                buf += separator
+            buf += serializer.dumpb(_error_record(e, call))
+            if not is_array:
+                buf += separator
+
+        if is_array:
+            buf += b']'
+
+        call.bytes += len(buf)
+        yield bytes(buf)
+
+    finally:
+        if call.on_end:
+            call.on_end(call)
+
+
+def stream_models(models, format=NDJSON, api_name=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Take an iterable (typically a generator) of models and return a Flask
+    Response streaming them, either as NDJSON (one json object per line) or as
+    a json array sent in chunks"""
+
+    if format not in mimetypes:
+        raise Exception("Unsupported stream format %s (expected one of %s)" % (format, ', '.join(mimetypes.keys())))
+
+    if api_name:
+        api = getattr(ApiPool, api_name)
+    else:
+        api = ApiPool().current_server_api
+
+    call = StreamedCall(format)
+    r = Response(
+        stream_with_context(_generate(models, call, api.model_to_json, chunk_size)),
+        mimetype=mimetypes[format],
+    )
+    r.klue_stream = call
+    return r
+
+
+class streamed(object):
+    """Decorate an endpoint that returns (or yields) models, to have them
+    streamed to the caller"""
+
+    def __init__(self, format=NDJSON, api_name=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.format = format
+        self.api_name = api_name
+        self.chunk_size = chunk_size
+
+    def __call__(self, f):
+
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            return stream_models(
+                f(*args, **kwargs),
+                format=self.format,
+                api_name=self.api_name,
+                chunk_size=self.chunk_size,
+            )
+
+        return wrapped
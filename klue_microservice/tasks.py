@@ -0,0 +1,356 @@
+import os
+import sys
+import json
+import time
+import heapq
+import queue
+import random
+import sqlite3
+import logging
+import threading
+import traceback
+from functools import update_wrapper
+from klue_microservice.config import get_config
+from klue_microservice.exceptions import TaskQueueFullError
+from klue_microservice.profiler import is_gevent
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Run slow side work (emails, webhooks...) off the request path, in a bounded
+# pool of threads in each worker (greenlets, once gevent has patched
+# threading), without celery:
+#
+# @background_task(retries=3)
+# def send_email(title, body):
+#     ...
+#
+# send_email.delay('Welcome!', 'You now have an account')
+#
+# Tasks declared with durable=True are also written to a local sqlite spool
+# until done, and recovered by another worker if their worker dies. Their
+# arguments must therefore be json serializable, which .delay() checks.
+#
+
+# name -> BackgroundTask, to find the task of spooled jobs
+tasks = {}
+
+
+class BackgroundTask(object):
+
+    def __init__(self, f, retries=0, backoff=1, durable=False):
+        update_wrapper(self, f)
+        self.f = f
+        self.name = '%s.%s' % (f.__module__, f.__qualname__)
+        self.retries = retries
+        self.backoff = backoff
+        self.durable = durable
+        tasks[self.name] = self
+
+    def __call__(self, *args, **kwargs):
+        """Calling the task runs it right away"""
+        return self.f(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        """Queue the task to run in the background, and return immediately.
+        Raise a TypeError if the task is durable and its arguments cannot be
+        spooled as json"""
+        job = Job(self, args, kwargs)
+        if self.durable:
+            # Fail in the caller, not when the executor spools the job
+            try:
+                job.spooled_args = json.dumps({'args': args, 'kwargs': kwargs})
+            except (TypeError, ValueError) as e:
+                raise TypeError("Arguments of durable task %s must be json serializable: %s" % (self.name, e))
+        get_executor().submit(job)
+
+
+def background_task(f=None, retries=0, backoff=1, durable=False):
+    """Decorate a function to make it into a task that can be run in the
+    background with .delay(), retried up to 'retries' times after 'backoff',
+    2*'backoff', 4*'backoff'... seconds if it raises an exception"""
+    if f:
+        return BackgroundTask(f)
+
+    def decorator(f):
+        return BackgroundTask(f, retries=retries, backoff=backoff, durable=durable)
+    return decorator
+
+
+class Job(object):
+
+    def __init__(self, task, args, kwargs, attempts=0, spool_id=None):
+        self.task = task
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = attempts
+        self.spool_id = spool_id
+        # Set by delay() for durable tasks
+        self.spooled_args = None
+
+
+class TaskSpool(object):
+    """A sqlite table of the durable jobs not yet done, shared by all workers
+    on the host. Each job is owned by the pid of the worker running it"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = self.run(self.connect)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'name TEXT, args TEXT, attempts INTEGER, owner INTEGER)'
+        )
+        return db
+
+    def run(self, f, *args):
+        """Call f(*args) holding the spool's lock. Under gevent, call it in the
+        hub's threadpool, so that sqlite's blocking io and waits on the
+        database's lock do not stall the worker's other greenlets"""
+        with self.lock:
+            if is_gevent():
+                import gevent
+                return gevent.get_hub().threadpool.apply(f, args)
+            return f(*args)
+
+    def add(self, job):
+        args = job.spooled_args or json.dumps({'args': job.args, 'kwargs': job.kwargs})
+        c = self.run(
+            self.db.execute,
+            'INSERT INTO tasks (name, args, attempts, owner) VALUES (?, ?, ?, ?)',
+            (job.task.name, args, job.attempts, os.getpid()),
+        )
+        return c.lastrowid
+
+    def update(self, job):
+        self.run(self.db.execute, 'UPDATE tasks SET attempts = ? WHERE id = ?', (job.attempts, job.spool_id))
+
+    def remove(self, job):
+        self.run(self.db.execute, 'DELETE FROM tasks WHERE id = ?', (job.spool_id,))
+
+    def release(self):
+        """Give up this worker's jobs, for other workers to recover"""
+        self.run(self.db.execute, 'UPDATE tasks SET owner = 0 WHERE owner = ?', (os.getpid(),))
+
+    def count(self):
+        return self.run(lambda: self.db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0])
+
+    def claim_orphans(self):
+        """Take over the jobs of dead or exited workers, and return them"""
+        return self.run(self.claim)
+
+    def claim(self):
+        pid = os.getpid()
+        jobs = []
+        rows = self.db.execute('SELECT id, name, args, attempts, owner FROM tasks WHERE owner != ?', (pid,)).fetchall()
+        for spool_id, name, args, attempts, owner in rows:
+            if owner and is_alive(owner):
+                continue
+            task = tasks.get(name)
+            if not task:
+                # Not declared in this server (yet)
+                continue
+            c = self.db.execute('UPDATE tasks SET owner = ? WHERE id = ? AND owner = ?', (pid, spool_id, owner))
+            if c.rowcount != 1:
+                # Another worker was faster
+                continue
+            args = json.loads(args)
+            jobs.append(Job(task, args['args'], args['kwargs'], attempts=attempts, spool_id=spool_id))
+        return jobs
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TaskExecutor(object):
+
+    def __init__(self, conf):
+        self.pid = os.getpid()
+        self.workers = max(1, conf.task_workers)
+        self.spool_path = conf.task_spool_path
+        self.spool = None
+
+        self.queue = queue.Queue(maxsize=conf.task_queue_size)
+        self.lock = threading.Lock()
+        # Jobs waiting to be retried, as a heap of (time, seq, job)
+        self.delayed = []
+        self.seq = 0
+        self.running = 0
+        self.stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'retried': 0,
+            'rejected': 0,
+        }
+
+        for i in range(self.workers):
+            threading.Thread(target=self.work, name='klue-task-%s' % i, daemon=True).start()
+        threading.Thread(target=self.schedule, name='klue-task-scheduler', daemon=True).start()
+
+    def get_spool(self):
+        if not self.spool:
+            self.spool = TaskSpool(self.spool_path)
+        return self.spool
+
+    def submit(self, job):
+        if job.task.durable and job.spool_id is None:
+            job.spool_id = self.get_spool().add(job)
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            if job.spool_id is not None:
+                # Safe in the spool: try again later
+                self.delay(job, 1)
+            else:
+                with self.lock:
+                    self.stats['rejected'] += 1
+                raise TaskQueueFullError("Background task queue is full (%s tasks): cannot run %s" % (self.queue.maxsize, job.task.name))
+        with self.lock:
+            self.stats['submitted'] += 1
+
+    def delay(self, job, seconds):
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.delayed, (time.time() + seconds, self.seq, job))
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                self.running += 1
+            try:
+                self.run(job)
+            except Exception:
+                # Most likely the spool failing: keep this thread in the pool
+                log.error("BACKGROUND TASK WORKER ERROR running %s: %s", job.task.name, traceback.format_exc())
+            finally:
+                with self.lock:
+                    self.running -= 1
+                self.queue.task_done()
+
+    def run(self, job):
+        task = job.task
+        try:
+            task.f(*job.args, **job.kwargs)
+        except Exception:
+            job.attempts += 1
+            trace = traceback.format_exception(*sys.exc_info(), limit=30)
+            if job.attempts <= task.retries:
+                backoff = task.backoff * 2 ** (job.attempts - 1) * random.uniform(1, 1.2)
+                log.warn("Background task %s failed (attempt %s/%s), retrying in %.1f sec: %s", task.name, job.attempts, task.retries + 1, backoff, trace[-1].strip())
+                if job.spool_id is not None:
+                    self.get_spool().update(job)
+                self.delay(job, backoff)
+                with self.lock:
+                    self.stats['retried'] += 1
+                return
+
+            log.error("BACKGROUND TASK FAILED: %s after %s attempts:\n%s", task.name, job.attempts, ''.join(trace))
+            with self.lock:
+                self.stats['failed'] += 1
+        else:
+            with self.lock:
+                self.stats['completed'] += 1
+
+        if job.spool_id is not None:
+            self.get_spool().remove(job)
+
+    def schedule(self):
+        """Queue delayed jobs once due, and recover the spooled jobs of dead
+        workers every minute"""
+        last_recovery = 0
+        while True:
+            now = time.time()
+            due = []
+            with self.lock:
+                while self.delayed and self.delayed[0][0] <= now:
+                    due.append(heapq.heappop(self.delayed)[2])
+            for job in due:
+                try:
+                    self.queue.put_nowait(job)
+                except queue.Full:
+                    self.delay(job, 1)
+
+            if now - last_recovery > 60 and os.path.exists(self.spool_path):
+                last_recovery = now
+                try:
+                    for job in self.get_spool().claim_orphans():
+                        log.info("Recovering background task %s from the spool", job.task.name)
+                        self.delay(job, 0)
+                except sqlite3.Error as e:
+                    log.warn("Failed to recover spooled tasks: %s", e)
+
+            time.sleep(0.5)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['running'] = self.running
+            stats['delayed'] = len(self.delayed)
+        stats['pid'] = self.pid
+        stats['workers'] = self.workers
+        stats['queued'] = self.queue.qsize()
+        stats['spooled'] = self.get_spool().count() if self.spool else 0
+        return stats
+
+    def shutdown(self, timeout):
+        """Wait up to timeout seconds for queued tasks to complete"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.running and not self.queue.qsize() and not self.delayed:
+                    break
+            time.sleep(0.1)
+
+        lost = self.queue.qsize() + len(self.delayed) + self.running
+        if lost:
+            log.warn("Worker exiting with %s background tasks not done (spooled ones will be recovered)", lost)
+        if self.spool:
+            self.spool.release()
+
+
+executor = None
+
+def get_executor():
+    """Return this process's executor, started on first use after fork"""
+    global executor
+    if not executor or executor.pid != os.getpid():
+        executor = TaskExecutor(get_config())
+    return executor
+
+
+def get_task_stats():
+    """Return the queue depth and counters of this worker's background tasks"""
+    if not executor or executor.pid != os.getpid():
+        stats = dict.fromkeys(['submitted', 'completed', 'failed', 'retried', 'rejected', 'running', 'delayed', 'workers', 'queued', 'spooled'], 0)
+        stats['pid'] = os.getpid()
+        return stats
+    return executor.get_stats()
+
+
+def start_tasks():
+    """Called when a gunicorn worker starts: if durable tasks are declared,
+    start the executor right away to recover the tasks of dead workers"""
+    if [t for t in tasks.values() if t.durable]:
+        get_executor()
+
+
+def shutdown_tasks():
+    """Called when a gunicorn worker exits"""
+    if executor and executor.pid == os.getpid():
+        executor.shutdown(get_config().task_shutdown_timeout)
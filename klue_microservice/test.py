@@ -1,5 +1,17 @@
 import os
+import sys
+import json
+import time
+import socket
+import logging
+import http.client
+import importlib.util
+from urllib.parse import urlsplit
 from klue_unit.testcase import KlueTestCase
+from klue_microservice.soak import record_latency
+
+
+log = logging.getLogger(__name__)
 
 
 def load_port_host_token():
@@ -30,14 +42,125 @@ def load_port_host_token():
     return (server_host, server_port, token)
 
 
+def wait_for_server(host, port, timeout=30, p=None):
+    """Wait until the server at host:port replies to /ping, and return
+    True, or False if it did not within timeout seconds, or if the process p
+    (a subprocess.Popen) died"""
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if p and p.poll() is not None:
+            return False
+        try:
+            c = http.client.HTTPConnection(host, port, timeout=1)
+            c.request('GET', '/ping')
+            if c.getresponse().status == 200:
+                return True
+        except (socket.error, http.client.HTTPException):
+            pass
+        time.sleep(0.1)
+    return False
+
+
+#
+# In-process mode: import the server, build its app once per test session,
+# and call it via Flask's test client instead of over http
+#
+
+# Path to server.py -> Flask app
+apps = {}
+
+def load_app(path_server):
+    """Import the server at path_server, without running it, and return its
+    Flask app (the variable 'app' in the server's code)"""
+    path_server = os.path.abspath(path_server)
+    if path_server in apps:
+        return apps[path_server]
+
+    import klue_microservice
+    klue_microservice.is_in_process_test = True
+
+    # The server may import modules next to it
+    sys.path.insert(0, os.path.dirname(path_server))
+
+    log.info("Loading server %s in-process", path_server)
+    name = os.path.splitext(os.path.basename(path_server))[0]
+    spec = importlib.util.spec_from_file_location(name, path_server)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    apps[path_server] = module.app
+    return module.app
+
+
+class InProcessResponse(object):
+    """Give a Flask test client's response the interface of a requests
+    response"""
+
+    def __init__(self, r):
+        self.status_code = r.status_code
+        self.headers = r.headers
+        self.content = r.get_data()
+        self.text = self.content.decode('utf-8')
+        # As a WSGI server would once the response is sent: runs the
+        # request's after_response hooks
+        r.close()
+
+    def json(self):
+        return json.loads(self.text)
+
+
 class KlueMicroServiceTestCase(KlueTestCase):
 
     token = None
 
+    # Set to the path of your server.py, or set KLUE_SERVER_PATH, to call the
+    # server in-process instead of over http
+    server_path = None
+    app = None
+
     def setUp(self):
         super().setUp()
         self.maxDiff = None
-        self.host, self.port, self.token = load_port_host_token()
+
+        path = self.server_path or os.environ.get('KLUE_SERVER_PATH')
+        if path:
+            self.app = load_app(path)
+            self.host, self.port = 'localhost', 80
+            self.token = os.environ.get('KLUE_JWT_TOKEN', None)
+            if not self.token:
+                from klue_microservice.config import get_config
+                from klue_microservice.auth import generate_token
+                if get_config().jwt_secret:
+                    self.token = generate_token(user_id='test-in-process')
+        else:
+            self.host, self.port, self.token = load_port_host_token()
+
+    def _try(self, method, url, headers, data, allow_redirects=True, verify_ssl=True):
+        t0 = time.time()
+        if self.app:
+            r = self._try_in_process(method, url, headers, data, allow_redirects=allow_redirects)
+        else:
+            r = super()._try(method, url, headers, data, allow_redirects=allow_redirects, verify_ssl=verify_ssl)
+        # In soak tests (run_acceptance_tests --loop), record each call's latency
+        record_latency(method, url, r.status_code, (time.time() - t0) * 1000)
+        return r
+
+    def _try_in_process(self, method, url, headers, data, allow_redirects=True):
+        if type(data) is dict:
+            data = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        r = self.app.test_client().open(
+            path,
+            method=method.upper(),
+            headers=headers,
+            data=data,
+            follow_redirects=allow_redirects,
+        )
+        return InProcessResponse(r)
 
     def assertIsVersion(self, j):
         self.assertTrue(type(j['version']) is str)
@@ -0,0 +1,189 @@
+import os
+import time
+import random
+import socket
+import logging
+from collections import deque
+from functools import wraps
+from flask import request
+from klue.swagger.apipool import ApiPool
+from klue_microservice import serializer
+from klue_microservice.config import get_config
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Lightweight distributed tracing: record the timing of sampled endpoint
+# calls and of the api calls they make, as Zipkin v2 spans. The trace id is
+# the call_id that klue-client-server propagates across micro-services, and
+# the caller's span id is passed along in the KlueSpanID header.
+#
+
+SPAN_HEADER = 'KlueSpanID'
+SAMPLED_HEADER = 'KlueTraceSampled'
+
+
+def new_span_id():
+    return '%016x' % random.getrandbits(64)
+
+
+class Span(object):
+
+    __slots__ = ('name', 'kind', 'span_id', 'parent_id', 'trace_id', 'start', 'duration', 'tags')
+
+    def __init__(self, name, kind, parent_id=None):
+        self.name = name
+        self.kind = kind
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.trace_id = None
+        self.start = time.time()
+        self.duration = None
+        self.tags = {}
+
+    def to_zipkin(self):
+        """Return this span in Zipkin's v2 json format"""
+        j = {
+            'traceId': (self.trace_id or '').replace('-', ''),
+            'id': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'timestamp': int(self.start * 1000000),
+            'duration': int(self.duration * 1000000),
+            'localEndpoint': {
+                'serviceName': ApiPool().current_server_name,
+            },
+            'tags': self.tags,
+        }
+        if self.parent_id:
+            j['parentId'] = self.parent_id
+        return j
+
+
+class Tracer(object):
+
+    def __init__(self):
+        conf = get_config()
+        self.sample_rate = conf.trace_sample_rate
+        self.spans = deque(maxlen=conf.trace_buffer_size)
+        self.sink = conf.trace_sink
+        self.sink_pid = None
+        self.sink_file = None
+        self.sink_socket = None
+        self.sink_address = None
+
+    def start_server_span(self, name):
+        """Start a span around the current request, or return None if this
+        request is not sampled"""
+
+        # Follow the caller's sampling decision, if any
+        sampled = request.headers.get(SAMPLED_HEADER, None)
+        if sampled is None:
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return None
+        elif sampled != '1':
+            return None
+
+        span = Span(name, 'SERVER', parent_id=request.headers.get(SPAN_HEADER, None))
+        stack.top.klue_span = span
+        return span
+
+    def start_client_span(self, name):
+        """Start a child span of the current request's span, or return None if
+        this request is not sampled"""
+        if stack.top is None:
+            return None
+        parent = getattr(stack.top, 'klue_span', None)
+        if not parent:
+            return None
+        return Span(name, 'CLIENT', parent_id=parent.span_id)
+
+    def finish_span(self, span, status=None):
+        span.duration = time.time() - span.start
+        if stack.top is not None:
+            span.trace_id = getattr(stack.top, 'call_id', None)
+        if status is not None:
+            span.tags['http.status_code'] = str(status)
+        self.spans.append(span)
+        if self.sink:
+            self.export(span)
+
+    def get_spans(self):
+        """Return the most recent spans recorded in this worker"""
+        return [s.to_zipkin() for s in list(self.spans)]
+
+    def export(self, span):
+        """Send this span to the configured sink, as a json line written to a
+        local file ('file:///path/to/spans.json') or as a UDP datagram
+        ('udp://host:port')"""
+
+        # Tracing must never break a request
+        if self.sink_pid != os.getpid():
+            # We were forked: re-open the sink
+            self.sink_pid = os.getpid()
+            self.sink_file = None
+            self.sink_socket = None
+            try:
+                if self.sink.startswith('file://'):
+                    self.sink_file = open(self.sink[7:], 'a', buffering=1)
+                elif self.sink.startswith('udp://'):
+                    host, port = self.sink[6:].split(':')
+                    self.sink_address = (host, int(port))
+                    self.sink_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    self.sink_socket.setblocking(False)
+                else:
+                    raise ValueError("unsupported scheme")
+            except Exception as e:
+                log.error("Cannot open trace_sink %s (%s): not exporting spans", self.sink, e)
+                self.sink = None
+                return
+
+        try:
+            if self.sink_file:
+                self.sink_file.write(serializer.dumps([span.to_zipkin()]) + '\n')
+            elif self.sink_socket:
+                self.sink_socket.sendto(serializer.dumpb([span.to_zipkin()]), self.sink_address)
+        except Exception as e:
+            log.warn("Failed to export span: %s", e)
+
+
+tracer = None
+
+def get_tracer():
+    global tracer
+    if not tracer:
+        tracer = Tracer()
+    return tracer
+
+
+def tracing_client_decorator(api, name, f):
+    """Wrap a client caller so that calls made while serving a sampled request
+    are recorded as child spans, and the called server continues the trace"""
+
+    name = "%s.%s" % (api.name, name)
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        span = get_tracer().start_client_span(name)
+        if not span:
+            return f(*args, **kwargs)
+
+        # Copy the caller's headers, which it may reuse across calls
+        headers = dict(kwargs.get('request_headers') or {})
+        headers[SPAN_HEADER] = span.span_id
+        headers[SAMPLED_HEADER] = '1'
+        kwargs['request_headers'] = headers
+
+        try:
+            return f(*args, **kwargs)
+        finally:
+            get_tracer().finish_span(span)
+
+    return wrapper
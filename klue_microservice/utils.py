@@ -1,75 +1,215 @@
 import os
+import re
 import sys
+import json
 import logging
 import datetime
+import threading
 from dateutil import parser
 import socket
 import logging
 import pytz
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 log = logging.getLogger(__name__)
 
 
-IS_EC2_INSTANCE = -1
+#
+# Detect whether the server runs on ec2 once, in the gunicorn master, and cache
+# it in a file that later masters on the same host reuse. The container's
+# version may change with every deploy, so each master reads it afresh
+#
 
-def is_ec2_instance():
+ENVIRONMENT_FILE = '/tmp/klue-environment.json'
+
+environment = None
+
+def probe_ec2_instance():
     """Try fetching instance metadata at 'curl http://169.254.169.254/latest/meta-data/'
     to see if host is on an ec2 instance"""
 
     # Note: this code assumes that docker containers running on ec2 instances
     # inherit instances metadata, which they do as of 2016-08-25
 
-    global IS_EC2_INSTANCE
-
-    if IS_EC2_INSTANCE != -1:
-        # Returned the cached value
-        return IS_EC2_INSTANCE
-
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.settimeout(0.2)
     try:
         s.connect(("169.254.169.254", 80))
-        IS_EC2_INSTANCE = 1
         return True
     except socket.timeout:
-        IS_EC2_INSTANCE = 0
         return False
     except socket.error:
-        IS_EC2_INSTANCE = 0
         return False
+    finally:
+        s.close()
+
+
+def read_container_version():
+    root_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
+    version_file = os.path.join(root_dir, 'VERSION')
+    if os.path.exists(version_file):
+        with open(version_file) as f:
+            return f.read()
+    return ''
+
+
+def probe_environment():
+    """Detect the environment and save whether on ec2 to ENVIRONMENT_FILE.
+    May block for up to 200msec"""
+    global environment
+    env = {
+        'is_ec2_instance': probe_ec2_instance(),
+        'hostname': socket.gethostname(),
+    }
+
+    try:
+        tmp_path = '%s.%s' % (ENVIRONMENT_FILE, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(env))
+        os.rename(tmp_path, ENVIRONMENT_FILE)
+    except (IOError, OSError) as e:
+        log.warn("Failed to save environment to %s: %s", ENVIRONMENT_FILE, e)
+
+    env['container_version'] = read_container_version()
+    log.info("Probed environment: %s", env)
+    environment = env
+    return env
+
+
+def load_environment():
+    """Return the environment set in the KLUE_IS_EC2_INSTANCE environment
+    variable, or previously saved on this host, or None"""
+
+    v = os.environ.get('KLUE_IS_EC2_INSTANCE')
+    if v is not None:
+        return {
+            'is_ec2_instance': v.lower() in ('1', 'true', 'yes'),
+            'container_version': read_container_version(),
+            'hostname': socket.gethostname(),
+        }
+
+    try:
+        with open(ENVIRONMENT_FILE) as f:
+            env = json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+    # In docker, the hostname is the container's id
+    if env.get('hostname') != socket.gethostname() or 'is_ec2_instance' not in env:
+        return None
+    return {
+        'is_ec2_instance': env['is_ec2_instance'],
+        'container_version': read_container_version(),
+        'hostname': env['hostname'],
+    }
+
+
+def get_environment():
+    """Return a dict describing the environment: 'is_ec2_instance',
+    'container_version' and 'hostname'"""
+    global environment
+    if environment is None:
+        environment = load_environment() or probe_environment()
+    return environment
+
+
+def start_environment_probe():
+    """Probe the environment in a background thread, unless it is already
+    known. Return the thread, or None"""
+    global environment
+    if environment is None:
+        environment = load_environment()
+    if environment is not None:
+        return None
+    t = threading.Thread(target=probe_environment, name='klue-environment-probe')
+    t.daemon = True
+    t.start()
+    return t
+
+
+def is_ec2_instance():
+    """Return True if running on an ec2 instance"""
+    return get_environment()['is_ec2_instance']
+
+
+UTC = pytz.timezone('utc')
+EPOCH = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, UTC)
+NAIVE_EPOCH = datetime.datetime(1970, 1, 1)
+
+# ISO 8601 timestamps, as written by datetime.isoformat() and most databases:
+# 2017-03-01T10:24:12[.123456][Z|+01:00|-0100]
+ISO_8601 = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?(Z|[+-]\d\d:?\d\d)?$')
 
 
 def timenow():
-    return datetime.datetime.now(pytz.timezone('utc'))
+    return datetime.datetime.now(UTC)
+
+
+def parse_iso_8601(s):
+    """Return the epoch, as a float, of an ISO 8601 timestamp string, or None
+    if s has an other format. Timestamps without timezone are in UTC"""
+    m = ISO_8601.match(s)
+    if not m:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = m.groups()
+    microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+    t = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    seconds = (t - NAIVE_EPOCH).total_seconds()
+    if tz and tz != 'Z':
+        offset = int(tz[1:3]) * 3600 + int(tz[-2:]) * 60
+        seconds = seconds - offset if tz[0] == '+' else seconds + offset
+    return seconds
 
 
 def to_epoch(t):
     """Take a datetime, either as a string or a datetime.datetime object,
     and return the corresponding epoch"""
     if isinstance(t, str):
+        seconds = parse_iso_8601(t)
+        if seconds is not None:
+            return int(seconds)
+        # Not a common format: let dateutil figure it out
         if '+' not in t:
             t = t + '+00:00'
         t = parser.parse(t)
     elif t.tzinfo is None or t.tzinfo.utcoffset(t) is None:
-        t = t.replace(tzinfo=pytz.timezone('utc'))
+        t = t.replace(tzinfo=UTC)
 
-    t0 = datetime.datetime(1970, 1, 1, 0, 0, 0, 0, pytz.timezone('utc'))
-    delta = t - t0
+    delta = t - EPOCH
     return int(delta.total_seconds())
 
 
 def to_datetime(e):
     """Take an epoch and return a timezone aware datetime"""
-    return datetime.datetime.fromtimestamp(e, pytz.timezone('utc'))
+    return datetime.datetime.fromtimestamp(e, UTC)
+
+
+def to_epoch_many(ts):
+    """Take a list of datetimes (as strings or datetime.datetime objects) and
+    return the list of their epochs. A numpy array of datetime64 is converted
+    in one go, and returned as an array of int64"""
+    if numpy is not None and isinstance(ts, numpy.ndarray):
+        if numpy.issubdtype(ts.dtype, numpy.datetime64):
+            return ts.astype('datetime64[s]').astype('int64')
+        return numpy.array([to_epoch(t) for t in ts.tolist()], dtype='int64')
+    return [to_epoch(t) for t in ts]
+
+
+def to_datetime_many(es):
+    """Take a list, or numpy array, of epochs and return the list of the
+    corresponding timezone aware datetimes"""
+    if numpy is not None and isinstance(es, numpy.ndarray):
+        es = es.tolist()
+    fromtimestamp = datetime.datetime.fromtimestamp
+    return [fromtimestamp(e, UTC) for e in es]
 
 
 def get_container_version():
     """Return the version of the docker container running the present server,
     or '' if not in a container"""
-    root_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
-    version_file = os.path.join(root_dir, 'VERSION')
-    if os.path.exists(version_file):
-        with open(version_file) as f:
-            return f.read()
-    return ''
+    return get_environment()['container_version']
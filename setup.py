@@ -63,7 +63,7 @@ setup(
         'PyJWT',
     ],
     packages=['klue_microservice'],
-    package_data={'klue_microservice': ['*.yaml']},
+    package_data={'klue_microservice': ['*.yaml', 'benchserver/*']},
     scripts=glob("bin/*"),
     test_suite='nose.collector',
     zip_safe=False,
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from klue_microservice.acceptance import make_shards, parse_xunit, get_module_name
+
+
+XUNIT = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuite name="nosetests" tests="5" errors="1" failures="1" skip="0">
+<testcase classname="testaccept.test_users.Tests" name="test_create" time="1.5"></testcase>
+<testcase classname="testaccept.test_users.Tests" name="test_delete" time="2.0"><failure type="AssertionError" message="nope"></failure></testcase>
+<testcase classname="test_ping.Tests" name="test_ping" time="0.25"></testcase>
+<testcase classname="test_ping" name="test_ping_function" time="0.25"><error type="Exception" message="boom"></error></testcase>
+<testcase classname="test_version.Tests" name="test_version" time="3"></testcase>
+</testsuite>
+"""
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def touch(self, *parts):
+        path = os.path.join(self.tmpdir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        return path
+
+    def test_make_shards(self):
+        durations = {'a': 10, 'b': 9, 'c': 5, 'd': 4, 'e': 1}
+        shards, totals = make_shards(['e', 'd', 'c', 'b', 'a'], durations, 2)
+        # Longest first, each to the shortest shard so far
+        self.assertEqual(shards, [['a', 'd', 'e'], ['b', 'c']])
+        self.assertEqual(totals, [15, 14])
+
+        # Modules never run before count as the median known duration
+        shards, totals = make_shards(['a', 'b', 'c', 'x', 'y'], durations, 3)
+        self.assertEqual(shards, [['a'], ['b', 'y'], ['x', 'c']])
+        self.assertEqual(totals, [10, 18, 14])
+
+        # No more shards than modules
+        shards, totals = make_shards(['x', 'y'], {}, 4)
+        self.assertEqual(shards, [['x'], ['y']])
+        self.assertEqual(totals, [10, 10])
+
+    def test_get_module_name(self):
+        self.touch('repo', 'testaccept', '__init__.py')
+        self.assertEqual(get_module_name(self.touch('repo', 'testaccept', 'test_users.py')), 'testaccept.test_users')
+        self.assertEqual(get_module_name(self.touch('other', 'testaccept', 'test_users.py')), 'test_users')
+
+    def test_parse_xunit(self):
+        path = os.path.join(self.tmpdir, 'shard.xml')
+        with open(path, 'w') as f:
+            f.write(XUNIT)
+
+        self.touch('repo', 'testaccept', '__init__.py')
+        users = self.touch('repo', 'testaccept', 'test_users.py')
+        ping = self.touch('repo', 'test_ping.py')
+        # Same name in two directories
+        version1 = self.touch('repo1', 'testaccept', 'test_version.py')
+        version2 = self.touch('repo2', 'testaccept', 'test_version.py')
+
+        tests, failures, errors, durations = parse_xunit(path, [users, ping, version1, version2])
+        self.assertEqual((tests, failures, errors), (5, 1, 1))
+        self.assertEqual(durations, {users: 3.5, ping: 0.5})
+
+        # A shard that crashed before writing its report
+        self.assertEqual(parse_xunit(os.path.join(self.tmpdir, 'nosuchfile.xml'), [users]), (0, 0, 0, {}))
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import unittest
+from types import SimpleNamespace
+from flask import Flask
+from klue_microservice import admission
+from klue_microservice.config import get_config
+from klue_microservice.hooks import get_hooks, run_hooks
+from klue_microservice.stream import StreamedCall
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        conf = get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.saved = (conf.max_inflight_requests, conf.max_queue_delay_ms)
+        conf.max_inflight_requests = 2
+        conf.max_queue_delay_ms = 500
+        self.app = Flask(__name__)
+        self.admission_control = admission.generate_admission_decorator()
+
+    def tearDown(self):
+        get_config().max_inflight_requests, get_config().max_queue_delay_ms = self.saved
+        admission.inflight = 0
+
+    def test_get_queue_delay_ms(self):
+        now = time.time()
+        tests = [
+            # header, min and max delay in msec
+            ('t=%.3f' % (now - 0.2), 150, 300),
+            ('%.3f' % (now - 0.2), 150, 300),
+            ('%d' % ((now - 0.2) * 1000), 150, 300),
+            ('%d' % ((now - 0.2) * 1000000), 150, 300),
+            # Clocks may drift: never negative
+            ('t=%.3f' % (now + 10), 0, 0),
+        ]
+        for header, min_ms, max_ms in tests:
+            ms = admission.get_queue_delay_ms(header)
+            self.assertTrue(min_ms <= ms <= max_ms, "%s: %s" % (header, ms))
+
+        for header in ('', 't=', 'notanumber'):
+            self.assertIsNone(admission.get_queue_delay_ms(header))
+
+    def call(self, f, headers={}):
+        with self.app.test_request_context('/', headers=headers):
+            return self.admission_control(f)()
+
+    def assertShed(self, r):
+        self.assertEqual(r.status_code, 503)
+        self.assertEqual(r.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(r.get_data().decode('utf-8'))['error'], 'SERVER_OVERLOADED')
+
+    def test_shed_inflight(self):
+        def do_nested():
+            # The inner call is the third in flight
+            self.assertEqual(admission.inflight, 1)
+            return self.call(do_get_inflight)
+
+        def do_get_inflight():
+            return admission.inflight
+
+        self.assertEqual(self.call(do_get_inflight), 1)
+        self.assertEqual(self.call(do_nested), 2)
+
+        admission.inflight = 2
+        shed = admission.get_admission_stats()['shed_inflight']
+        self.assertShed(self.call(do_get_inflight))
+        self.assertEqual(admission.get_admission_stats()['shed_inflight'], shed + 1)
+
+    def test_shed_queue_delay(self):
+        def do_nothing():
+            return 'ok'
+
+        self.assertEqual(self.call(do_nothing, {'X-Request-Start': 't=%.3f' % (time.time() - 0.1)}), 'ok')
+        self.assertShed(self.call(do_nothing, {'X-Request-Start': 't=%.3f' % (time.time() - 1)}))
+        self.assertEqual(admission.inflight, 0)
+
+    def test_streamed_call_inflight(self):
+        ended = []
+
+        def do_stream():
+            r = SimpleNamespace(klue_stream=StreamedCall('ndjson'))
+            r.klue_stream.on_end = ended.append
+            return r
+
+        with self.app.test_request_context('/'):
+            r = self.admission_control(do_stream)()
+            # Still in flight until the stream has been sent
+            self.assertEqual(admission.inflight, 1)
+            r.klue_stream.on_end(r.klue_stream)
+            self.assertEqual(admission.inflight, 0)
+            self.assertEqual(ended, [r.klue_stream])
+
+            # Closing the response does not release it twice
+            run_hooks(get_hooks())
+            self.assertEqual(admission.inflight, 0)
+
+        with self.app.test_request_context('/'):
+            r = self.admission_control(do_stream)()
+            # The response was closed before the stream started
+            run_hooks(get_hooks())
+            self.assertEqual(admission.inflight, 0)
+            self.assertEqual(len(ended), 1)
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from klue_microservice import autotune
+from klue_microservice.autotune import get_cpu_limit, get_memory_limit, get_worker_memory, MB
+
+
+GB = 1024 * MB
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (autotune.CGROUP_DIR, autotune.WORKER_MEMORY_FILE)
+        autotune.CGROUP_DIR = os.path.join(self.tmpdir, 'cgroup')
+        autotune.WORKER_MEMORY_FILE = os.path.join(self.tmpdir, 'klue-worker-memory.json')
+        os.makedirs(autotune.CGROUP_DIR)
+
+    def tearDown(self):
+        autotune.CGROUP_DIR, autotune.WORKER_MEMORY_FILE = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        path = os.path.join(autotune.CGROUP_DIR, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def get_conf(self, profile='io', worker_memory_mb=0, workers=0):
+        return SimpleNamespace(
+            gunicorn_profile=profile,
+            gunicorn_worker_memory_mb=worker_memory_mb,
+            gunicorn_workers=workers,
+        )
+
+    def get_host_cpus(self):
+        if hasattr(os, 'sched_getaffinity'):
+            return float(len(os.sched_getaffinity(0)))
+        return float(os.cpu_count())
+
+    def test_cpu_limit_v2(self):
+        self.write('cpu.max', '150000 100000\n')
+        self.assertEqual(get_cpu_limit(), 1.5)
+
+        self.write('cpu.max', 'max 100000\n')
+        self.assertEqual(get_cpu_limit(), self.get_host_cpus())
+
+    def test_cpu_limit_v1(self):
+        self.write('cpu/cpu.cfs_quota_us', '50000\n')
+        self.write('cpu/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(get_cpu_limit(), 0.5)
+
+        # No quota
+        self.write('cpu/cpu.cfs_quota_us', '-1\n')
+        self.assertEqual(get_cpu_limit(), self.get_host_cpus())
+
+    def test_no_cgroup(self):
+        self.assertEqual(get_cpu_limit(), self.get_host_cpus())
+        physical = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        self.assertEqual(get_memory_limit(), physical)
+
+    def test_memory_limit_v2(self):
+        self.write('memory.max', '%s\n' % (512 * MB))
+        self.assertEqual(get_memory_limit(), 512 * MB)
+
+        self.write('memory.max', 'max\n')
+        self.assertEqual(get_memory_limit(), os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+
+    def test_memory_limit_v1(self):
+        self.write('memory/memory.limit_in_bytes', '%s\n' % (256 * MB))
+        self.assertEqual(get_memory_limit(), 256 * MB)
+
+        # v1 means no limit with a huge number
+        self.write('memory/memory.limit_in_bytes', '9223372036854771712\n')
+        self.assertEqual(get_memory_limit(), os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+
+    def test_worker_memory(self):
+        conf = self.get_conf()
+        self.assertEqual(get_worker_memory(conf), (100 * MB, 'default estimate'))
+        self.assertEqual(get_worker_memory(conf, 80 * MB)[0], 80 * MB)
+
+        # Measured after warmup at a previous startup
+        with open(autotune.WORKER_MEMORY_FILE, 'w') as f:
+            f.write(json.dumps({'unique': 60 * MB, 'rss': 200 * MB}))
+        self.assertEqual(get_worker_memory(conf, 80 * MB)[0], 60 * MB)
+
+        self.assertEqual(get_worker_memory(self.get_conf(worker_memory_mb=150), 80 * MB)[0], 150 * MB)
+
+        with open(autotune.WORKER_MEMORY_FILE, 'w') as f:
+            f.write('not json')
+        self.assertEqual(get_worker_memory(conf)[0], 100 * MB)
+
+    def test_autotune(self):
+        self.write('cpu.max', '200000 100000\n')
+        self.write('memory.max', '%s\n' % (4 * GB))
+
+        tests = [
+            # profile, worker memory mb, master memory, forced workers, expected settings
+            ('io', 0, None, 0, {'workers': 5, 'worker_class': 'gevent', 'worker_connections': 1000}),
+            ('mixed', 0, None, 0, {'workers': 3, 'worker_class': 'gevent', 'worker_connections': 100}),
+            ('cpu', 0, None, 0, {'workers': 2, 'worker_class': 'sync', 'worker_connections': 1}),
+            ('unknown', 0, None, 0, {'workers': 5, 'worker_class': 'gevent', 'worker_connections': 1000}),
+            # 80% of 4GB fit 3 workers of 1GB
+            ('io', 1024, None, 0, {'workers': 3, 'worker_class': 'gevent', 'worker_connections': 1000}),
+            ('io', 0, 1 * GB, 0, {'workers': 3, 'worker_class': 'gevent', 'worker_connections': 1000}),
+            # But at least one
+            ('io', 8192, None, 0, {'workers': 1, 'worker_class': 'gevent', 'worker_connections': 1000}),
+            ('cpu', 1024, None, 8, {'workers': 8, 'worker_class': 'sync', 'worker_connections': 1}),
+        ]
+        for profile, worker_memory_mb, master_memory, workers, expected in tests:
+            conf = self.get_conf(profile, worker_memory_mb, workers)
+            settings, reasons = autotune.autotune(conf, master_memory=master_memory)
+            self.assertEqual(settings, expected, (profile, worker_memory_mb, master_memory, workers))
+            self.assertTrue(reasons[-1].startswith('=> %s' % expected['workers']))
+
+        settings, reasons = autotune.autotune(self.get_conf('io', 1024))
+        self.assertIn("capping workers from 5 to 3 to fit in memory", reasons)
@@ -0,0 +1,79 @@
+import unittest
+from click.testing import CliRunner
+from klue_microservice.bench import summarize, compare, percentile, main
+
+
+def result(rps, p99):
+    return {'rps': rps, 'latency_ms': {'p99': p99}}
+
+
+class Tests(unittest.TestCase):
+
+    def test_percentile(self):
+        latencies = list(range(1, 101))
+        self.assertEqual(percentile(latencies, 50), 51)
+        self.assertEqual(percentile(latencies, 99), 100)
+        self.assertEqual(percentile(latencies, 100), 100)
+        self.assertEqual(percentile([], 99), 0)
+
+    def test_summarize(self):
+        # 1000 requests over 4 sec, latencies shuffled
+        latencies = [(i * 7 % 1000) / 10.0 + 0.1 for i in range(1000)]
+        s = summarize(latencies, 3, 4)
+        self.assertEqual(s['requests'], 1000)
+        self.assertEqual(s['errors'], 3)
+        self.assertEqual(s['rps'], 250)
+        self.assertEqual(s['latency_ms'], {
+            'mean': 50.05,
+            'p50': 50.1,
+            'p90': 90.1,
+            'p99': 99.1,
+            'max': 100,
+        })
+        self.assertEqual(sum(s['histogram'].values()), 1000)
+        self.assertEqual(s['histogram']['<=0.5'], 5)
+        self.assertEqual(s['histogram']['<=100'], 500)
+        self.assertEqual(s['histogram']['>5000'], 0)
+
+    def test_summarize_no_requests(self):
+        s = summarize([], 12, 10)
+        self.assertEqual((s['requests'], s['errors'], s['rps']), (0, 12, 0))
+        self.assertEqual(s['latency_ms'], {'mean': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'max': 0})
+
+    def test_compare(self):
+        baseline = {'endpoints': {
+            'ping': result(1000, 10),
+            'version': result(500, 20),
+            'crash': result(100, 50),
+            'gone': result(100, 50),
+        }}
+        results = {'endpoints': {
+            # rps dropped 15%
+            'ping': result(850, 10),
+            # p99 rose 15%
+            'version': result(500, 23),
+            # Within bounds
+            'crash': result(95, 55),
+            # Not in the baseline
+            'new': result(100, 50),
+        }}
+
+        lines, regressed = compare(results, baseline, 20)
+        self.assertFalse(regressed)
+        self.assertEqual([l.split()[0] for l in lines], ['crash', 'ping', 'version'])
+        self.assertNotIn('REGRESSION', '\n'.join(lines))
+        self.assertIn('( -15.0%)', lines[1])
+        self.assertIn('( +15.0%)', lines[2])
+
+        lines, regressed = compare(results, baseline, 10)
+        self.assertTrue(regressed)
+        self.assertEqual(['REGRESSION' in l for l in lines], [False, True, True])
+
+        # Without a max, only report
+        lines, regressed = compare(results, baseline, None)
+        self.assertFalse(regressed)
+
+    def test_max_regression_requires_baseline(self):
+        r = CliRunner().invoke(main, ['--max-regression', '10'])
+        self.assertEqual(r.exit_code, 1)
+        self.assertIn('--max-regression requires a --baseline', r.output)
@@ -0,0 +1,89 @@
+import unittest
+from types import SimpleNamespace
+from klue_microservice import blocking
+from klue_microservice.blocking import generate_blocking_listener, get_blocking_stats, spawn_report
+
+
+class EventLoopBlocked(object):
+    """Stands for gevent.events.EventLoopBlocked"""
+
+    def __init__(self, blocking_time, info):
+        self.blocking_time = blocking_time
+        self.info = info
+
+
+class OtherEvent(object):
+    pass
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (blocking.blocked_count, blocking.max_blocked_ms, blocking.last_report_time, blocking.unreported_count, blocking.time)
+        blocking.blocked_count = 0
+        blocking.max_blocked_ms = 0
+        blocking.last_report_time = 0
+        blocking.unreported_count = 0
+        self.now = 1000.0
+        blocking.time = SimpleNamespace(time=lambda: self.now)
+
+        self.callbacks = []
+        self.hub = SimpleNamespace(loop=SimpleNamespace(
+            run_callback_threadsafe=lambda f, *args: self.callbacks.append((f, args)),
+        ))
+
+    def tearDown(self):
+        blocking.blocked_count, blocking.max_blocked_ms, blocking.last_report_time, blocking.unreported_count, blocking.time = self.saved
+
+    def test_counters(self):
+        on_event = generate_blocking_listener(self.hub, 300)
+        on_event(OtherEvent())
+        self.assertEqual(get_blocking_stats(), {'blocked': 0, 'max_blocked_ms': 0})
+
+        on_event(EventLoopBlocked(0.25, ['File "a.py", line 1', '  work()']))
+        on_event(EventLoopBlocked(1.5, ['File "b.py", line 2']))
+        on_event(EventLoopBlocked(0.1, ['File "c.py", line 3']))
+        self.assertEqual(get_blocking_stats(), {'blocked': 3, 'max_blocked_ms': 1500})
+
+        # The first one is reported, in the hub's thread
+        self.assertEqual(self.callbacks, [(spawn_report, (250, 'File "a.py", line 1\n  work()'))])
+
+    def test_report_interval(self):
+        on_event = generate_blocking_listener(self.hub, 300)
+
+        on_event(EventLoopBlocked(0.2, ['a']))
+        self.now += 100
+        on_event(EventLoopBlocked(0.3, ['b']))
+        self.now += 100
+        on_event(EventLoopBlocked(0.4, ['c']))
+        self.assertEqual(len(self.callbacks), 1)
+        self.assertEqual(blocking.unreported_count, 2)
+
+        # At most one report per interval
+        self.now += 100
+        on_event(EventLoopBlocked(0.5, ['d']))
+        self.assertEqual([args for f, args in self.callbacks], [(200, 'a'), (500, 'd')])
+        self.assertEqual(blocking.last_report_time, self.now)
+        self.assertEqual(get_blocking_stats(), {'blocked': 4, 'max_blocked_ms': 500})
+
+    def test_report_blocking(self):
+        reports = []
+        saved = blocking.is_ec2_instance
+        from klue_microservice import crash
+        saved_report_error = crash.report_error
+        blocking.is_ec2_instance = lambda: False
+        crash.report_error = lambda title=None, data=None: reports.append((title, data))
+        try:
+            blocking.blocked_count = 4
+            blocking.unreported_count = 2
+            blocking.report_blocking(500, 'd')
+        finally:
+            blocking.is_ec2_instance = saved
+            crash.report_error = saved_report_error
+
+        title, data = reports[0]
+        self.assertEqual(title, "gevent hub blocked for more than 500 msec")
+        self.assertEqual(data['blocking']['blocked_count'], 4)
+        self.assertEqual(data['blocking']['unreported_since_last_report'], 2)
+        self.assertEqual(data['blocking']['stack'], 'd')
+        self.assertEqual(blocking.unreported_count, 0)
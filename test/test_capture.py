@@ -0,0 +1,150 @@
+import os
+import json
+import zlib
+import shutil
+import tempfile
+import datetime
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from flask import Flask
+from klue_microservice import capture
+from klue_microservice.config import get_config
+from klue_microservice.capture import capture_request, load_captures, is_replayable, replay
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.received.append((self.command, self.path, body, self.headers.get('Authorization')))
+        status = 200 if self.path.startswith('/ok') else 500
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = reply
+    do_POST = reply
+
+    def log_message(self, *args):
+        pass
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        conf = get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.saved = (conf.capture_sample_rate, conf.capture_dir, conf.capture_max_mb, conf.capture_backups, conf.capture_bodies, capture.capture)
+        self.tmpdir = tempfile.mkdtemp()
+        conf.capture_sample_rate = 1
+        conf.capture_dir = self.tmpdir
+        conf.capture_backups = 2
+        conf.capture_bodies = True
+        capture.capture = None
+        self.app = Flask(__name__)
+        self.t0 = datetime.datetime(2017, 3, 1, 10, 24, 12, tzinfo=datetime.timezone.utc)
+        self.t1 = self.t0 + datetime.timedelta(milliseconds=12.5)
+
+    def tearDown(self):
+        conf = get_config()
+        conf.capture_sample_rate, conf.capture_dir, conf.capture_max_mb, conf.capture_backups, conf.capture_bodies, capture.capture = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def capture(self, path='/v1/users?id=1', method='POST', data=b'{"name": "bob"}', status=200):
+        with self.app.test_request_context(path, method=method, data=data, content_type='application/json', headers={'Authorization': 'Bearer xxx'}):
+            capture_request('api.do_stuff', status, self.t0, self.t1)
+
+    def test_record(self):
+        self.capture()
+        self.capture(method='GET', data=b'', status='404')
+
+        records = load_captures([self.tmpdir])
+        self.assertEqual(records[0], {
+            't': 1488363852.0,
+            'endpoint': 'api.do_stuff',
+            'method': 'POST',
+            'path': '/v1/users',
+            'query': 'id=1',
+            'auth': True,
+            'body_size': 15,
+            'body_crc': '%08x' % zlib.crc32(b'{"name": "bob"}'),
+            'body': '{"name": "bob"}',
+            'content_type': 'application/json',
+            'status': 200,
+            'ms': 12.5,
+        })
+        self.assertEqual(records[1]['status'], 404)
+        self.assertEqual(records[1]['body_size'], 0)
+        self.assertNotIn('body', records[1])
+
+    def test_rotate(self):
+        capture.get_capture().max_bytes = 1000
+        for i in range(30):
+            self.capture()
+
+        path = os.path.join(self.tmpdir, 'capture-%s.jsonl' % os.getpid())
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), sorted([
+            os.path.basename(path),
+            os.path.basename(path) + '.1',
+            os.path.basename(path) + '.2',
+        ]))
+        for p in (path, path + '.1', path + '.2'):
+            self.assertTrue(os.path.getsize(p) <= 1000)
+        # Older files beyond the backups are dropped
+        self.assertTrue(len(load_captures([self.tmpdir])) < 30)
+
+    def test_capture_error(self):
+        # Never raises, and stops capturing
+        self.capture(status='notastatus')
+        self.assertEqual(capture.capture.sample_rate, 0)
+        self.capture()
+        self.assertEqual(load_captures([self.tmpdir]), [])
+
+    def test_load_captures(self):
+        for name, times in (('capture-1.jsonl', [3, 1]), ('capture-2.jsonl.1', [2])):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                for t in times:
+                    f.write(json.dumps({'t': t}) + '\n\n')
+        with open(os.path.join(self.tmpdir, 'other.jsonl'), 'w') as f:
+            f.write(json.dumps({'t': 0}) + '\n')
+
+        self.assertEqual([r['t'] for r in load_captures([self.tmpdir])], [1, 2, 3])
+        self.assertEqual([r['t'] for r in load_captures([os.path.join(self.tmpdir, 'other.jsonl'), self.tmpdir])], [0, 1, 2, 3])
+
+    def test_is_replayable(self):
+        tests = [
+            # record, replayable
+            ({'method': 'GET', 'body_size': 0}, True),
+            ({'method': 'DELETE', 'body_size': 0}, True),
+            ({'method': 'POST', 'body_size': 12}, False),
+            ({'method': 'POST', 'body_size': 12, 'body': '{"a": "bcd"}'}, True),
+        ]
+        for r, replayable in tests:
+            self.assertEqual(is_replayable(r), replayable, r)
+
+    def test_replay(self):
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        server.received = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            records = [
+                {'t': 1, 'endpoint': 'ok', 'method': 'GET', 'path': '/ok', 'query': 'a=1', 'auth': True, 'status': 200},
+                {'t': 1.1, 'endpoint': 'ok', 'method': 'POST', 'path': '/ok', 'query': '', 'auth': False, 'status': 200, 'body': '{"a": 1}'},
+                {'t': 1.2, 'endpoint': 'ko', 'method': 'GET', 'path': '/ko', 'query': '', 'auth': False, 'status': 200},
+            ]
+            latencies, errors, seconds = replay(records, '127.0.0.1', server.server_address[1], speed=0, concurrency=2, token='tok')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(len(latencies['ok']), 2)
+        self.assertNotIn('ko', latencies)
+        self.assertEqual(errors, {'ko': 1})
+        self.assertEqual(sorted(server.received), [
+            ('GET', '/ko', b'', None),
+            ('GET', '/ok?a=1', b'', 'Bearer tok'),
+            ('POST', '/ok', b'{"a": 1}', None),
+        ])
@@ -3,7 +3,7 @@ import sys
 import logging
 import json
 import imp
-from time import sleep
+from time import sleep, time
 
 
 utils = imp.load_source('utils', os.path.join(os.path.dirname(__file__), 'utils.py'))
@@ -23,19 +23,38 @@ except:
 class Tests(utils.KlueMicroServiceTests):
 
 
-    def assertNoErrorReport(self):
+    def assertNoErrorReport(self, timeout=1):
+        # Reports are sent after the response: give them time to show up
+        t0 = time()
+        while time() - t0 < timeout:
+            self.assertFalse(os.path.isfile(reportpath))
+            sleep(0.1)
         self.assertFalse(os.path.isfile(reportpath))
 
+    def wait_for_report(self, timeout=5):
+        """Return the report's content once it has been fully written"""
+        t0 = time()
+        while True:
+            s = ''
+            if os.path.isfile(reportpath):
+                with open(reportpath) as f:
+                    s = f.read()
+            try:
+                return s, json.loads(s)
+            except ValueError:
+                # Missing or partially written
+                if time() - t0 > timeout:
+                    self.fail("No error report written to %s within %s sec" % (reportpath, timeout))
+                sleep(0.1)
+
     def load_report(self):
-        with open(reportpath) as f:
-            s = f.read()
-            log.info("GOT\n%s\n" % s)
-            j = json.loads(s)
-            log.debug("Report is %s" % json.dumps(j, indent=4))
-            title = j['title']
-            body = j['body']
-            log.info("Loaded error report [%s]" % title)
-            return title, body
+        s, j = self.wait_for_report()
+        log.info("GOT\n%s\n" % s)
+        log.debug("Report is %s" % json.dumps(j, indent=4))
+        title = j['title']
+        body = j['body']
+        log.info("Loaded error report [%s]" % title)
+        return title, body
 
 
     def assertBaseReportOk(self, path=None, user_id=None):
@@ -225,3 +244,47 @@ class Tests(utils.KlueMicroServiceTests):
         self.assertEqual(body['request']['params'], '[]')
 
         self.assertEqual(body['title'], 'klue_microservice.api.do_crash_slow_call() calltime exceeded 1000 millisec!')
+
+
+    def test_streamed_error(self):
+        j = self.assertGetReturnJson(
+            'crash/streamerror',
+            200
+        )
+        self.assertEqual(len(j), 3)
+        self.assertEqual(j[0], {})
+        self.assertEqual(j[2]['status'], 500)
+        self.assertEqual(j[2]['error'], 'UNHANDLED_SERVER_ERROR')
+        self.assertTrue('error_id' in j[2])
+
+        title, body = self.assertServerErrorReportOk(
+            path='crash/streamerror',
+        )
+        self.assertEqual(title, 'FATAL ERROR %s 500 UNHANDLED_SERVER_ERROR: klue_microservice.api.do_crash_stream_error(): Raising an exception mid-stream' % body['server']['api_name'])
+
+        self.assertEqual(body['error_id'], j[2]['error_id'])
+        self.assertEqual(body['stream']['format'], 'array')
+        self.assertEqual(body['stream']['items'], 2)
+        self.assertEqual(body['response']['status'], '500')
+        self.assertEqual(body['response']['is_error'], 1)
+
+
+    def test_streamed_slow_call(self):
+        j = self.assertGetReturnJson(
+            'crash/streamslowcall',
+            200
+        )
+        self.assertEqual(j, [{}, {}, {}])
+
+        # Reported once the stream has been sent
+        title, body = self.assertServerErrorReportOk(
+            path='crash/streamslowcall',
+            fatal=False,
+        )
+        self.assertEqual(title, 'NON-FATAL ERROR %s 200 : klue_microservice.api.do_crash_stream_slow_call() calltime exceeded 1000 millisec!' % body['server']['api_name'])
+
+        self.assertEqual(body['stream']['format'], 'array')
+        self.assertEqual(body['stream']['items'], 3)
+        self.assertEqual(body['response']['status'], '200')
+        self.assertEqual(body['response']['is_error'], 0)
+        self.assertTrue(body['time']['microsecs'] >= 1800000)
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import unittest
+from types import SimpleNamespace
+from flask import Flask
+from klue_microservice.config import get_config
+from klue_microservice.exceptions import DeadlineExceededError
+from klue_microservice.deadline import deadline, generate_deadline_decorator, deadline_client_decorator, get_remaining_ms, stack
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.app = Flask(__name__)
+        self.deadline_control = generate_deadline_decorator()
+
+    def call(self, f, headers={}):
+        with self.app.test_request_context('/', headers=headers):
+            return self.deadline_control(f)()
+
+    def test_deadline_header(self):
+        def do_get_remaining_ms():
+            return get_remaining_ms()
+
+        tests = [
+            # header, min and max remaining msec
+            ({'KlueCallTimeout': '500'}, 400, 500),
+            ({'KlueCallTimeout': '2000.5'}, 1900, 2001),
+            ({'KlueCallTimeout': 'notanumber'}, None, None),
+            ({}, None, None),
+        ]
+        for headers, min_ms, max_ms in tests:
+            ms = self.call(do_get_remaining_ms, headers)
+            if min_ms is None:
+                self.assertIsNone(ms, headers)
+            else:
+                self.assertTrue(min_ms < ms <= max_ms, "%s: %s" % (headers, ms))
+
+        # The endpoint's own deadline applies if it is shorter
+        @deadline(max_ms=100)
+        def do_get_remaining_ms_fast():
+            return get_remaining_ms()
+
+        self.assertTrue(0 < self.call(do_get_remaining_ms_fast, {'KlueCallTimeout': '500'}) <= 100)
+        self.assertTrue(0 < self.call(do_get_remaining_ms_fast) <= 100)
+
+    def test_deadline_exceeded(self):
+        def do_nothing():
+            self.fail("Should not be called")
+
+        for header in ('0', '-10'):
+            r = self.call(do_nothing, {'KlueCallTimeout': header})
+            self.assertEqual(r.status_code, 504)
+            self.assertEqual(json.loads(r.get_data().decode('utf-8'))['error'], 'DEADLINE_EXCEEDED')
+
+    def test_deadline_propagation(self):
+        api = SimpleNamespace(name='test', client_timeout=10, error_callback=lambda e: e)
+
+        def call_api(**kwargs):
+            return kwargs
+
+        caller = deadline_client_decorator(api, 'call_api', call_api)
+
+        # Not serving a request: no deadline to propagate
+        self.assertEqual(caller(), {})
+
+        with self.app.test_request_context('/'):
+            stack.top.deadline = time.time() + 2
+            headers = {'X-Foo': 'bar'}
+            kwargs = caller(request_headers=headers, read_timeout=30)
+            self.assertEqual(kwargs['request_headers']['X-Foo'], 'bar')
+            self.assertTrue(1900 < int(kwargs['request_headers']['KlueCallTimeout']) <= 2000)
+            self.assertTrue(kwargs['read_timeout'] <= 2)
+            self.assertTrue(kwargs['connect_timeout'] <= 2)
+            # The caller's headers are left untouched
+            self.assertEqual(headers, {'X-Foo': 'bar'})
+
+            stack.top.deadline = time.time() - 1
+            self.assertIsInstance(caller(), DeadlineExceededError)
@@ -0,0 +1,83 @@
+import json
+import logging
+import unittest
+from klue_microservice import exceptions
+from klue_microservice.serializer import dumpb
+from klue_microservice.exceptions import InternalServerError, AuthTokenExpiredError, warn_error
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (exceptions.WARNING_INTERVAL, dict(exceptions.last_warnings))
+        exceptions.last_warnings.clear()
+
+    def tearDown(self):
+        exceptions.WARNING_INTERVAL, last_warnings = self.saved
+        exceptions.last_warnings.clear()
+        exceptions.last_warnings.update(last_warnings)
+
+    def assertSameReply(self, e):
+        r = e.http_reply()
+        # The reply is the same json, byte for byte, as encoding the error's dict
+        data = e.to_dict()
+        data['error_id'] = e.error_id or r.klue_error_id
+        self.assertEqual(r.get_data(), dumpb(data))
+        self.assertEqual(r.klue_error, data)
+        self.assertEqual(r.status, '%s %s' % (e.status, {500: 'INTERNAL SERVER ERROR', 401: 'UNAUTHORIZED'}[e.status]))
+        self.assertEqual(r.status_code, e.status)
+        self.assertEqual(r.headers['Content-Type'], 'application/json')
+        return r, json.loads(r.get_data().decode('utf-8'))
+
+    def test_http_reply(self):
+        r, j = self.assertSameReply(InternalServerError("Something broke: \"quotes\", é and </script>"))
+        self.assertEqual(sorted(j.keys()), ['error', 'error_description', 'error_id', 'status'])
+        self.assertEqual(j['error_description'], "Something broke: \"quotes\", é and </script>")
+        self.assertEqual(j['error_id'], r.klue_error_id)
+
+        r, j = self.assertSameReply(AuthTokenExpiredError("Token expired"))
+        self.assertEqual((j['status'], j['error']), (401, 'TOKEN_EXPIRED'))
+
+    def test_http_reply_forwarded(self):
+        # An error forwarded from another micro-service keeps its error_id
+        e = InternalServerError("Forwarded")
+        e.error_id = '1234'
+        r, j = self.assertSameReply(e)
+        self.assertEqual(j['error_id'], '1234')
+        self.assertEqual(r.klue_error_id, '')
+
+    def test_http_reply_user_message(self):
+        r, j = self.assertSameReply(InternalServerError("Oops").tell_user("Try again later"))
+        self.assertEqual(j['user_message'], "Try again later")
+
+        r, j = self.assertSameReply(InternalServerError("Oops").caught(ValueError("bad value")))
+        self.assertEqual(j['error_caught'], "ValueError('bad value')")
+
+        e = InternalServerError("Oops").tell_user("Try again later").caught(ValueError("bad value"))
+        e.error_id = '1234'
+        r, j = self.assertSameReply(e)
+        self.assertEqual(sorted(j.keys()), ['error', 'error_caught', 'error_description', 'error_id', 'status', 'user_message'])
+
+    def test_warn_error(self):
+        exceptions.WARNING_INTERVAL = 3600
+        with self.assertLogs('klue_microservice.exceptions', level='WARNING') as logs:
+            for i in range(5):
+                warn_error(500, 'SERVER_ERROR', 'Boom %s' % i)
+            warn_error(401, 'TOKEN_EXPIRED', 'Expired')
+
+        # One warning per code per interval
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(logs.records[0].getMessage(), 'ERROR: caught error 500 SERVER_ERROR [Boom 0]')
+        self.assertEqual(logs.records[1].getMessage(), 'ERROR: caught error 401 TOKEN_EXPIRED [Expired]')
+        self.assertEqual(exceptions.last_warnings['SERVER_ERROR'][1], 4)
+        self.assertEqual(exceptions.last_warnings['TOKEN_EXPIRED'][1], 0)
+
+        # The next warning tells how many were skipped
+        exceptions.WARNING_INTERVAL = 0
+        with self.assertLogs('klue_microservice.exceptions', level='WARNING') as logs:
+            warn_error(500, 'SERVER_ERROR', 'Boom 5')
+            warn_error(500, 'SERVER_ERROR', 'Boom 6')
+        self.assertEqual([r.getMessage() for r in logs.records], [
+            'ERROR: caught error 500 SERVER_ERROR [Boom 5] (4 more since last warning)',
+            'ERROR: caught error 500 SERVER_ERROR [Boom 6]',
+        ])
@@ -0,0 +1,68 @@
+import os
+import imp
+import logging
+from klue_microservice.config import get_config
+from klue_microservice.auth import generate_token
+from klue_microservice.test import load_app
+
+
+utils = imp.load_source('utils', os.path.join(os.path.dirname(__file__), 'utils.py'))
+
+
+log = logging.getLogger(__name__)
+
+
+# Headers set by the http server itself, not by the app
+server_headers = ['date', 'server', 'connection', 'keep-alive']
+
+
+class Tests(utils.KlueMicroServiceTests):
+
+    def setUp(self):
+        super().setUp()
+        self.kill_server()
+        self.start_server()
+        get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.token = generate_token(user_id='killroy was here')
+
+    def call(self, path, headers, in_process):
+        """Call the test server over http, or in-process"""
+        if in_process:
+            self.app = load_app(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testserver.py'))
+            self.host, self.port = 'localhost', 80
+        else:
+            self.app = None
+            self.host, self.port = '127.0.0.1', 8765
+        url = "http://%s:%s/%s" % (self.host, self.port, path)
+        return self._try('get', url, dict(headers), None, verify_ssl=False)
+
+    def test_in_process_same_as_http(self):
+        tests = [
+            # path, headers
+            ('ping', {}),
+            ('version', {}),
+            ('auth/version', {}),
+            ('auth/version', {'Authorization': 'Bearer %s' % self.token}),
+            ('crash/klueexception', {}),
+            ('crash/returnerrormodel', {}),
+            ('crash/internalexception', {}),
+        ]
+
+        for path, headers in tests:
+            r_http = self.call(path, headers, False)
+            r_in_process = self.call(path, headers, True)
+
+            self.assertEqual(r_in_process.status_code, r_http.status_code, path)
+            self.assertEqual(r_in_process.headers.get('Content-Type'), r_http.headers.get('Content-Type'), path)
+            self.assertEqual(
+                sorted(k.lower() for k in r_in_process.headers.keys() if k.lower() not in server_headers),
+                sorted(k.lower() for k in r_http.headers.keys() if k.lower() not in server_headers),
+                path,
+            )
+
+            j_http, j_in_process = r_http.json(), r_in_process.json()
+            if 'error_id' in j_http:
+                # Unique to each call
+                del j_http['error_id']
+                del j_in_process['error_id']
+            self.assertEqual(j_in_process, j_http, path)
@@ -0,0 +1,205 @@
+import io
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+import importlib
+from flask import Flask
+from klue_microservice.log import LogPolicy, set_log_policy, get_dropped_count, DeferredQueueHandler, JsonFormatter, context_filter
+
+# klue_microservice.log is shadowed by the package's own logger
+klue_log = importlib.import_module('klue_microservice.log')
+
+
+def make_record(name, msg, args=(), level=logging.INFO, created=1000.0):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.created = created
+    return record
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_levels = {name: logging.getLogger(name).level for name in ('test.a', 'test.a.b')}
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name, level in self.saved_levels.items():
+            logging.getLogger(name).setLevel(level)
+        set_log_policy()
+        if klue_log.queue_handler:
+            klue_log.stop_listener()
+            klue_log.root.removeHandler(klue_log.queue_handler)
+            klue_log.root.addHandler(klue_log.ch)
+            klue_log.queue_handler = None
+        klue_log.set_format('text')
+        shutil.rmtree(self.tmpdir)
+
+    def test_levels(self):
+        set_log_policy(levels={'test.a': 'warning', 'test.a.b': logging.DEBUG})
+        self.assertEqual(logging.getLogger('test.a').level, logging.WARNING)
+        self.assertEqual(logging.getLogger('test.a.b').level, logging.DEBUG)
+        self.assertFalse(logging.getLogger('test.a.c').isEnabledFor(logging.INFO))
+        self.assertTrue(logging.getLogger('test.a.b').isEnabledFor(logging.DEBUG))
+        # Levels alone need no filter
+        self.assertIsNone(klue_log.policy)
+
+    def test_get_rule(self):
+        p = LogPolicy(sampling={'test.a': 10, 'test': 0}, rate_limits={'test.a.b': 5})
+        tests = [
+            # logger name, (1-in-N, rate limit)
+            ('test.a', (10, 0)),
+            ('test.a.c.d', (10, 0)),
+            # The closest rule wins, and does not inherit its parent's
+            ('test.a.b', (1, 5)),
+            ('test.other', (1, 0)),
+            ('other', (1, 0)),
+        ]
+        for name, rule in tests:
+            self.assertEqual(p.get_rule(name), rule, name)
+
+    def test_sampling(self):
+        p = LogPolicy(sampling={'test.a': 3})
+        kept = [p.filter(make_record('test.a', "Doing %s", (i,))) for i in range(7)]
+        # 1 in 3 per template, starting with the first
+        self.assertEqual(kept, [True, False, False, True, False, False, True])
+        self.assertTrue(p.filter(make_record('test.a', "Doing something else")))
+        self.assertEqual(p.dropped, 4)
+
+        # Other loggers are left alone
+        self.assertTrue(all(p.filter(make_record('test.b', "Doing %s", (i,))) for i in range(3)))
+
+    def test_rate_limit(self):
+        p = LogPolicy(rate_limits={'test.a': 2})
+        kept = [p.filter(make_record('test.a', "Doing %s", (i,), created=1000 + i * 0.1)) for i in range(5)]
+        self.assertEqual(kept, [True, True, False, False, False])
+        # Per template
+        self.assertTrue(p.filter(make_record('test.a', "Done %s", (1,), created=1000.5)))
+        # Until the next second
+        self.assertTrue(p.filter(make_record('test.a', "Doing %s", (5,), created=1001)))
+        self.assertEqual(p.dropped, 3)
+
+    def test_warnings_pass(self):
+        p = LogPolicy(sampling={'test.a': 100}, rate_limits={'test.a': 1})
+        for level in (logging.WARNING, logging.ERROR, logging.CRITICAL):
+            for i in range(5):
+                self.assertTrue(p.filter(make_record('test.a', "Failed %s", (i,), level=level)))
+        self.assertEqual(p.dropped, 0)
+
+    def test_set_log_policy(self):
+        set_log_policy(sampling={'test.a': 2})
+        self.assertIn(klue_log.policy, klue_log.ch.filters)
+
+        logger = logging.getLogger('test.a')
+        logger.setLevel(logging.INFO)
+        stream = klue_log.ch.setStream(io.StringIO())
+        try:
+            for i in range(4):
+                logger.info("Doing %s", i)
+        finally:
+            out = klue_log.ch.setStream(stream).getvalue()
+        self.assertIn("Doing 0", out)
+        self.assertNotIn("Doing 1", out)
+        self.assertIn("Doing 2", out)
+        self.assertEqual(get_dropped_count(), 2)
+
+        policy = klue_log.policy
+        set_log_policy()
+        self.assertIsNone(klue_log.policy)
+        self.assertNotIn(policy, klue_log.ch.filters)
+        self.assertEqual(get_dropped_count(), 0)
+
+    def test_deferred_queue_handler(self):
+        handler = DeferredQueueHandler(None)
+        args = {'name': 'bob'}
+        record = make_record('test.a', "Saving user %s", (args,))
+        record = handler.prepare(record)
+        # Interpolated when enqueued, whatever happens to the args later
+        args['name'] = 'alice'
+        self.assertEqual(record.msg, "Saving user {'name': 'bob'}")
+        self.assertIsNone(record.args)
+        self.assertEqual(record.getMessage(), "Saving user {'name': 'bob'}")
+
+        # But the exception is left for the listener to format
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record('test.a', "Failed")
+            record.exc_info = sys.exc_info()
+        record = handler.prepare(record)
+        self.assertIsNotNone(record.exc_info)
+        self.assertIsNone(record.exc_text)
+
+    def test_json_formatter(self):
+        app = Flask(__name__)
+        with app.test_request_context('/'):
+            top = klue_log.stack.top
+            top.call_id = '1234-5678'
+            top.endpoint = 'do_stuff'
+            record = make_record('test.a', "Doing %s", ('stuff',))
+            context_filter.filter(record)
+
+        j = json.loads(JsonFormatter().format(record))
+        self.assertEqual(j['message'], 'Doing stuff')
+        self.assertEqual(j['level'], 'INFO')
+        self.assertEqual(j['logger'], 'test.a')
+        self.assertEqual(j['pid'], os.getpid())
+        self.assertEqual(j['call_id'], '1234-5678')
+        self.assertEqual(j['endpoint'], 'do_stuff')
+        self.assertNotIn('exception', j)
+
+        # Outside of a request
+        record = make_record('test.a', "Idle")
+        context_filter.filter(record)
+        j = json.loads(JsonFormatter().format(record))
+        self.assertEqual((j['call_id'], j['endpoint']), ('', ''))
+
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record('test.a', "Failed")
+            record.exc_info = sys.exc_info()
+        j = json.loads(JsonFormatter().format(record))
+        self.assertIn('ValueError: boom', j['exception'])
+
+    def test_async_logging(self):
+        path = os.path.join(self.tmpdir, 'log.json')
+        logger = logging.getLogger('test.a')
+        logger.setLevel(logging.INFO)
+
+        with open(path, 'w') as f:
+            stream = klue_log.ch.setStream(f)
+            try:
+                klue_log.set_format('json')
+                klue_log.enable_async_logging()
+                self.assertNotIn(klue_log.ch, klue_log.root.handlers)
+
+                pid = os.fork()
+                if pid == 0:
+                    # The hook registered with os.register_at_fork gave the
+                    # child a listener of its own
+                    status = 1
+                    try:
+                        if klue_log.listener and klue_log.listener._thread.is_alive():
+                            logger.info("Child %s", 2)
+                            klue_log.stop_listener()
+                            status = 0
+                    finally:
+                        os._exit(status)
+
+                logger.info("Parent %s", 1)
+                _, status = os.waitpid(pid, 0)
+                self.assertEqual(status, 0)
+                klue_log.stop_listener()
+            finally:
+                klue_log.ch.setStream(stream)
+
+        with open(path) as f:
+            lines = [json.loads(l) for l in f.readlines()]
+        self.assertEqual(sorted((l['message'], l['pid']) for l in lines), [
+            ('Child 2', pid),
+            ('Parent 1', os.getpid()),
+        ])
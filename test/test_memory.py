@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import unittest
+from klue_microservice import memory
+from klue_microservice.memory import get_memory_usage, get_rss, get_children, format_memory_usage, memory_report
+
+
+SMAPS_ROLLUP = """559cccd59000-7fff836d7000 ---p 00000000 00:00 0                          [rollup]
+Rss:              102400 kB
+Pss:               61440 kB
+Pss_Dirty:         20480 kB
+Pss_Anon:          20480 kB
+Pss_File:          40960 kB
+Pss_Shmem:             0 kB
+Shared_Clean:      61440 kB
+Shared_Dirty:      20480 kB
+Private_Clean:      4096 kB
+Private_Dirty:     16384 kB
+Referenced:       102400 kB
+Anonymous:         36864 kB
+LazyFree:              0 kB
+Swap:                  0 kB
+SwapPss:               0 kB
+Locked:                0 kB
+"""
+
+MB = 1024 * 1024
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = memory.PROC_DIR
+        memory.PROC_DIR = self.tmpdir
+
+    def tearDown(self):
+        memory.PROC_DIR = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, pid, name, content):
+        path = os.path.join(self.tmpdir, str(pid), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_smaps_rollup(self):
+        self.write(12, 'smaps_rollup', SMAPS_ROLLUP)
+        self.assertEqual(get_memory_usage(12), {
+            'pid': 12,
+            'rss': 100 * MB,
+            'pss': 60 * MB,
+            'unique': 20 * MB,
+            'shared': 80 * MB,
+        })
+        self.assertEqual(format_memory_usage(get_memory_usage(12)), "pid 12: rss 100.0MB, pss 60.0MB, unique 20.0MB, shared 80.0MB")
+
+    def test_statm(self):
+        # Kernels older than 4.14 have no smaps_rollup
+        page = os.sysconf('SC_PAGE_SIZE')
+        self.write(12, 'statm', '50000 2560 1024 100 0 3000 0\n')
+        self.assertEqual(get_memory_usage(12), {
+            'pid': 12,
+            'rss': 2560 * page,
+            'pss': None,
+            'unique': 1536 * page,
+            'shared': 1024 * page,
+        })
+        self.assertEqual(get_rss(12), 2560 * page)
+        self.assertIn('pss ?MB', format_memory_usage(get_memory_usage(12)))
+
+    def test_unreadable(self):
+        self.assertIsNone(get_memory_usage(12))
+        self.assertIsNone(get_rss(12))
+        self.write(12, 'statm', 'garbage')
+        self.assertIsNone(get_memory_usage(12))
+        self.assertIsNone(get_rss(12))
+
+    def test_memory_report(self):
+        self.write(10, 'smaps_rollup', SMAPS_ROLLUP)
+        self.write(10, 'stat', '10 (gunicorn: master) S 1 10 10 0 -1\n')
+        for pid in (11, 12):
+            self.write(pid, 'smaps_rollup', SMAPS_ROLLUP)
+            # Command names may contain spaces and parentheses
+            self.write(pid, 'stat', '%s (gunicorn: worker (app)) S 10 10 10 0 -1\n' % pid)
+        self.write(13, 'stat', '13 (bash) S 1 13 13 0 -1\n')
+        os.makedirs(os.path.join(self.tmpdir, 'sys'))
+
+        self.assertEqual(get_children(10), [11, 12])
+        lines = memory_report(10).split('\n')
+        self.assertEqual([l.split()[0] for l in lines[0:3]], ['master', 'worker', 'worker'])
+        self.assertEqual(lines[3], "total unique memory of workers: 40.0MB")
+
+    def test_self(self):
+        memory.PROC_DIR = self.saved
+        usage = get_memory_usage()
+        if usage is None:
+            self.skipTest("No /proc on this platform")
+        self.assertEqual(usage['pid'], os.getpid())
+        self.assertTrue(usage['rss'] > 0)
+        self.assertTrue(get_rss() > 0)
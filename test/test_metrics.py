@@ -0,0 +1,98 @@
+import socket
+import unittest
+from types import SimpleNamespace
+from klue_microservice import blocking
+from klue_microservice.metrics import MetricsEmitter
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        # A local UDP listener standing in for the StatsD agent
+        self.agent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.agent.bind(('127.0.0.1', 0))
+        self.agent.settimeout(2)
+
+    def tearDown(self):
+        self.agent.close()
+
+    def get_emitter(self, dogstatsd=True, max_samples=50, max_packet_bytes=1432):
+        return MetricsEmitter(SimpleNamespace(
+            statsd_host='127.0.0.1',
+            statsd_port=self.agent.getsockname()[1],
+            statsd_prefix='klue',
+            statsd_tags={'service': 'test'},
+            statsd_dogstatsd=dogstatsd,
+            statsd_flush_interval_sec=3600,
+            statsd_max_timer_samples=max_samples,
+            statsd_max_packet_bytes=max_packet_bytes,
+        ))
+
+    def receive(self):
+        lines = []
+        self.agent.settimeout(0.5)
+        try:
+            while True:
+                lines += self.agent.recv(65536).decode('utf-8').split('\n')
+        except socket.timeout:
+            pass
+        return lines
+
+    def test_dogstatsd(self):
+        e = self.get_emitter()
+        e.record('api.do_ping', 200, 1.5)
+        e.record('api.do_ping', 200, 2.5)
+        e.record('api.do_ping', 500, 10)
+        e.flush()
+
+        lines = self.receive()
+        self.assertEqual(sorted(lines), [
+            'klue.calls:1|c|#endpoint:api.do_ping,status:500,service:test',
+            'klue.calls:2|c|#endpoint:api.do_ping,status:200,service:test',
+            'klue.latency:1.5|ms|#endpoint:api.do_ping,status:200,service:test',
+            'klue.latency:10|ms|#endpoint:api.do_ping,status:500,service:test',
+            'klue.latency:2.5|ms|#endpoint:api.do_ping,status:200,service:test',
+        ])
+
+        # Aggregates are reset at each flush
+        e.flush()
+        self.assertEqual(self.receive(), [])
+
+    def test_plain_statsd(self):
+        e = self.get_emitter(dogstatsd=False)
+        e.record('api.do_ping', 200, 1)
+        e.flush()
+        self.assertEqual(sorted(self.receive()), [
+            'klue.calls.api_do_ping.200.test:1|c',
+            'klue.latency.api_do_ping.200.test:1|ms',
+        ])
+
+    def test_sampled_latencies(self):
+        e = self.get_emitter(max_samples=10, max_packet_bytes=512)
+        for i in range(1000):
+            e.record('api.do_ping', 200, i)
+        e.flush()
+
+        lines = self.receive()
+        self.assertIn('klue.calls:1000|c|#endpoint:api.do_ping,status:200,service:test', lines)
+        latencies = [l for l in lines if l.startswith('klue.latency:')]
+        self.assertEqual(len(latencies), 10)
+        for l in latencies:
+            self.assertIn('|ms|@0.01|#', l)
+
+    def test_hub_blocking(self):
+        e = self.get_emitter()
+        blocking.blocked_count, blocking.max_blocked_ms = 3, 250
+        try:
+            e.flush()
+            self.assertEqual(sorted(self.receive()), [
+                'klue.hub.blocked:3|c|#service:test',
+                'klue.hub.max_blocked_ms:250|g|#service:test',
+            ])
+
+            # Only new blocks are counted at the next flush
+            blocking.blocked_count = 4
+            e.flush()
+            self.assertIn('klue.hub.blocked:1|c|#service:test', self.receive())
+        finally:
+            blocking.blocked_count, blocking.max_blocked_ms = 0, 0
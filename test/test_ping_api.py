@@ -44,3 +44,13 @@ class Tests(utils.KlueMicroServiceTests):
         self.token = generate_token(user_id='killroy was here')
 
         self.assertHasAuthVersion(verify_ssl=self.verify_ssl)
+
+    def test_health(self):
+        self.assertHasPing()
+        j = self.assertGetReturnJson('health', 200, verify_ssl=self.verify_ssl)
+        self.assertTrue(j['healthy'])
+        self.assertEqual(j['breaches'], [])
+        self.assertEqual(j['inflight'], 0)
+        # Pings are not counted
+        self.assertEqual(j['calls'], 0)
+        self.assertEqual(j['hub'], {'blocked': 0, 'max_blocked_ms': 0})
@@ -0,0 +1,37 @@
+import os
+import gc
+import sys
+import unittest
+from klue_microservice import preload
+from klue_microservice.config import get_config
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.saved = preload.is_preloaded
+        preload.is_preloaded = False
+
+    def tearDown(self):
+        preload.is_preloaded = self.saved
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    def test_preload(self):
+        preload.preload()
+        self.assertTrue(preload.is_preloaded)
+        for name in ('exceptions', 'auth', 'crash', 'stream', 'admission', 'deadline', 'client', 'tracing'):
+            self.assertIn('klue_microservice.%s' % name, sys.modules)
+
+        from klue_microservice import tracing
+        self.assertIsNotNone(tracing.tracer)
+
+        # Only once
+        preload.preload()
+
+    def test_freeze(self):
+        if not hasattr(gc, 'freeze'):
+            self.skipTest("gc.freeze requires python 3.7")
+        preload.freeze()
+        self.assertTrue(gc.get_freeze_count() > 0)
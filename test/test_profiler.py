@@ -0,0 +1,149 @@
+import os
+import time
+import json
+import yaml
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+from flask import Flask
+from klue_microservice import profiler
+from klue_microservice.config import get_config
+from klue_microservice.exceptions import ProfilerBusyError
+from klue_microservice.profiler import SamplingProfiler, collapse, start_profiler, install_profile_signal
+
+
+def wait_here(event):
+    event.wait(5)
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        conf = get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.saved = (conf.profile_signal_seconds, conf.profile_max_seconds, profiler.PROFILE_FILE, profiler.current_profiler)
+        self.tmpdir = tempfile.mkdtemp()
+        profiler.PROFILE_FILE = os.path.join(self.tmpdir, 'klue-profile-%s-%d.folded')
+        profiler.current_profiler = None
+
+    def tearDown(self):
+        while profiler.is_profiling():
+            time.sleep(0.01)
+        conf = get_config()
+        conf.profile_signal_seconds, conf.profile_max_seconds, profiler.PROFILE_FILE, profiler.current_profiler = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for(self, condition, timeout=5):
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("Timed out")
+
+    def test_collapse(self):
+        frame = None
+
+        def inner():
+            nonlocal frame
+            frame = __import__('sys')._getframe()
+
+        def outer():
+            inner()
+
+        outer()
+        stack = collapse(frame).split(';')
+        self.assertEqual([s.rsplit(':', 1)[0] for s in stack[-3:]], [
+            'test_profiler.py:test_collapse',
+            'test_profiler.py:outer',
+            'test_profiler.py:inner',
+        ])
+        self.assertTrue(all(s.rsplit(':', 1)[1].isdigit() for s in stack))
+
+    def test_collapsed_stacks(self):
+        event = threading.Event()
+        t = threading.Thread(target=wait_here, args=(event,), name='waiter')
+        t.start()
+        try:
+            p = SamplingProfiler(0)
+            names = dict([(th.ident, th.name) for th in threading.enumerate()])
+            for i in range(3):
+                p.sample(threading.get_ident(), names)
+        finally:
+            event.set()
+            t.join()
+
+        self.assertEqual(p.samples, 3)
+        lines = p.get_collapsed_stacks().split('\n')
+        waiter = [l for l in lines if l.startswith('waiter;')]
+        self.assertEqual(len(waiter), 1)
+        stack, count = waiter[0].rsplit(' ', 1)
+        self.assertEqual(count, '3')
+        self.assertIn(';test_profiler.py:wait_here:', stack)
+        # The sampling thread itself is left out
+        self.assertFalse([l for l in lines if ':test_collapsed_stacks:' in l])
+        # Most frequent first
+        counts = [int(l.rsplit(' ', 1)[1]) for l in lines]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_one_profiling_at_a_time(self):
+        p = start_profiler(0.2)
+        self.assertIsNotNone(p)
+        self.assertIsNone(start_profiler(0.2))
+        self.wait_for(lambda: p.is_done)
+        self.assertTrue(p.samples > 0)
+
+        done = []
+        p = start_profiler(0.1, then=done.append)
+        self.wait_for(lambda: done == [p])
+
+    def test_debug_profile(self):
+        from klue_microservice.api import do_debug_profile
+        get_config().profile_max_seconds = 0.2
+        app = Flask(__name__)
+        with app.test_request_context('/'):
+            t0 = time.time()
+            j = json.loads(do_debug_profile(seconds=60).get_data().decode('utf-8'))
+            # Capped at profile_max_seconds
+            self.assertTrue(time.time() - t0 < 5)
+            self.assertEqual(j['seconds'], 0.2)
+            self.assertEqual(j['pid'], os.getpid())
+            self.assertTrue(j['samples'] > 0)
+            self.assertIn(';test_profiler.py:test_debug_profile:', j['stacks'])
+
+            p = start_profiler(0.2)
+            with self.assertRaises(ProfilerBusyError):
+                do_debug_profile(seconds=1)
+            self.wait_for(lambda: p.is_done)
+
+    def test_debug_api_requires_auth(self):
+        path = os.path.join(os.path.dirname(profiler.__file__), 'debug.yaml')
+        with open(path) as f:
+            spec = yaml.safe_load(f)
+        self.assertIn('/debug/profile', spec['paths'])
+        for p, methods in spec['paths'].items():
+            for method, op in methods.items():
+                self.assertEqual(op.get('x-decorate-server'), 'klue_microservice.auth.requires_auth', (p, method))
+
+    def test_profile_signal(self):
+        get_config().profile_signal_seconds = 0.3
+        saved = signal.getsignal(signal.SIGUSR2)
+        install_profile_signal()
+        try:
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.wait_for(profiler.is_profiling)
+            # Ignored while profiling
+            first = profiler.current_profiler
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertIs(profiler.current_profiler, first)
+            self.wait_for(lambda: os.listdir(self.tmpdir))
+        finally:
+            signal.signal(signal.SIGUSR2, saved)
+
+        time.sleep(0.1)
+        files = os.listdir(self.tmpdir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('klue-profile-%s-' % os.getpid()))
+        with open(os.path.join(self.tmpdir, files[0])) as f:
+            self.assertIn('test_profiler.py:test_profile_signal:', f.read())
@@ -0,0 +1,160 @@
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from klue_microservice import recycle
+from klue_microservice.recycle import MemoryRecycler, MB
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = recycle.get_rss
+        self.rss = 100 * MB
+        recycle.get_rss = lambda: self.rss
+
+    def tearDown(self):
+        recycle.get_rss = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def get_recycler(self, max_rss_mb=0, growth_percent=0, warmup=10, check_every=5, min_interval=60):
+        r = MemoryRecycler(SimpleNamespace(
+            worker_max_rss_mb=max_rss_mb,
+            worker_max_rss_growth_percent=growth_percent,
+            worker_warmup_requests=warmup,
+            worker_rss_check_every=check_every,
+            worker_recycle_min_interval_sec=min_interval,
+        ))
+        r.lock_path = os.path.join(self.tmpdir, 'klue-recycle.lock')
+        # No jitter, and checks on multiples of check_every
+        r.requests = 0
+        r.jitter = 1
+        return r
+
+    def serve(self, r, worker, n):
+        for i in range(n):
+            r.check(worker)
+
+    def test_is_enabled(self):
+        self.assertFalse(self.get_recycler().is_enabled())
+        self.assertTrue(self.get_recycler(max_rss_mb=500).is_enabled())
+        self.assertTrue(self.get_recycler(growth_percent=50).is_enabled())
+
+    def test_jitter(self):
+        conf = SimpleNamespace(
+            worker_max_rss_mb=500,
+            worker_max_rss_growth_percent=0,
+            worker_warmup_requests=0,
+            worker_rss_check_every=20,
+            worker_recycle_min_interval_sec=0,
+        )
+        recyclers = [MemoryRecycler(conf) for i in range(50)]
+        for r in recyclers:
+            # Workers check on different requests
+            self.assertTrue(0 <= r.requests < 20)
+            # And have slightly different limits
+            self.assertTrue(1 <= r.jitter <= 1.05)
+            self.assertTrue(500 * MB <= r.get_limit() <= 525 * MB)
+        self.assertTrue(len(set(r.requests for r in recyclers)) > 1)
+        self.assertTrue(len(set(r.jitter for r in recyclers)) > 1)
+
+    def test_check_every(self):
+        calls = []
+        recycle.get_rss = lambda: calls.append(1) or self.rss
+        r = self.get_recycler(max_rss_mb=500, check_every=5)
+        self.serve(r, SimpleNamespace(alive=True), 23)
+        self.assertEqual(len(calls), 4)
+
+    def test_max_rss(self):
+        r = self.get_recycler(max_rss_mb=150, warmup=10, check_every=5)
+        worker = SimpleNamespace(alive=True)
+
+        self.serve(r, worker, 10)
+        self.assertEqual(r.baseline, 100 * MB)
+
+        self.rss = 150 * MB
+        self.serve(r, worker, 10)
+        self.assertTrue(worker.alive)
+
+        self.rss = 151 * MB
+        self.serve(r, worker, 4)
+        self.assertTrue(worker.alive)
+        self.serve(r, worker, 1)
+        self.assertFalse(worker.alive)
+        self.assertTrue(r.is_recycling)
+
+    def test_growth_percent(self):
+        r = self.get_recycler(growth_percent=50, warmup=10, check_every=5)
+        worker = SimpleNamespace(alive=True)
+
+        # Not before warmup, however large the worker
+        self.rss = 1000 * MB
+        self.serve(r, worker, 5)
+        self.assertIsNone(r.baseline)
+        self.assertIsNone(r.get_limit())
+
+        self.rss = 200 * MB
+        self.serve(r, worker, 5)
+        self.assertEqual(r.baseline, 200 * MB)
+        self.assertEqual(r.get_limit(), 300 * MB)
+
+        self.rss = 300 * MB
+        self.serve(r, worker, 20)
+        self.assertTrue(worker.alive)
+
+        self.rss = 301 * MB
+        self.serve(r, worker, 5)
+        self.assertFalse(worker.alive)
+
+    def test_both_limits(self):
+        r = self.get_recycler(max_rss_mb=250, growth_percent=50)
+        r.baseline = 200 * MB
+        # The lowest wins
+        self.assertEqual(r.get_limit(), 250 * MB)
+        r.baseline = 100 * MB
+        self.assertEqual(r.get_limit(), 150 * MB)
+
+    def test_one_recycle_per_interval(self):
+        r1 = self.get_recycler(min_interval=60)
+        r2 = self.get_recycler(min_interval=60)
+        self.assertTrue(r1.acquire_recycle_slot())
+        self.assertFalse(r2.acquire_recycle_slot())
+
+        # Once the interval has passed
+        with open(r1.lock_path, 'w') as f:
+            f.write(str(time.time() - 61))
+        self.assertTrue(r2.acquire_recycle_slot())
+
+        # And never while an other worker holds the lock
+        with open(r1.lock_path, 'w') as f:
+            f.write(str(time.time() - 61))
+        with open(r1.lock_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertFalse(r2.acquire_recycle_slot())
+
+    def test_recycle_waits_for_slot(self):
+        r1 = self.get_recycler(max_rss_mb=150, warmup=0, check_every=1)
+        r2 = self.get_recycler(max_rss_mb=150, warmup=0, check_every=1)
+        w1 = SimpleNamespace(alive=True)
+        w2 = SimpleNamespace(alive=True)
+
+        # Record the baselines
+        r1.check(w1)
+        r2.check(w2)
+
+        self.rss = 200 * MB
+        r1.check(w1)
+        self.assertFalse(w1.alive)
+        r2.check(w2)
+        self.assertTrue(w2.alive)
+        self.assertFalse(r2.is_recycling)
+
+    def test_lock_error(self):
+        r = self.get_recycler()
+        r.lock_path = os.path.join(self.tmpdir, 'nosuchdir', 'klue-recycle.lock')
+        # Recycle anyway rather than never
+        self.assertTrue(r.acquire_recycle_slot())
@@ -0,0 +1,66 @@
+import json
+import unittest
+from klue_microservice import serializer
+from klue_microservice.serializer import set_serializer, get_serializer, dumpb, dumps, loads
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = get_serializer()
+
+    def tearDown(self):
+        set_serializer(self.saved)
+
+    def test_set_serializer(self):
+        # The fastest available by default
+        set_serializer()
+        for name in ('orjson', 'ujson', 'json'):
+            if name in serializer.serializers:
+                break
+        self.assertEqual(get_serializer(), name)
+
+        set_serializer('json')
+        self.assertEqual(get_serializer(), 'json')
+
+        with self.assertRaises(Exception):
+            set_serializer('nosuchjson')
+
+    def test_dumpb(self):
+        data = {'b': [1, 2.5, None, True], 'a': {'c': "é and </script>"}}
+        for name in serializer.serializers:
+            set_serializer(name)
+            b = dumpb(data)
+            self.assertTrue(isinstance(b, bytes), name)
+            s = dumps(data)
+            self.assertTrue(isinstance(s, str), name)
+            self.assertEqual(s, b.decode('utf-8'), name)
+            # Compact, in key order
+            self.assertNotIn(b', ', b, name)
+            self.assertTrue(s.startswith('{"b":'), name)
+            self.assertEqual(loads(b), data, name)
+            self.assertEqual(loads(s), data, name)
+
+    def test_pretty(self):
+        data = {'b': [1, 2], 'a': {'d': None, 'c': 'x'}}
+        expected = json.dumps(data, indent=4, sort_keys=True)
+        for name in serializer.serializers:
+            set_serializer(name)
+            # Same indentation and key order whatever the library
+            self.assertEqual(dumps(data, pretty=True), expected, name)
+
+    def test_non_str_keys(self):
+        for name in serializer.serializers:
+            set_serializer(name)
+            self.assertEqual(loads(dumps({1: 'a', 'b': 2})), {'1': 'a', 'b': 2}, name)
+            self.assertEqual(loads(dumps({2: 'a', 1: 'b'}, pretty=True)), {'1': 'b', '2': 'a'}, name)
+
+    def test_fallback(self):
+        for name in serializer.serializers:
+            set_serializer(name)
+            # Ints too large for the fast libraries are left to the standard one
+            self.assertEqual(dumps({'n': 2 ** 70}), '{"n":%s}' % 2 ** 70, name)
+            self.assertEqual(json.loads(dumps({'n': 2 ** 70}, pretty=True)), {'n': 2 ** 70}, name)
+            # Which raises the usual error on what it can't serialize
+            with self.assertRaises(TypeError):
+                dumps({'o': object()})
@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from click.testing import CliRunner
+from klue_microservice import soak
+from klue_microservice.soak import record_latency, read_latencies, drift, main, MB
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (os.environ.get('KLUE_LATENCY_LOG'), soak.get_server_memory)
+        self.memory = {}
+        soak.get_server_memory = lambda pid: self.memory.get(pid)
+
+    def tearDown(self):
+        latency_log, soak.get_server_memory = self.saved
+        os.environ.pop('KLUE_LATENCY_LOG', None)
+        if latency_log:
+            os.environ['KLUE_LATENCY_LOG'] = latency_log
+        shutil.rmtree(self.tmpdir)
+
+    def run_iteration(self, iteration, latencies, memory=None, args=()):
+        """Log the latencies of one iteration's calls, and record them"""
+        os.environ['KLUE_LATENCY_LOG'] = os.path.join(self.tmpdir, 'latency-%s.jsonl' % iteration)
+        for ms in latencies:
+            record_latency('get', 'http://localhost/ping', 200, ms)
+        cmd = ['--dir', self.tmpdir, '--iteration', str(iteration)] + list(args)
+        if memory:
+            self.memory[1234] = memory
+            cmd += ['--pid', '1234']
+        return CliRunner().invoke(main, cmd)
+
+    def get_series(self):
+        with open(os.path.join(self.tmpdir, 'timeseries.json')) as f:
+            return json.loads(f.read())
+
+    def test_record_latency(self):
+        path = os.path.join(self.tmpdir, 'latency.jsonl')
+        os.environ.pop('KLUE_LATENCY_LOG', None)
+        record_latency('get', 'http://localhost/ping', 200, 1.5)
+        self.assertFalse(os.path.exists(path))
+
+        os.environ['KLUE_LATENCY_LOG'] = path
+        record_latency('get', 'http://localhost/ping', 200, 3.14159)
+        record_latency('post', 'http://localhost/v1/users', 500, 1.5)
+        with open(path) as f:
+            self.assertEqual(json.loads(f.readline()), {'method': 'get', 'url': 'http://localhost/ping', 'status': 200, 'ms': 3.142})
+        self.assertEqual(read_latencies(path), [1.5, 3.142])
+        self.assertEqual(read_latencies(os.path.join(self.tmpdir, 'nosuchfile')), [])
+
+    def test_drift(self):
+        series = [{'p95_ms': v} for v in (10, 12, 11, 14, 16, 15)]
+        # Median of the last 3 (15) versus median of the first 3 (11)
+        self.assertAlmostEqual(drift(series, 'p95_ms', 3), 400.0 / 11)
+        # Not enough iterations yet
+        self.assertIsNone(drift(series[0:3], 'p95_ms', 3))
+        # Iterations without a value are skipped
+        self.assertIsNone(drift(series + [{}], 'memory', 3))
+        self.assertAlmostEqual(drift([{'memory': None}] + series, 'p95_ms', 3), 400.0 / 11)
+        # Improvements are negative
+        self.assertEqual(drift([{'p95_ms': v} for v in (10, 10, 10, 5, 5)], 'p95_ms', 3), -50)
+
+    def test_time_series(self):
+        for i in range(1, 5):
+            r = self.run_iteration(i, [float(ms) for ms in range(1, 101)], memory=(100 + i) * MB)
+            self.assertEqual(r.exit_code, 0, r.output)
+
+        series = self.get_series()
+        self.assertEqual([s['iteration'] for s in series], [1, 2, 3, 4])
+        self.assertEqual(series[0]['calls'], 100)
+        self.assertEqual((series[0]['p50_ms'], series[0]['p95_ms'], series[0]['p99_ms']), (51, 96, 100))
+        self.assertEqual([s['memory'] for s in series], [101 * MB, 102 * MB, 103 * MB, 104 * MB])
+        self.assertIn('=> p95_ms drifted by +0.0% since the first 3 iterations', r.output)
+
+        with open(os.path.join(self.tmpdir, 'report.txt')) as f:
+            lines = f.read().strip().split('\n')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[-1].split()[-1], '104.0')
+
+    def test_max_p95_drift(self):
+        args = ['--max-p95-drift', '50', '--max-memory-drift', '20']
+        for i in range(1, 4):
+            r = self.run_iteration(i, [10.0] * 20, memory=100 * MB, args=args)
+            self.assertEqual(r.exit_code, 0, r.output)
+
+        # p95 up 40%: within bounds
+        r = self.run_iteration(4, [14.0] * 20, memory=100 * MB, args=args)
+        self.assertEqual(r.exit_code, 0, r.output)
+
+        # up 60% over the last 3 iterations
+        self.run_iteration(5, [16.0] * 20, memory=100 * MB, args=args)
+        r = self.run_iteration(6, [16.0] * 20, memory=100 * MB, args=args)
+        self.assertEqual(r.exit_code, 1, r.output)
+        self.assertIn('ERROR: p95_ms drifted by more than 50.0%', r.output)
+        self.assertNotIn('ERROR: memory', r.output)
+
+    def test_max_memory_drift(self):
+        args = ['--max-memory-drift', '20']
+        for i, mb in enumerate([100, 90, 110, 115, 125, 130], 1):
+            r = self.run_iteration(i, [10.0] * 20, memory=mb * MB, args=args)
+        # Median of the last 3 (125) versus of the first 3 (100)
+        self.assertEqual(r.exit_code, 1, r.output)
+        self.assertIn('=> memory drifted by +25.0%', r.output)
+        self.assertIn('ERROR: memory drifted by more than 20.0%', r.output)
+
+        # Without a server to measure
+        self.run_iteration(7, [10.0] * 20, args=args)
+        self.assertEqual(self.get_series()[-1].get('memory'), None)
@@ -0,0 +1,168 @@
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import subprocess
+from types import SimpleNamespace
+from klue_microservice import tasks
+from klue_microservice.exceptions import TaskQueueFullError
+from klue_microservice.tasks import background_task, TaskExecutor, TaskSpool, Job
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.tmpdir, 'tasks.sqlite')
+        self.saved = tasks.executor
+
+    def tearDown(self):
+        tasks.executor = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def get_executor(self, workers=2, queue_size=100):
+        tasks.executor = TaskExecutor(SimpleNamespace(
+            task_workers=workers,
+            task_queue_size=queue_size,
+            task_spool_path=self.spool_path,
+        ))
+        return tasks.executor
+
+    def wait_for(self, condition, timeout=5):
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("Timed out")
+
+    def test_delay(self):
+        e = self.get_executor()
+        done = []
+
+        @background_task
+        def add(a, b=0):
+            done.append(a + b)
+
+        # Calling the task runs it right away
+        add(1, b=1)
+        self.assertEqual(done, [2])
+
+        add.delay(2, b=3)
+        self.wait_for(lambda: len(done) == 2)
+        self.assertEqual(done, [2, 5])
+        self.wait_for(lambda: e.get_stats()['completed'] == 1)
+        self.assertEqual(e.get_stats()['submitted'], 1)
+
+    def test_retries(self):
+        e = self.get_executor()
+        attempts = []
+
+        @background_task(retries=2, backoff=0.1)
+        def flaky():
+            attempts.append(time.time())
+            if len(attempts) < 3:
+                raise Exception("Failing attempt %s" % len(attempts))
+
+        @background_task(retries=1, backoff=0.1)
+        def broken():
+            raise Exception("Always failing")
+
+        flaky.delay()
+        broken.delay()
+        self.wait_for(lambda: e.get_stats()['completed'] == 1 and e.get_stats()['failed'] == 1)
+
+        self.assertEqual(len(attempts), 3)
+        # Backoff doubles after each attempt
+        self.assertTrue(attempts[1] - attempts[0] >= 0.1)
+        self.assertTrue(attempts[2] - attempts[1] >= 0.2)
+        self.assertEqual(e.get_stats()['retried'], 3)
+
+    def test_queue_full(self):
+        e = self.get_executor(workers=1, queue_size=1)
+        release = threading.Event()
+
+        @background_task
+        def wait():
+            release.wait(5)
+
+        try:
+            wait.delay()
+            self.wait_for(lambda: e.get_stats()['running'] == 1)
+            wait.delay()
+            with self.assertRaises(TaskQueueFullError):
+                wait.delay()
+            self.assertEqual(e.get_stats()['rejected'], 1)
+        finally:
+            release.set()
+        self.wait_for(lambda: e.get_stats()['completed'] == 2)
+
+    def test_durable(self):
+        e = self.get_executor()
+        done = []
+
+        @background_task(durable=True)
+        def save(d):
+            done.append(d)
+
+        with self.assertRaises(TypeError):
+            save.delay(object())
+        self.assertFalse(os.path.exists(self.spool_path))
+
+        save.delay({'a': [1, 2]})
+        self.wait_for(lambda: e.get_stats()['completed'] == 1)
+        self.assertEqual(done, [{'a': [1, 2]}])
+        # Removed from the spool once done
+        self.assertEqual(e.get_spool().count(), 0)
+
+    def test_spool_error(self):
+        e = self.get_executor(workers=1)
+        done = []
+
+        @background_task(durable=True)
+        def save(i):
+            done.append(i)
+
+        def remove(job):
+            raise sqlite3.OperationalError("database is locked")
+
+        e.get_spool().remove = remove
+        save.delay(1)
+        save.delay(2)
+        # The pool's only thread survived the first error
+        self.wait_for(lambda: done == [1, 2])
+
+    def test_spool(self):
+        @background_task(durable=True)
+        def save_user(user_id, name=None):
+            pass
+
+        spool = TaskSpool(self.spool_path)
+        job = Job(save_user, [1], {'name': 'bob'})
+        job.spool_id = spool.add(job)
+        self.assertEqual(spool.count(), 1)
+        job.attempts = 2
+        spool.update(job)
+
+        # Jobs of live workers are not taken over
+        spool.db.execute('UPDATE tasks SET owner = ?', (os.getppid(),))
+        self.assertEqual(spool.claim_orphans(), [])
+
+        # But those of dead ones are
+        p = subprocess.Popen(['true'])
+        p.wait()
+        spool.db.execute('UPDATE tasks SET owner = ?', (p.pid,))
+        jobs = spool.claim_orphans()
+        self.assertEqual(len(jobs), 1)
+        self.assertIs(jobs[0].task, save_user)
+        self.assertEqual((jobs[0].args, jobs[0].kwargs, jobs[0].attempts), ([1], {'name': 'bob'}, 2))
+        self.assertEqual(spool.db.execute('SELECT owner FROM tasks').fetchone()[0], os.getpid())
+
+        # And only once
+        self.assertEqual(spool.claim_orphans(), [])
+
+        spool.remove(jobs[0])
+        self.assertEqual(spool.count(), 0)
@@ -0,0 +1,136 @@
+import os
+import json
+import socket
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from flask import Flask
+from klue_microservice import tracing
+from klue_microservice.config import get_config
+from klue_microservice.tracing import Tracer, tracing_client_decorator, stack
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        conf = get_config(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'klue-config.yaml'))
+        self.saved = (conf.trace_sample_rate, conf.trace_buffer_size, conf.trace_sink, tracing.tracer)
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        conf = get_config()
+        conf.trace_sample_rate, conf.trace_buffer_size, conf.trace_sink, tracing.tracer = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def get_tracer(self, sample_rate=1, buffer_size=10, sink=None):
+        conf = get_config()
+        conf.trace_sample_rate = sample_rate
+        conf.trace_buffer_size = buffer_size
+        conf.trace_sink = sink
+        tracing.tracer = Tracer()
+        return tracing.tracer
+
+    def test_sampling(self):
+        tests = [
+            # sample rate, headers, sampled
+            (0, {}, False),
+            (1, {}, True),
+            (0, {'KlueTraceSampled': '1'}, True),
+            (1, {'KlueTraceSampled': '0'}, False),
+        ]
+        for rate, headers, sampled in tests:
+            t = self.get_tracer(sample_rate=rate)
+            with self.app.test_request_context('/', headers=headers):
+                span = t.start_server_span('do_stuff')
+                self.assertEqual(span is not None, sampled, (rate, headers))
+                if sampled:
+                    self.assertIs(stack.top.klue_span, span)
+
+    def test_client_span(self):
+        t = self.get_tracer()
+
+        def call_api(**kwargs):
+            return kwargs
+
+        caller = tracing_client_decorator(SimpleNamespace(name='myapi'), 'get_user', call_api)
+
+        # Not serving a request: nothing to trace
+        self.assertEqual(caller(), {})
+
+        with self.app.test_request_context('/', headers={'KlueSpanID': 'abcd'}):
+            stack.top.call_id = '1234-5678'
+            server_span = t.start_server_span('do_stuff')
+            self.assertEqual(server_span.parent_id, 'abcd')
+
+            headers = {'X-Foo': 'bar'}
+            kwargs = caller(request_headers=headers)
+            t.finish_span(server_span, 200)
+
+            # The caller's headers are left untouched
+            self.assertEqual(headers, {'X-Foo': 'bar'})
+            client_span, server_span = t.get_spans()
+            self.assertEqual(kwargs['request_headers'], {
+                'X-Foo': 'bar',
+                'KlueSpanID': client_span['id'],
+                'KlueTraceSampled': '1',
+            })
+
+        self.assertEqual(client_span['name'], 'myapi.get_user')
+        self.assertEqual(client_span['kind'], 'CLIENT')
+        self.assertEqual(client_span['parentId'], server_span['id'])
+        self.assertEqual(client_span['traceId'], '12345678')
+        self.assertEqual(server_span['kind'], 'SERVER')
+        self.assertEqual(server_span['parentId'], 'abcd')
+        self.assertEqual(server_span['tags'], {'http.status_code': '200'})
+
+    def test_ring_buffer(self):
+        t = self.get_tracer(buffer_size=3)
+        with self.app.test_request_context('/'):
+            for i in range(5):
+                t.finish_span(t.start_server_span('do_%s' % i))
+        self.assertEqual([s['name'] for s in t.get_spans()], ['do_2', 'do_3', 'do_4'])
+
+    def test_export_file(self):
+        path = os.path.join(self.tmpdir, 'spans.json')
+        t = self.get_tracer(sink='file://%s' % path)
+        with self.app.test_request_context('/'):
+            t.finish_span(t.start_server_span('do_stuff'), 200)
+            t.finish_span(t.start_server_span('do_other_stuff'), 500)
+
+        with open(path) as f:
+            lines = [json.loads(l) for l in f.readlines()]
+        self.assertEqual([l[0]['name'] for l in lines], ['do_stuff', 'do_other_stuff'])
+        self.assertEqual(lines[1][0]['tags'], {'http.status_code': '500'})
+
+    def test_export_udp(self):
+        collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        collector.bind(('127.0.0.1', 0))
+        collector.settimeout(2)
+        try:
+            t = self.get_tracer(sink='udp://127.0.0.1:%s' % collector.getsockname()[1])
+            with self.app.test_request_context('/'):
+                t.finish_span(t.start_server_span('do_stuff'), 200)
+            spans = json.loads(collector.recv(65536).decode('utf-8'))
+            self.assertEqual(spans[0]['name'], 'do_stuff')
+        finally:
+            collector.close()
+
+    def test_export_bad_sink(self):
+        for sink in ('file:///no/such/dir/spans.json', 'udp://localhost', 'udp://localhost:notaport', 'http://localhost:9411'):
+            t = self.get_tracer(sink=sink)
+            with self.app.test_request_context('/'):
+                # Never raises
+                t.finish_span(t.start_server_span('do_stuff'), 200)
+            self.assertIsNone(t.sink, sink)
+            self.assertEqual(len(t.get_spans()), 1)
+
+    def test_debug_spans(self):
+        from klue_microservice.api import do_debug_spans
+        t = self.get_tracer()
+        with self.app.test_request_context('/'):
+            t.finish_span(t.start_server_span('do_stuff'))
+            j = json.loads(do_debug_spans().get_data().decode('utf-8'))
+        self.assertEqual(j['pid'], os.getpid())
+        self.assertEqual([s['name'] for s in j['spans']], ['do_stuff'])
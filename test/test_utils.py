@@ -0,0 +1,105 @@
+import os
+import json
+import shutil
+import socket
+import datetime
+import tempfile
+import unittest
+from dateutil import parser
+from klue_microservice import utils
+
+
+class Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (utils.ENVIRONMENT_FILE, utils.environment, utils.read_container_version, utils.probe_ec2_instance)
+        self.saved_override = os.environ.pop('KLUE_IS_EC2_INSTANCE', None)
+        utils.ENVIRONMENT_FILE = os.path.join(self.tmpdir, 'klue-environment.json')
+        utils.environment = None
+        utils.read_container_version = lambda: '1.2.3'
+
+    def tearDown(self):
+        utils.ENVIRONMENT_FILE, utils.environment, utils.read_container_version, utils.probe_ec2_instance = self.saved
+        os.environ.pop('KLUE_IS_EC2_INSTANCE', None)
+        if self.saved_override is not None:
+            os.environ['KLUE_IS_EC2_INSTANCE'] = self.saved_override
+        shutil.rmtree(self.tmpdir)
+
+    def test_environment_override(self):
+        utils.probe_ec2_instance = lambda: self.fail("Should not probe ec2")
+        os.environ['KLUE_IS_EC2_INSTANCE'] = '1'
+        self.assertTrue(utils.is_ec2_instance())
+        self.assertEqual(utils.get_container_version(), '1.2.3')
+
+        utils.environment = None
+        os.environ['KLUE_IS_EC2_INSTANCE'] = 'false'
+        self.assertFalse(utils.is_ec2_instance())
+        self.assertIsNone(utils.start_environment_probe())
+        self.assertFalse(os.path.exists(utils.ENVIRONMENT_FILE))
+
+    def test_environment_cache(self):
+        utils.probe_ec2_instance = lambda: True
+        t = utils.start_environment_probe()
+        t.join(5)
+        self.assertTrue(utils.is_ec2_instance())
+        self.assertEqual(utils.get_container_version(), '1.2.3')
+
+        # Only the ec2 probe is cached, not the container's version
+        with open(utils.ENVIRONMENT_FILE) as f:
+            self.assertEqual(json.loads(f.read()), {
+                'is_ec2_instance': True,
+                'hostname': socket.gethostname(),
+            })
+
+        # The next master reuses the probe, and reads the new version
+        utils.environment = None
+        utils.probe_ec2_instance = lambda: self.fail("Should not probe ec2")
+        utils.read_container_version = lambda: '1.2.4'
+        self.assertIsNone(utils.start_environment_probe())
+        self.assertTrue(utils.is_ec2_instance())
+        self.assertEqual(utils.get_container_version(), '1.2.4')
+
+    def test_environment_cache_other_host(self):
+        with open(utils.ENVIRONMENT_FILE, 'w') as f:
+            f.write(json.dumps({'is_ec2_instance': True, 'hostname': 'not-%s' % socket.gethostname()}))
+        utils.probe_ec2_instance = lambda: False
+        self.assertFalse(utils.is_ec2_instance())
+
+    def test_parse_iso_8601(self):
+        tests = [
+            # string, epoch
+            ('2017-03-01T10:24:12', 1488363852),
+            ('2017-03-01 10:24:12', 1488363852),
+            ('2017-03-01T10:24:12Z', 1488363852),
+            ('2017-03-01T10:24:12.5', 1488363852.5),
+            ('2017-03-01T10:24:12.123456Z', 1488363852.123456),
+            ('2017-03-01T10:24:12.1234567', 1488363852.123456),
+            ('2017-03-01T10:24:12+01:00', 1488363852 - 3600),
+            ('2017-03-01T10:24:12.250-05:30', 1488363852.25 + 5.5 * 3600),
+            ('2017-03-01T10:24:12+0100', 1488363852 - 3600),
+        ]
+        for s, epoch in tests:
+            self.assertAlmostEqual(utils.parse_iso_8601(s), epoch, places=6, msg=s)
+            # Same as dateutil's reading of it
+            t = parser.parse(s)
+            if t.tzinfo is None:
+                t = t.replace(tzinfo=utils.UTC)
+            self.assertEqual(int((t - utils.EPOCH).total_seconds()), int(epoch), s)
+            self.assertEqual(utils.to_epoch(s), int(epoch), s)
+
+        for s in ('2017-03-01', '01/03/2017 10:24:12', '2017-03-01T10:24:12 UTC'):
+            self.assertIsNone(utils.parse_iso_8601(s), s)
+
+    def test_bulk_conversions(self):
+        ts = [
+            '2017-03-01T10:24:12.5Z',
+            '2017-03-01T10:24:12+02:00',
+            'Wed, 01 Mar 2017 10:24:12',
+            datetime.datetime(2017, 3, 1, 10, 24, 12),
+            datetime.datetime(2017, 3, 1, 10, 24, 12, tzinfo=utils.UTC),
+        ]
+        epochs = utils.to_epoch_many(ts)
+        self.assertEqual(epochs, [utils.to_epoch(t) for t in ts])
+        self.assertEqual(utils.to_datetime_many(epochs), [utils.to_datetime(e) for e in epochs])
+        self.assertEqual(utils.to_epoch_many([]), [])
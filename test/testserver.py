@@ -35,7 +35,7 @@ def test_crash_reporter(msg, body):
         f.write(json.dumps(data))
 
 
-def start(port, debug):
+def start(port=8765, debug=False):
 
     api = API(
         app,
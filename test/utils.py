@@ -4,8 +4,7 @@ import logging
 import json
 import subprocess
 import psutil
-from time import sleep
-from klue_microservice.test import KlueMicroServiceTestCase
+from klue_microservice.test import KlueMicroServiceTestCase, wait_for_server
 
 
 log = logging.getLogger(__name__)
@@ -36,11 +35,7 @@ class KlueMicroServiceTests(KlueMicroServiceTestCase):
         p = subprocess.Popen([path_server])
         self.pid = p.pid
         log.info("Waiting for test server with pid %s to start" % self.pid)
-        sleep(2)
-
-        try:
-            p = psutil.Process(self.pid)
-        except psutil.NoSuchProcess as e:
+        if not wait_for_server('127.0.0.1', 8765, p=p):
             assert 0, "Failed to start testserver"
 
 